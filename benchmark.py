@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 SUSE LLC.
+#
+# All modifications and additions to the file contributed by third parties
+# remain the property of their copyright owners, unless otherwise agreed
+# upon. The license for this file, and modifications and additions to the
+# file, is the same license as for the pristine package itself (unless the
+# license for the pristine package is not an Open Source License, in which
+# case the license is the MIT License). An "Open Source License" is a
+# license that conforms to the Open Source Definition (Version 1.9)
+# published by the Open Source Initiative.
+
+# Please submit bugfixes or comments via http://bugs.opensuse.org/
+#
+
+# Benchmark for venvjail.  Generate a synthetic repository of RPM and
+# Debian packages, that are similar to the Python packages used to
+# build a venv, and measure `create` and some of the internal phases.
+
+import argparse
+import datetime
+import gzip
+import io
+import json
+import lzma
+import os
+import pathlib
+import random
+import re
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import sysconfig
+import tarfile
+import tempfile
+import time
+
+import venvjail
+from venvjail import (
+    AR_MAGIC,
+    CPIO_HEADER_SIZE,
+    CPIO_MAGIC,
+    RPM_HEADER_MAGIC,
+    RPM_INT32_TYPE,
+    RPM_LEAD_MAGIC,
+    RPM_LEAD_SIZE,
+    RPM_STRING_ARRAY_TYPE,
+    RPM_STRING_TYPE,
+    RPMTAG_ARCH,
+    RPMTAG_BASENAMES,
+    RPMTAG_DIRINDEXES,
+    RPMTAG_DIRNAMES,
+    RPMTAG_DISTURL,
+    RPMTAG_FILELINKTOS,
+    RPMTAG_FILEMODES,
+    RPMTAG_FILESIZES,
+    RPMTAG_NAME,
+    RPMTAG_PAYLOADCOMPRESSOR,
+    RPMTAG_PAYLOADFORMAT,
+    RPMTAG_PROVIDENAME,
+    RPMTAG_RELEASE,
+    RPMTAG_REQUIRENAME,
+    RPMTAG_VERSION,
+)
+
+# Fixed modification time, so the packages are reproducible
+MTIME = 1577836800
+
+REMOVE_FILE = """\
+# Remove list used by the benchmark
+usr/share/doc/packages/.*
+lib/python{version}/site-packages/.*/tests
+.*\\.pyc
+"""
+
+
+def _compress(data, compressor):
+    """Compress the payload of a package."""
+    if compressor == "gzip":
+        return gzip.compress(data, mtime=0)
+    elif compressor == "xz":
+        return lzma.compress(data)
+    elif compressor == "zstd":
+        return subprocess.run(
+            ["zstd", "-q", "-c"], input=data, stdout=subprocess.PIPE, check=True
+        ).stdout
+    return data
+
+
+def _rpm_header(tags):
+    """Build a RPM header structure from a dict of tags."""
+    index = []
+    store = b""
+    for tag, value in sorted(tags.items()):
+        if isinstance(value, str):
+            type_, count, data = RPM_STRING_TYPE, 1, value.encode() + b"\0"
+        elif value and isinstance(value[0], int):
+            # INT32 values are aligned to 4 bytes
+            store += b"\0" * (-len(store) % 4)
+            type_, count = RPM_INT32_TYPE, len(value)
+            data = struct.pack(f">{len(value)}I", *value)
+        else:
+            type_, count = RPM_STRING_ARRAY_TYPE, len(value)
+            data = b"".join(v.encode() + b"\0" for v in value)
+        index.append(struct.pack(">IIII", tag, type_, len(store), count))
+        store += data
+    return (
+        RPM_HEADER_MAGIC
+        + b"\0\0\0\0"
+        + struct.pack(">II", len(index), len(store))
+        + b"".join(index)
+        + store
+    )
+
+
+def _cpio(entries):
+    """Build a cpio (newc) archive from a list of entries."""
+    out = io.BytesIO()
+
+    def _write(name, mode, data, ino):
+        name = name.encode() + b"\0"
+        fields = (ino, mode, 0, 0, 1, MTIME, len(data), 0, 0, 0, 0, len(name), 0)
+        out.write(CPIO_MAGIC[0] + b"".join(b"%08X" % v for v in fields))
+        out.write(name + b"\0" * (-(CPIO_HEADER_SIZE + len(name)) % 4))
+        out.write(data + b"\0" * (-len(data) % 4))
+
+    for ino, (name, mode, data) in enumerate(entries, 1):
+        _write(f"./{name}", mode, data, ino)
+    _write("TRAILER!!!", 0, b"", 0)
+    return out.getvalue()
+
+
+def write_rpm(path, name, entries, compressor="gzip", requires=()):
+    """Write a RPM package with the entries of the payload."""
+    dirnames = sorted({os.path.dirname(f"/{e[0]}") + "/" for e in entries})
+    tags = {
+        RPMTAG_NAME: name,
+        RPMTAG_VERSION: "1.0",
+        RPMTAG_RELEASE: "1.1",
+        RPMTAG_ARCH: "noarch",
+        RPMTAG_PROVIDENAME: [name],
+        RPMTAG_DISTURL: f"obs://build.example.com/bench/standard/{name}",
+        RPMTAG_PAYLOADFORMAT: "cpio",
+        RPMTAG_PAYLOADCOMPRESSOR: compressor,
+        RPMTAG_BASENAMES: [os.path.basename(e[0]) for e in entries],
+        RPMTAG_DIRNAMES: dirnames,
+        RPMTAG_DIRINDEXES: [
+            dirnames.index(os.path.dirname(f"/{e[0]}") + "/") for e in entries
+        ],
+        RPMTAG_FILESIZES: [
+            0 if e[1] & 0o170000 == 0o040000 else len(e[2]) for e in entries
+        ],
+        RPMTAG_FILEMODES: [e[1] for e in entries],
+        RPMTAG_FILELINKTOS: [
+            e[2].decode() if e[1] & 0o170000 == 0o120000 else "" for e in entries
+        ],
+    }
+    if requires:
+        tags[RPMTAG_REQUIRENAME] = list(requires)
+    lead = RPM_LEAD_MAGIC + b"\x03\x00\x00\x00" + name.encode()[:65].ljust(66, b"\0")
+    lead += b"\0" * (RPM_LEAD_SIZE - len(lead))
+    signature = _rpm_header({RPMTAG_NAME: [0]})
+    signature += b"\0" * (-len(signature) % 8)
+    with open(path, "wb") as f:
+        f.write(lead + signature + _rpm_header(tags))
+        f.write(_compress(_cpio(entries), compressor))
+
+
+def _tar(entries, compressor):
+    """Build a compressed tar archive from a list of entries."""
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for name, mode, data in entries:
+            info = tarfile.TarInfo(f"./{name}")
+            info.mode = mode & 0o7777
+            info.mtime = MTIME
+            info.uname = info.gname = "root"
+            if mode & 0o170000 == 0o040000:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif mode & 0o170000 == 0o120000:
+                info.type = tarfile.SYMTYPE
+                info.linkname = data.decode()
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return _compress(out.getvalue(), compressor)
+
+
+def write_deb(path, name, entries, compressor="gzip", requires=()):
+    """Write a Debian package with the entries of the data member."""
+    control = f"Package: {name}\nVersion: 1.0-1.1\nArchitecture: all\n"
+    if requires:
+        control += f"Depends: {', '.join(requires)}\n"
+    control += "Maintainer: Benchmark <bench@example.com>\nDescription: Benchmark\n"
+    suffix = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst", "none": ""}[compressor]
+    members = [
+        ("debian-binary", b"2.0\n"),
+        ("control.tar.gz", _tar([("control", 0o100644, control.encode())], "gzip")),
+        (f"data.tar{suffix}", _tar(entries, compressor)),
+    ]
+    with open(path, "wb") as f:
+        f.write(AR_MAGIC)
+        for member, data in members:
+            header = f"{member:<16}{MTIME:<12}{0:<6}{0:<6}{100644:<8}{len(data):<10}`\n"
+            f.write(header.encode() + data + b"\n" * (len(data) % 2))
+
+
+def _package_entries(name, files, file_size, python_version, rng):
+    """Entries of a synthetic Python package, with `files` files."""
+    site = f"usr/lib/python{python_version}/site-packages/{name}"
+    dirs = [
+        "usr",
+        "usr/bin",
+        "usr/lib",
+        f"usr/lib/python{python_version}",
+        f"usr/lib/python{python_version}/site-packages",
+        site,
+        f"{site}/tests",
+        "usr/lib/systemd",
+        "usr/lib/systemd/system",
+        "usr/share",
+        "usr/share/doc",
+        "usr/share/doc/packages",
+        f"usr/share/doc/packages/{name}",
+    ]
+    entries = [(d, 0o040755, b"") for d in dirs]
+
+    def _content(header=b""):
+        # Valid Python code, so the modules can be compiled
+        lines = [header]
+        size = len(header)
+        while size < file_size:
+            value = bytes(rng.choices(b"abcdefghij", k=24))
+            lines.append(b'VALUE_%d = "%s"\n' % (len(lines), value))
+            size += len(lines[-1])
+        return b"".join(lines)
+
+    # Scripts with a Python shebang, an alternative and a service
+    shebang = b"#!/usr/bin/python3\n"
+    entries += [
+        (f"usr/bin/{name}", 0o100755, _content(shebang)),
+        (f"usr/bin/{name}-alt", 0o120777, f"/etc/alternatives/{name}-alt".encode()),
+        (f"usr/bin/{name}-alt-{python_version}", 0o100755, _content(shebang)),
+        (
+            f"usr/lib/systemd/system/{name}.service",
+            0o100644,
+            f"[Service]\nExecStart=/usr/bin/{name}\n".encode(),
+        ),
+        (f"usr/share/doc/packages/{name}/README", 0o100644, _content()),
+        (f"{site}/__init__.py", 0o100644, b""),
+        (f"{site}/compat.py", 0o120777, b"__init__.py"),
+    ]
+
+    # The rest are modules and tests
+    for n in range(max(files - (len(entries) - len(dirs)), 0)):
+        if n % 5 == 4:
+            entries.append((f"{site}/tests/test_{n}.py", 0o100644, _content()))
+        else:
+            entries.append((f"{site}/module_{n}.py", 0o100644, _content()))
+    return entries
+
+
+def generate(repo, packages, files, file_size, fmt, compressor, python_version, seed):
+    """Generate a synthetic repository, and return the paths of the files."""
+    rng = random.Random(seed)
+    repo.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for n in range(packages):
+        name = f"python3-bench{n:04}"
+        entries = _package_entries(name, files, file_size, python_version, rng)
+        # Paths inside the venv, where `usr/bin` and `usr/lib` are links
+        paths.extend(re.sub(r"^usr/(bin|lib)/", r"\1/", e[0]) for e in entries)
+        # Each package requires some of the previous ones
+        requires = [f"python3-bench{r:04}" for r in range(max(0, n - 2), n)]
+        if fmt == "deb" or (fmt == "mixed" and n % 2):
+            write_deb(
+                repo / f"{name}_1.0-1.1_all.deb", name, entries, compressor, requires
+            )
+        else:
+            write_rpm(
+                repo / f"{name}-1.0-1.1.noarch.rpm",
+                name,
+                entries,
+                compressor,
+                requires,
+            )
+    return paths
+
+
+def bench_create(workdir, repo, remove_file, jobs, extra=()):
+    """Run `create` and return the wall time and the internal timings."""
+    dest_dir = workdir / "venv"
+    if dest_dir.exists():
+        shutil.rmtree(dest_dir)
+    timings_json = workdir / "timings.json"
+    command = [
+        sys.executable,
+        str(pathlib.Path(venvjail.__file__).resolve()),
+        "create",
+        str(dest_dir),
+        "--repo",
+        str(repo),
+        "--include",
+        str(workdir / "include-rpm"),
+        "--exclude",
+        str(workdir / "exclude-rpm"),
+        "--remove",
+        str(remove_file),
+        "--jobs",
+        str(jobs),
+        "--timings-json",
+        str(timings_json),
+        *extra,
+    ]
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    with timings_json.open() as f:
+        return wall, json.load(f)
+
+
+def _link_stdlib(dest_dir, python_version):
+    """Link the standard library inside the venv, so the loader can start."""
+    # The synthetic repository has no interpreter package, and both
+    # loaders take the standard library from the venv (the shell one
+    # sets PYTHONHOME, and the native one points `home` to the venv),
+    # like in the venvs that install the Python packages
+    stdlib = pathlib.Path(sysconfig.get_paths()["stdlib"])
+    lib_dir = dest_dir / "lib" / f"python{python_version}"
+    for path in stdlib.iterdir():
+        if not (lib_dir / path.name).exists():
+            (lib_dir / path.name).symlink_to(path)
+
+
+def bench_startup(command, runs):
+    """Return the wall time of every run of a command."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_filelist(remove_file, paths):
+    """Return the time needed to match all the paths with the remove list."""
+    start = time.perf_counter()
+    filelist = venvjail.FileList(remove_file)
+    sum(path in filelist for path in paths)
+    return time.perf_counter() - start
+
+
+def _git_revision():
+    """Return the current commit, if any."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(results, baseline=None):
+    """Print the median and minimum of each measure."""
+    print(f"{'Benchmark':<32} {'Median (s)':>11} {'Min (s)':>10} {'Baseline':>10}")
+    for name, values in results.items():
+        median = statistics.median(values)
+        line = f"{name:<32} {median:11.4f} {min(values):10.4f}"
+        if baseline and baseline.get(name):
+            ratio = median / statistics.median(baseline[name])
+            line += f" {ratio:9.2f}x"
+        print(line)
+
+
+def _load_baseline(filename, params):
+    """Return the results of the last run with the same parameters."""
+    baseline = None
+    with open(filename) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["params"] == params:
+                baseline = record["results"]
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark for venvjail")
+    parser.add_argument(
+        "-n", "--packages", type=int, default=50, help="Number of packages"
+    )
+    parser.add_argument(
+        "-m", "--files", type=int, default=40, help="Number of files per package"
+    )
+    parser.add_argument(
+        "-s", "--file-size", type=int, default=2048, help="Size of each file"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("rpm", "deb", "mixed"),
+        default="rpm",
+        help="Format of the packages",
+    )
+    parser.add_argument(
+        "-c",
+        "--compressor",
+        choices=("gzip", "xz", "zstd", "none"),
+        default="gzip",
+        help="Compression of the payload",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Jobs used by `create`"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Number of repetitions"
+    )
+    parser.add_argument(
+        "--compile", action="store_true", help="Compile the modules in `create`"
+    )
+    parser.add_argument(
+        "--startup",
+        type=int,
+        default=0,
+        metavar="RUNS",
+        help="Measure the startup of the interpreter and of a script, "
+        "for every loader",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=pathlib.Path,
+        default="bench_output.txt",
+        help="File where the results are appended, as JSON lines",
+    )
+    parser.add_argument(
+        "--compare",
+        type=pathlib.Path,
+        help="Compare with the last run with the same parameters in this file",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the generated repository"
+    )
+    args = parser.parse_args()
+
+    python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    params = {
+        "packages": args.packages,
+        "files": args.files,
+        "file_size": args.file_size,
+        "format": args.format,
+        "compressor": args.compressor,
+        "jobs": args.jobs,
+        "compile": args.compile,
+        "startup": args.startup,
+        "seed": args.seed,
+    }
+
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix="venvjail-bench-"))
+    try:
+        repo = workdir / "repo"
+        paths = generate(
+            repo,
+            args.packages,
+            args.files,
+            args.file_size,
+            args.format,
+            args.compressor,
+            python_version,
+            args.seed,
+        )
+        (workdir / "include-rpm").write_text("python3-bench.*\n")
+        (workdir / "exclude-rpm").write_text("")
+        remove_file = workdir / "remove-file"
+        remove_file.write_text(REMOVE_FILE.format(version=python_version))
+
+        results = {}
+        for _ in range(args.repeat):
+            extra = ["--compile"] if args.compile else []
+            wall, timings = bench_create(workdir, repo, remove_file, args.jobs, extra)
+            results.setdefault("create", []).append(wall)
+            for phase in timings["phases"]:
+                results.setdefault(f"create:{phase['name']}", []).append(phase["wall"])
+            results.setdefault("filelist", []).append(
+                bench_filelist(remove_file, paths)
+            )
+
+        # The same venv is created with each loader, in the same place.
+        # The native loader cannot export LD_LIBRARY_PATH, so both use
+        # a runpath
+        dest_dir = workdir / "venv"
+        for loader in ("shell", "native") if args.startup else ():
+            extra = ["--loader", loader, "--runpath"]
+            bench_create(workdir, repo, remove_file, args.jobs, extra)
+            _link_stdlib(dest_dir, python_version)
+            python = dest_dir / "bin" / "python3"
+            script = dest_dir / "bin" / "python3-bench0000"
+            results[f"startup:{loader}"] = bench_startup(
+                [python, "-c", "pass"], args.startup
+            )
+            results[f"script:{loader}"] = bench_startup([script], args.startup)
+    finally:
+        if args.keep:
+            print(f"Repository kept in {workdir}")
+        else:
+            shutil.rmtree(workdir)
+
+    baseline = None
+    if args.compare and args.compare.exists():
+        baseline = _load_baseline(args.compare, params)
+    _summary(results, baseline)
+
+    record = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": sys.version.split()[0],
+        "params": params,
+        "results": results,
+    }
+    with args.output.open("a") as f:
+        print(json.dumps(record), file=f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1292 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 SUSE LLC.
+#
+# All modifications and additions to the file contributed by third parties
+# remain the property of their copyright owners, unless otherwise agreed
+# upon. The license for this file, and modifications and additions to the
+# file, is the same license as for the pristine package itself (unless the
+# license for the pristine package is not an Open Source License, in which
+# case the license is the MIT License). An "Open Source License" is a
+# license that conforms to the Open Source Definition (Version 1.9)
+# published by the Open Source Initiative.
+
+# Please submit bugfixes or comments via http://bugs.opensuse.org/
+#
+
+# Tests for the fixes of venvjail that rewrite binaries or links.  The
+# ELF files are compiled with the C compiler of the system, and the
+# packages are generated like in the benchmark.
+
+import argparse
+import functools
+import http.server
+import io
+import marshal
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import benchmark
+import venvjail
+
+LIBFOO = "int foo(void) { return 42; }\n"
+PROG = "int foo(void);\nint main(void) { return foo() == 42 ? 0 : 1; }\n"
+
+
+def _compile(path, source, *flags):
+    """Compile a C source into an ELF file."""
+    src = path.with_name(path.name + ".c")
+    src.write_text(source)
+    subprocess.run(["cc", "-g", "-o", str(path), str(src), *flags], check=True)
+    src.unlink()
+
+
+def _readelf(*options):
+    """Return the output of readelf, that cannot have warnings."""
+    result = subprocess.run(
+        ["readelf", "-W", *map(str, options)],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if result.stderr:
+        raise AssertionError(result.stderr)
+    return result.stdout
+
+
+def _run(path):
+    """Run an executable without LD_LIBRARY_PATH, and return the exit code."""
+    env = {k: v for k, v in os.environ.items() if k != "LD_LIBRARY_PATH"}
+    return subprocess.run([str(path)], env=env).returncode
+
+
+@unittest.skipUnless(shutil.which("cc") and shutil.which("readelf"), "needs cc")
+class ElfTestCase(unittest.TestCase):
+    """A venv with a library in `lib`, and an executable in `bin`."""
+
+    def setUp(self):
+        self.dest_dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dest_dir)
+        (self.dest_dir / "lib").mkdir()
+        (self.dest_dir / "bin").mkdir()
+        self.lib = self.dest_dir / "lib" / "libfoo.so"
+        _compile(self.lib, LIBFOO, "-shared", "-fPIC", "-Wl,-soname,libfoo.so")
+        self.prog = self.dest_dir / "bin" / "prog"
+
+    def compile_prog(self, *flags):
+        _compile(self.prog, PROG, f"-L{self.lib.parent}", "-lfoo", *flags)
+
+    def fix_runpath(self):
+        libraries = {}
+        visitor = functools.partial(venvjail._visit_libraries, libraries=libraries)
+        venvjail._walk_tree(self.dest_dir, [visitor])
+        files = [str(self.prog), str(self.lib)]
+        return venvjail._fix_runpath(self.dest_dir, files, libraries)
+
+
+# Without padding after the segments, like in the files already
+# extended by patchelf
+NO_SPACE = mock.patch(
+    "venvjail._append_runpath", side_effect=ValueError("no space for runpath")
+)
+
+
+class TestRunpath(ElfTestCase):
+    def test_new_runpath(self):
+        self.compile_prog()
+        self.assertNotEqual(_run(self.prog), 0)
+        with mock.patch("shutil.which", return_value=None):
+            patched, not_patched = self.fix_runpath()
+        self.assertEqual(patched, ["bin/prog ($ORIGIN/../lib)"])
+        self.assertEqual(not_patched, [])
+        self.assertIn(
+            "(RUNPATH)            Library runpath: [$ORIGIN/../lib]",
+            _readelf("-d", self.prog),
+        )
+        self.assertEqual(_run(self.prog), 0)
+
+    def test_keep_rpath(self):
+        self.compile_prog("-Wl,--disable-new-dtags,-rpath,/opt/a:/opt/b")
+        with mock.patch("shutil.which", return_value=None):
+            patched, _ = self.fix_runpath()
+        self.assertEqual(patched, ["bin/prog ($ORIGIN/../lib:/opt/a:/opt/b)"])
+        dynamic = _readelf("-d", self.prog)
+        self.assertIn("Library rpath: [$ORIGIN/../lib:/opt/a:/opt/b]", dynamic)
+        self.assertNotIn("RUNPATH", dynamic)
+        self.assertEqual(_run(self.prog), 0)
+
+    def test_in_place(self):
+        self.compile_prog("-Wl,--disable-new-dtags,-rpath,/opt/a:$ORIGIN/../lib")
+        with mock.patch("shutil.which", return_value=None):
+            patched, not_patched = self.fix_runpath()
+        self.assertEqual(patched, ["bin/prog ($ORIGIN/../lib:/opt/a)"])
+        self.assertEqual(not_patched, [])
+        dynamic = _readelf("-d", self.prog)
+        self.assertIn("Library rpath: [$ORIGIN/../lib:/opt/a]", dynamic)
+        self.assertNotIn("RUNPATH", dynamic)
+        self.assertEqual(_run(self.prog), 0)
+
+    def test_no_space(self):
+        self.compile_prog("-Wl,--enable-new-dtags,-rpath,/opt/a")
+        data = self.prog.read_bytes()
+        with mock.patch("shutil.which", return_value=None), NO_SPACE:
+            patched, not_patched = self.fix_runpath()
+        self.assertEqual(patched, [])
+        self.assertEqual(not_patched, ["bin/prog (no space for runpath)"])
+        self.assertEqual(self.prog.read_bytes(), data)
+
+    @unittest.skipUnless(shutil.which("patchelf"), "needs patchelf")
+    def test_patchelf(self):
+        self.compile_prog("-Wl,--enable-new-dtags,-rpath,/opt/a")
+        with NO_SPACE:
+            patched, _ = self.fix_runpath()
+        self.assertEqual(patched, ["bin/prog ($ORIGIN/../lib:/opt/a)"])
+        self.assertIn(
+            "Library runpath: [$ORIGIN/../lib:/opt/a]", _readelf("-d", self.prog)
+        )
+        self.assertEqual(_run(self.prog), 0)
+
+    def test_stripped_sections(self):
+        self.compile_prog("-Wl,--enable-new-dtags,-rpath,/opt/a", "-s")
+        with mock.patch("shutil.which", return_value=None):
+            patched, _ = self.fix_runpath()
+        self.assertEqual(patched, ["bin/prog ($ORIGIN/../lib:/opt/a)"])
+        self.assertIn(
+            "Library runpath: [$ORIGIN/../lib:/opt/a]", _readelf("-d", self.prog)
+        )
+        self.assertIn("NEEDED", _readelf("-d", self.prog))
+        self.assertEqual(_run(self.prog), 0)
+
+    def test_keep_ld_library_path(self):
+        self.compile_prog()
+        with mock.patch("shutil.which", return_value=None), NO_SPACE, mock.patch(
+            "venvjail._fix_activators"
+        ) as activators, mock.patch("venvjail._fix_loader") as loader:
+            log = venvjail._fix_virtualenv(
+                self.dest_dir, pathlib.Path("/opt"), [], None, runpath=True
+            )
+        self.assertEqual(len(log["Not patched runpaths"]), 1)
+        self.assertTrue(activators.call_args.args[2])
+        self.assertTrue(loader.call_args.args[3])
+
+    def test_native_loader_fallback(self):
+        self.compile_prog()
+        with mock.patch("shutil.which", return_value=None), NO_SPACE, mock.patch(
+            "venvjail._fix_activators"
+        ), mock.patch("venvjail._fix_loader") as loader, mock.patch(
+            "venvjail._fix_loader_native"
+        ) as native:
+            venvjail._fix_virtualenv(
+                self.dest_dir,
+                pathlib.Path("/opt"),
+                [],
+                "3.11",
+                None,
+                loader="native",
+                runpath=True,
+            )
+        native.assert_not_called()
+        self.assertTrue(loader.call_args.args[3])
+
+
+class TestStrip(ElfTestCase):
+    def test_strip(self):
+        self.compile_prog("-Wl,-rpath,$ORIGIN/../lib", "-Wl,--build-id")
+        notes = _readelf("-n", self.lib)
+        symbols = _readelf("--dyn-syms", self.lib)
+        size = self.lib.stat().st_size
+        stripped, not_stripped = venvjail._fix_strip(
+            self.dest_dir, [str(self.prog), str(self.lib)]
+        )
+        self.assertEqual(len(stripped), 2)
+        self.assertEqual(not_stripped, [])
+        self.assertLess(self.lib.stat().st_size, size)
+        for path in (self.prog, self.lib):
+            sections = _readelf("-S", path)
+            self.assertNotIn(".debug_", sections)
+            self.assertNotIn(".symtab", sections)
+            self.assertIn(".dynsym", sections)
+        self.assertEqual(_readelf("-n", self.lib), notes)
+        self.assertEqual(_readelf("--dyn-syms", self.lib), symbols)
+        self.assertEqual(_run(self.prog), 0)
+
+    def test_strip_and_runpath(self):
+        self.compile_prog()
+        files = [str(self.prog), str(self.lib)]
+        venvjail._fix_strip(self.dest_dir, files)
+        with mock.patch("shutil.which", return_value=None):
+            patched, _ = self.fix_runpath()
+        self.assertEqual(patched, ["bin/prog ($ORIGIN/../lib)"])
+        self.assertNotIn(".symtab", _readelf("-S", self.prog))
+        self.assertEqual(_run(self.prog), 0)
+
+    def test_not_elf(self):
+        script = self.dest_dir / "bin" / "script"
+        script.write_text("#!/bin/sh\n")
+        script.chmod(0o755)
+        self.assertEqual(venvjail._fix_strip(self.dest_dir, [str(script)]), ([], []))
+        self.assertEqual(script.read_text(), "#!/bin/sh\n")
+
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        self.dest_dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dest_dir)
+        self.addCleanup(os.chmod, self.dest_dir / "ro", 0o755)
+
+    def test_read_only_directory(self):
+        (self.dest_dir / "ro").mkdir()
+        for name in ("a", "b", "b.dedup"):
+            (self.dest_dir / "ro" / name).write_text("data")
+        (self.dest_dir / "ro").chmod(0o555)
+        self.assertEqual(venvjail._dedup(self.dest_dir), 8)
+        inodes = {path.stat().st_ino for path in (self.dest_dir / "ro").iterdir()}
+        self.assertEqual(len(inodes), 1)
+        self.assertEqual(
+            sorted(path.name for path in (self.dest_dir / "ro").iterdir()),
+            ["a", "b", "b.dedup"],
+        )
+        self.assertEqual((self.dest_dir / "ro").stat().st_mode & 0o777, 0o555)
+
+    def test_unshare(self):
+        (self.dest_dir / "ro").mkdir()
+        (self.dest_dir / "ro" / "a").write_text("data")
+        os.link(self.dest_dir / "ro" / "a", self.dest_dir / "b")
+        (self.dest_dir / "ro").chmod(0o555)
+        venvjail._unshare(str(self.dest_dir / "ro" / "a"))
+        self.assertEqual((self.dest_dir / "ro" / "a").stat().st_nlink, 1)
+        self.assertEqual((self.dest_dir / "b").stat().st_nlink, 1)
+        self.assertEqual((self.dest_dir / "ro").stat().st_mode & 0o777, 0o555)
+
+
+class TestCompile(unittest.TestCase):
+    def setUp(self):
+        self.dest_dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dest_dir)
+        self.version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        self.site_packages = self.dest_dir / f"lib/python{self.version}/site-packages"
+        (self.site_packages / "pkg").mkdir(parents=True)
+        for name in ("mod.py", "pkg/__init__.py", "pkg/sub.py"):
+            (self.site_packages / name).write_text("VALUE = 1\n")
+
+    def pycs(self):
+        return {
+            path.relative_to(self.site_packages): path.read_bytes()
+            for path in self.site_packages.glob("**/*.pyc")
+        }
+
+    def test_changed_like_full(self):
+        for mode in ("timestamp", "checked-hash"):
+            with self.subTest(mode):
+                compile = functools.partial(
+                    venvjail._compile_bytecode,
+                    self.dest_dir,
+                    pathlib.Path("/opt/venv"),
+                    self.version,
+                    mode,
+                )
+                self.assertTrue(compile())
+                full = self.pycs()
+                for path in self.site_packages.glob("**/__pycache__"):
+                    shutil.rmtree(path)
+                prefix = f"lib/python{self.version}/site-packages/"
+                changed = {prefix + "mod.py", prefix + "pkg/sub.py", "bin/script"}
+                self.assertTrue(compile(changed))
+                self.assertEqual(len(self.pycs()), 2)
+                for path, data in self.pycs().items():
+                    self.assertEqual(data, full[path])
+                self.assertIn(b"/opt/venv/lib/", full[path])
+
+    def test_error(self):
+        (self.site_packages / "mod.py").write_text("def\n")
+        prefix = f"lib/python{self.version}/site-packages/"
+        result = venvjail._compile_bytecode(
+            self.dest_dir,
+            pathlib.Path("/opt/venv"),
+            self.version,
+            "timestamp",
+            {prefix + "mod.py", prefix + "pkg/sub.py"},
+        )
+        self.assertFalse(result)
+        self.assertTrue(
+            (self.site_packages / "pkg/__pycache__").is_dir(), "sub.py not compiled"
+        )
+
+
+# Entries of a package, with the paths of the venv that are links to
+# directories, and a link replaced by a file
+ENTRIES = [
+    ("usr", 0o040755, b""),
+    ("usr/lib", 0o040755, b""),
+    ("usr/lib/module.py", 0o100644, b"VALUE = 1\n"),
+    ("lib64", 0o040755, b""),
+    ("lib64/libfoo.so", 0o100755, b"\x7fELF" + bytes(range(256)) * 40),
+    ("etc", 0o040700, b""),
+    ("etc/empty", 0o100600, b""),
+    ("etc/link", 0o120777, b"../usr/lib/module.py"),
+    ("old", 0o100644, b"file"),
+]
+
+# Payloads that can be written here
+COMPRESSORS = ("none", "gzip", "xz") + (("zstd",) if shutil.which("zstd") else ())
+
+
+def _newc(entries):
+    """Build a cpio (newc) archive of (name, mode, data, ino, nlink) entries."""
+    out = io.BytesIO()
+    for name, mode, data, ino, nlink in entries + [("TRAILER!!!", 0, b"", 0, 1)]:
+        name = name.encode() + b"\0"
+        fields = (ino, mode, 0, 0, nlink, 0, len(data), 0, 0, 0, 0, len(name), 0)
+        out.write(b"070701" + b"".join(b"%08X" % v for v in fields))
+        out.write(name + b"\0" * (-(110 + len(name)) % 4))
+        out.write(data + b"\0" * (-len(data) % 4))
+    return out.getvalue()
+
+
+def _snapshot(path):
+    """Return the content of a tree, and the groups of hard links."""
+    tree = {}
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            child = os.path.join(dirpath, name)
+            relpath = os.path.relpath(child, path)
+            st = os.lstat(child)
+            if os.path.islink(child):
+                tree[relpath] = ("link", os.readlink(child))
+            elif os.path.isdir(child):
+                tree[relpath] = ("dir", oct(st.st_mode))
+            else:
+                with open(child, "rb") as f:
+                    tree[relpath] = ("file", oct(st.st_mode), st.st_mtime, f.read())
+                inodes.setdefault(st.st_ino, []).append(relpath)
+    links = sorted(sorted(names) for names in inodes.values() if len(names) > 1)
+    return tree, links
+
+
+@unittest.skipUnless(shutil.which("tar"), "needs tar")
+class TestExtract(unittest.TestCase):
+    """Extraction of the packages, compared with GNU tar."""
+
+    def setUp(self):
+        self.workdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def venv(self, name):
+        """A directory with the links of a venv, and a link to a file."""
+        dest_dir = self.workdir / name
+        (dest_dir / "lib").mkdir(parents=True)
+        (dest_dir / "usr").mkdir()
+        (dest_dir / "usr" / "lib").symlink_to("../lib")
+        (dest_dir / "lib64").symlink_to("lib")
+        (dest_dir / "old").symlink_to("lib")
+        return dest_dir
+
+    def tar(self, data):
+        """Extract a tar archive like the old cpio, keeping the links."""
+        dest_dir = self.venv("tar")
+        subprocess.run(
+            ["tar", "-x", "--keep-directory-symlink", "-C", str(dest_dir)],
+            input=data,
+            check=True,
+        )
+        return _snapshot(dest_dir)
+
+    def test_packages(self):
+        expected = self.tar(benchmark._tar(ENTRIES, "none"))
+        tree, _ = expected
+        self.assertEqual(tree["usr/lib"], ("link", "../lib"))
+        self.assertEqual(tree["lib/module.py"][3], b"VALUE = 1\n")
+        self.assertEqual(tree["old"][0], "file")
+        for compressor in COMPRESSORS:
+            for suffix in ("rpm", "deb"):
+                with self.subTest(f"{suffix} {compressor}"):
+                    package = self.workdir / f"test-{compressor}.{suffix}"
+                    writer = getattr(benchmark, f"write_{suffix}")
+                    writer(package, "test", ENTRIES, compressor)
+                    dest_dir = self.venv(f"{suffix}-{compressor}")
+                    venvjail._extract(package, dest_dir)
+                    self.assertEqual(_snapshot(dest_dir), expected)
+
+    def test_hard_links(self):
+        data = b"data"
+        entries = [
+            ("./dir", 0o040755, b"", 1, 2),
+            # The data is only in the last link
+            ("./dir/first", 0o100644, b"", 2, 3),
+            ("./dir/second", 0o100644, b"", 2, 3),
+            ("./dir/last", 0o100644, data, 2, 3),
+            # Links without data are empty files
+            ("./dir/empty", 0o100600, b"", 3, 2),
+            ("./dir/empty2", 0o100600, b"", 3, 2),
+        ]
+        dest_dir = self.venv("cpio")
+        venvjail._write_entries(
+            dest_dir, venvjail._read_cpio(io.BytesIO(_newc(entries)))
+        )
+
+        # In tar the data is in the first link
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode="w") as tar:
+            for name, mode, content, _, _ in [entries[i] for i in (0, 3, 1, 2, 4, 5)]:
+                info = tarfile.TarInfo(name)
+                info.mode, info.mtime = mode & 0o7777, 0
+                if mode & 0o040000:
+                    info.type = tarfile.DIRTYPE
+                elif name in ("./dir/first", "./dir/second"):
+                    info.type, info.linkname = tarfile.LNKTYPE, "./dir/last"
+                elif name == "./dir/empty2":
+                    info.type, info.linkname = tarfile.LNKTYPE, "./dir/empty"
+                else:
+                    info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        expected = self.tar(out.getvalue())
+        self.assertEqual(
+            expected[1],
+            [["dir/empty", "dir/empty2"], ["dir/first", "dir/last", "dir/second"]],
+        )
+        self.assertEqual(_snapshot(dest_dir), expected)
+
+        # The same archive, from a Debian package
+        dest_dir = self.venv("deb")
+        out.seek(0)
+        venvjail._write_entries(dest_dir, venvjail._read_tar(out))
+        self.assertEqual(_snapshot(dest_dir), expected)
+
+    def test_truncated(self):
+        for compressor in COMPRESSORS:
+            for suffix in ("rpm", "deb"):
+                package = self.workdir / f"test.{suffix}"
+                writer = getattr(benchmark, f"write_{suffix}")
+                writer(package, "test", ENTRIES, compressor)
+                data = package.read_bytes()
+                # In the payload, and at the end of the compressed stream
+                sizes = [len(data) // 2, len(data) - 16]
+                if compressor == "none":
+                    # In the data of a file
+                    sizes.append(data.index(b"\x7fELF") + 100)
+                for size in sizes:
+                    with self.subTest(f"{suffix} {compressor} {size}"):
+                        package.write_bytes(data[:size])
+                        dest_dir = self.venv(f"{suffix}-{compressor}-{size}")
+                        with self.assertRaises(Exception) as cm:
+                            venvjail._extract(package, dest_dir)
+                        if size == sizes[-1] and compressor == "none":
+                            self.assertEqual(
+                                str(cm.exception), "Unexpected end of stream"
+                            )
+
+    def test_corrupted(self):
+        entries = [("./file", 0o100644, b"data", 1, 1)]
+        payload = bytearray(_newc(entries))
+        with self.assertRaisesRegex(ValueError, "Unexpected end of stream"):
+            list(venvjail._read_cpio(io.BytesIO(payload[:-130])))
+        payload[0] = ord("X")
+        with self.assertRaisesRegex(ValueError, "Bad cpio header"):
+            list(venvjail._read_cpio(io.BytesIO(payload)))
+
+
+# Patterns of a remove list, with the paths where they are checked
+PATTERNS = [
+    r"usr/share/doc/.*",
+    r"usr/share/man",
+    r"^lib/python3\.11/site-packages/.*\.pyc",
+    r"lib/python3\.\d+/test/.*",
+    r"etc/[a-c]rontab",
+    r"bin/python3\.?1*",
+    r"bin/pip+",
+    r"(?i)share/LOCALE/.*",
+    r"share/(?i:info)",
+    r"(?:include|src)/.*",
+    r"docs?/|README",
+    r"(man|info)/\1",
+    r"(?P<dir>etc)/(?P=dir)",
+    r"a\\b",
+    r"x{2}y",
+    r"xy{2}",
+    r"lib64\/.*",
+]
+PATHS = [
+    "usr/share/doc",
+    "usr/share/doc/python3/README",
+    "usr/share/man",
+    "usr/share/manual",
+    "lib/python3.11/site-packages/foo.pyc",
+    "lib/python3.11/site-packages/foo.py",
+    "lib/python3x11/site-packages/foo.pyc",
+    "lib/python3.12/test/test_os.py",
+    "lib/python3.x/test/test_os.py",
+    "etc/crontab",
+    "etc/drontab",
+    "etc/etc",
+    "bin/python3",
+    "bin/python311",
+    "bin/python3.11",
+    "bin/pi",
+    "bin/pippp",
+    "share/locale/de",
+    "SHARE/Locale/de",
+    "share/INFO",
+    "SHARE/info",
+    "include/Python.h",
+    "src/",
+    "doc/",
+    "docs/index",
+    "README",
+    "man/man",
+    "man/info",
+    "a\\b",
+    "ab",
+    "xxy",
+    "xyy",
+    "xy",
+    "lib64/libfoo.so",
+    "",
+]
+
+
+class TestFileList(unittest.TestCase):
+    def filelist(self, patterns):
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("# Comment\n\n" + "\n".join(patterns) + "\n")
+            f.flush()
+            return venvjail.FileList(f.name)
+
+    def test_like_re_match(self):
+        filelist = self.filelist(PATTERNS)
+        self.assertTrue(filelist._prefixes)
+        self.assertTrue(filelist._others)
+        for path in PATHS:
+            with self.subTest(path):
+                expected = any(re.match(pattern, path) for pattern in PATTERNS)
+                self.assertEqual(path in filelist, expected)
+                # The cached result
+                self.assertEqual(path in filelist, expected)
+
+    def test_single_pattern(self):
+        for pattern in PATTERNS:
+            filelist = self.filelist([pattern])
+            for path in PATHS:
+                with self.subTest(pattern=pattern, path=path):
+                    expected = bool(re.match(pattern, path))
+                    self.assertEqual(path in filelist, expected)
+
+    def test_literal_prefix(self):
+        for pattern, prefix in (
+            (r"^usr/share/doc/.*", "usr/share/doc/"),
+            (r"lib/python3\.11/", "lib/python3.11/"),
+            (r"bin/python3\.?", "bin/python3"),
+            (r"bin/pip+", "bin/pip"),
+            (r"lib\d", "lib"),
+            (r"(?i)share", ""),
+            (r"docs?/|README", ""),
+            (r"[a-c]rontab", ""),
+        ):
+            with self.subTest(pattern):
+                self.assertEqual(venvjail._literal_prefix(pattern), prefix)
+
+
+class _ApiHandler(http.server.BaseHTTPRequestHandler):
+    """OBS API that returns a document per path, with an ETag."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        body = server.documents[self.path].encode()
+        etag = f'"{len(server.requests)}-{hash(body)}"'
+        if self.headers.get("If-None-Match", "") == server.etags.get(self.path):
+            self.send_response(304)
+            self.end_headers()
+            return
+        server.etags[self.path] = etag
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestApiCache(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ApiHandler)
+        self.server.requests = []
+        self.server.etags = {}
+        self.server.documents = {f"/source/p/{n}": f"<{n}/>" for n in "abc"}
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        cache_dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.args = argparse.Namespace(
+            apiurl=f"http://127.0.0.1:{self.server.server_port}/",
+            api_cache_dir=cache_dir / "api",
+            ttl=3600,
+            offline=False,
+            transport="http",
+            jobs=4,
+        )
+
+    def test_cache(self):
+        apis = ["/source/p/a", "/source/p/b", "/source/p/c"]
+        self.assertEqual(
+            venvjail._osc_api_map(self.args, apis), [b"<a/>", b"<b/>", b"<c/>"]
+        )
+        self.assertEqual(sorted(path for path, _ in self.server.requests), apis)
+        for _, headers in self.server.requests:
+            self.assertNotIn("If-None-Match", headers)
+
+        # The valid responses are taken from the cache
+        self.assertEqual(venvjail._osc_api(self.args, apis[0]), b"<a/>")
+        self.assertEqual(len(self.server.requests), 3)
+
+        # The expired responses are validated, and not modified
+        cache_file = venvjail._api_cache_file(self.args, apis[0])
+        os.utime(cache_file, (0, 0))
+        self.assertEqual(venvjail._osc_api(self.args, apis[0]), b"<a/>")
+        path, headers = self.server.requests[-1]
+        self.assertEqual(path, apis[0])
+        self.assertEqual(headers["If-None-Match"], self.server.etags[apis[0]])
+        self.assertEqual(headers["If-Modified-Since"], "Thu, 01 Jan 1970 00:00:00 GMT")
+        self.assertGreater(cache_file.stat().st_mtime, 0)
+        self.assertEqual(venvjail._osc_api(self.args, apis[0]), b"<a/>")
+        self.assertEqual(len(self.server.requests), 4)
+
+        # Or fetched again if modified
+        self.server.documents[apis[1]] = "<modified/>"
+        self.server.etags[apis[1]] = None
+        self.args.ttl = 0
+        self.assertEqual(venvjail._osc_api(self.args, apis[1]), b"<modified/>")
+        self.assertEqual(len(self.server.requests), 5)
+        self.args.ttl = 3600
+        self.assertEqual(venvjail._osc_api(self.args, apis[1]), b"<modified/>")
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_offline(self):
+        self.args.offline = True
+        with self.assertRaisesRegex(ValueError, "offline mode"):
+            venvjail._osc_api(self.args, "/source/p/a")
+        self.args.offline = False
+        venvjail._osc_api(self.args, "/source/p/a")
+        self.args.offline = True
+        self.args.ttl = 0
+        self.assertEqual(venvjail._osc_api(self.args, "/source/p/a"), b"<a/>")
+        self.assertEqual(len(self.server.requests), 1)
+
+
+def _rpm(name, provides=(), requires=(), files=()):
+    """Header of a RPM package, with the tags used by the resolver."""
+    dirnames = sorted({os.path.dirname(path) + "/" for path in files})
+    return {
+        venvjail.RPMTAG_NAME: name,
+        venvjail.RPMTAG_PROVIDENAME: [name, *provides],
+        venvjail.RPMTAG_REQUIRENAME: list(requires),
+        venvjail.RPMTAG_DIRNAMES: dirnames,
+        venvjail.RPMTAG_BASENAMES: [os.path.basename(path) for path in files],
+        venvjail.RPMTAG_DIRINDEXES: [
+            dirnames.index(os.path.dirname(path) + "/") for path in files
+        ],
+    }
+
+
+class TestResolve(unittest.TestCase):
+    HEADERS = {
+        "app-1.0-1.1.noarch.rpm": _rpm(
+            "app", requires=["python3-lib", "/usr/bin/sh", "rpmlib(X)", "cycle-a"]
+        ),
+        "python3-lib-2.0-1.1.noarch.rpm": _rpm(
+            "python3-lib", provides=["python3dist(lib)"], requires=["libfoo.so.1"]
+        ),
+        # Two providers, the one with the same name is preferred
+        "foo-1.0-1.1.x86_64.rpm": _rpm("foo", provides=["libfoo.so.1"]),
+        "libfoo1-1.0-1.1.x86_64.rpm": _rpm("libfoo1", provides=["libfoo.so.1"]),
+        "bash-5.0-1.1.x86_64.rpm": _rpm("bash", files=["/usr/bin/bash", "/usr/bin/sh"]),
+        "cycle-a-1.0-1.1.noarch.rpm": _rpm("cycle-a", requires=["cycle-b"]),
+        "cycle-b-1.0-1.1.noarch.rpm": _rpm("cycle-b", requires=["cycle-a", "missing"]),
+        "unused-1.0-1.1.noarch.rpm": _rpm("unused"),
+        # Debian packages, with versions and alternatives
+        "tool_1.0-1_all.deb": {
+            "Package": "tool",
+            "Depends": "python3-lib (>= 2.0), gone | libbar:any (<< 3)",
+            "Pre-Depends": "dpkg (>= 1.19)",
+        },
+        "libbar_1.0-1_amd64.deb": {"Package": "libbar", "Provides": "bar"},
+    }
+
+    def resolve(self, roots, exclude=()):
+        packages = [pathlib.Path("repo", name) for name in self.HEADERS]
+        closure, unresolved = venvjail._resolve(
+            packages, self.HEADERS, roots, set(exclude)
+        )
+        return sorted(package.name for package in closure), sorted(unresolved)
+
+    def test_closure(self):
+        closure, unresolved = self.resolve(["app"])
+        self.assertEqual(
+            closure,
+            [
+                "app-1.0-1.1.noarch.rpm",
+                "bash-5.0-1.1.x86_64.rpm",
+                "cycle-a-1.0-1.1.noarch.rpm",
+                "cycle-b-1.0-1.1.noarch.rpm",
+                "foo-1.0-1.1.x86_64.rpm",
+                "python3-lib-2.0-1.1.noarch.rpm",
+            ],
+        )
+        self.assertEqual(unresolved, ["missing (required by cycle-b)"])
+
+    def test_provides(self):
+        closure, _ = self.resolve(["python3dist(lib)"])
+        self.assertEqual(
+            closure, ["foo-1.0-1.1.x86_64.rpm", "python3-lib-2.0-1.1.noarch.rpm"]
+        )
+
+    def test_excluded(self):
+        # The excluded packages are installed outside the venv
+        excluded = ["bash-5.0-1.1.x86_64.rpm", "cycle-a-1.0-1.1.noarch.rpm"]
+        closure, unresolved = self.resolve(["app"], excluded)
+        self.assertEqual(
+            closure,
+            [
+                "app-1.0-1.1.noarch.rpm",
+                "foo-1.0-1.1.x86_64.rpm",
+                "python3-lib-2.0-1.1.noarch.rpm",
+            ],
+        )
+        self.assertEqual(unresolved, [])
+        with self.assertRaisesRegex(ValueError, "root package bash is excluded"):
+            self.resolve(["bash"], excluded)
+
+    def test_versions(self):
+        # The versions of the requirements are not checked, and the
+        # architecture qualifiers are dropped
+        closure, unresolved = self.resolve(["tool"])
+        self.assertEqual(
+            closure,
+            [
+                "foo-1.0-1.1.x86_64.rpm",
+                "libbar_1.0-1_amd64.deb",
+                "python3-lib-2.0-1.1.noarch.rpm",
+                "tool_1.0-1_all.deb",
+            ],
+        )
+        self.assertEqual(unresolved, ["dpkg (required by tool)"])
+
+    def test_not_found(self):
+        with self.assertRaisesRegex(ValueError, "root package missing not found"):
+            self.resolve(["missing"])
+
+    def test_index(self):
+        workdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, workdir)
+        repo = workdir / "repo"
+        repo.mkdir()
+        for name, requires in (("app", ["lib"]), ("lib", []), ("other", [])):
+            benchmark.write_rpm(
+                repo / f"{name}-1.0-1.1.noarch.rpm",
+                name,
+                [("usr", 0o040755, b"")],
+                requires=requires,
+            )
+        packages = sorted(repo.glob("*.rpm"))
+        index = venvjail.RepoIndex(workdir / "index.db")
+        self.addCleanup(index.close)
+        self.assertEqual(index.update(packages), (3, 0, []))
+        self.assertEqual(index.update(packages), (0, 0, []))
+        closure, unresolved = venvjail._resolve(
+            packages, index.headers(), ["app"], set()
+        )
+        self.assertEqual(
+            sorted(package.name for package in closure),
+            ["app-1.0-1.1.noarch.rpm", "lib-1.0-1.1.noarch.rpm"],
+        )
+        self.assertEqual(unresolved, [])
+
+        # A removed package is forgotten
+        packages[-1].unlink()
+        self.assertEqual(index.update(packages[:-1]), (0, 1, []))
+        self.assertEqual(
+            sorted(index.headers()),
+            ["app-1.0-1.1.noarch.rpm", "lib-1.0-1.1.noarch.rpm"],
+        )
+
+
+class TestImportIndex(unittest.TestCase):
+    def setUp(self):
+        self.dest_dir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dest_dir)
+        version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        self.site_packages = self.dest_dir / f"lib/python{version}/site-packages"
+        (self.site_packages / "pkg").mkdir(parents=True)
+        (self.site_packages / "pkg/__init__.py").write_text("")
+        (self.site_packages / "ns").mkdir()
+        (self.site_packages / "ns/sub.py").write_text("")
+        (self.site_packages / "mod.py").write_text("")
+        (self.site_packages / "mod.pth").write_text("")
+        (self.dest_dir / "lib64").symlink_to("lib")
+        index = venvjail._write_import_index(self.dest_dir, version)
+
+        # The finder, without installing it
+        finder = {}
+        exec(venvjail.IMPORT_FINDER.replace("\n_install()\n", "\n"), finder)
+        self.mtime = index.stat().st_mtime_ns
+        with index.open("rb") as f:
+            self.index = {
+                str(self.dest_dir / path): modules
+                for paths, modules in marshal.load(f)
+                for path in paths
+            }
+        self.finder = finder["IndexFinder"](self.mtime, self.index)
+        self.other = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.other)
+        (self.other / "other.py").write_text("")
+        path = [str(self.other), str(self.site_packages)]
+        patcher = mock.patch("sys.path", path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_index(self):
+        relpath = self.site_packages.relative_to(self.dest_dir / "lib")
+        self.assertEqual(
+            sorted(self.index),
+            [str(self.dest_dir / lib / relpath) for lib in ("lib", "lib64")],
+        )
+        modules = self.index[str(self.site_packages)]
+        self.assertEqual(modules["mod"], (False, (), ("mod.pth", "mod.py")))
+        self.assertEqual(modules["pkg"], (True, ("__init__.py",), ()))
+
+    def test_lookups(self):
+        spec = self.finder.find_spec("mod")
+        self.assertEqual(spec.origin, str(self.site_packages / "mod.py"))
+        self.assertIsNone(spec.submodule_search_locations)
+        spec = self.finder.find_spec("pkg")
+        self.assertEqual(spec.origin, str(self.site_packages / "pkg/__init__.py"))
+        self.assertEqual(
+            spec.submodule_search_locations, [str(self.site_packages / "pkg")]
+        )
+        # The namespace packages and the submodules are found as usual
+        self.assertIsNone(self.finder.find_spec("ns"))
+        self.assertIsNone(self.finder.find_spec("sub", [str(self.site_packages)]))
+        self.assertIsNone(self.finder.find_spec("missing"))
+        # The entries of sys.path that are not indexed are listed
+        spec = self.finder.find_spec("other")
+        self.assertEqual(spec.origin, str(self.other / "other.py"))
+
+    def test_fallback(self):
+        # A module added after the index is found with the normal
+        # lookup, as the directory is newer
+        (self.site_packages / "new.py").write_text("")
+        os.utime(self.site_packages, ns=(self.mtime + 10**9, self.mtime + 10**9))
+        self.finder.invalidate_caches()
+        spec = self.finder.find_spec("new")
+        self.assertEqual(spec.origin, str(self.site_packages / "new.py"))
+        self.assertEqual(
+            self.finder.find_spec("mod").origin, str(self.site_packages / "mod.py")
+        )
+
+    def test_not_modified(self):
+        # The directories not modified after the index are not read
+        (self.site_packages / "new.py").write_text("")
+        os.utime(self.site_packages, ns=(self.mtime, self.mtime))
+        self.assertIsNone(self.finder.find_spec("new"))
+
+
+class TestLinkGraph(unittest.TestCase):
+    def test_update(self):
+        graph = venvjail._LinkGraph("/nonexistent", {"a": "b", "c": "a/x"})
+        self.assertEqual(graph.resolve("c"), ("b/x", False))
+        graph.update("b", "../d")
+        self.assertEqual(graph.resolve("c"), ("d/x", True))
+        graph.update("a", "e")
+        self.assertEqual(graph.resolve("c"), ("e/x", False))
+
+    def test_loop(self):
+        graph = venvjail._LinkGraph("/nonexistent", {"a": "b", "b": "a"})
+        with self.assertRaises(ValueError):
+            graph.resolve("a")
+
+
+# Links of a package, like installed in /usr, and the expected target
+LINKS = {
+    # An alternative
+    "usr/bin/tool": ("/etc/alternatives/tool", "tool-3.11"),
+    # A relative link to an alternative, fixed after it
+    "alt/tool": ("../bin/tool", "../bin/tool"),
+    # An absolute link to the venv
+    "usr/share/data/abs": ("/usr/lib/data/file", "../../../lib/data/file"),
+    # Relative links from the original place, inside and outside of
+    # the venv
+    "usr/lib/data/chain": ("../data/link", "../data/link"),
+    "usr/lib/data/link": ("../../share/data/file", "../../usr/share/data/file"),
+    "usr/lib/data/system": ("../../share/zoneinfo/UTC", "/usr/share/zoneinfo/UTC"),
+    # A relative link that cannot be resolved
+    "etc/data/dangling": ("../missing", "../missing"),
+}
+
+
+def _venvjail(*arguments, check=True):
+    """Run a command of venvjail, and return the output."""
+    result = subprocess.run(
+        [sys.executable, venvjail.__file__, *map(str, arguments)],
+        check=check,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return result.stdout if check else result
+
+
+def _create(workdir, packages, remove="", *options):
+    """Create the venv `venv` from a repository of RPM packages.
+
+    `packages` is a dict with the entries of every package.  Return
+    the output of the command.
+
+    """
+    repo = workdir / "repo"
+    repo.mkdir(exist_ok=True)
+    for name, entries in packages.items():
+        benchmark.write_rpm(repo / f"{name}-1.0-1.1.noarch.rpm", name, entries)
+    (workdir / "include-rpm").write_text("".join(f"{name}\n" for name in packages))
+    (workdir / "exclude-rpm").write_text("")
+    (workdir / "remove-file").write_text(remove)
+    return _venvjail(
+        "create",
+        workdir / "venv",
+        "--repo",
+        repo,
+        "--include",
+        workdir / "include-rpm",
+        "--exclude",
+        workdir / "exclude-rpm",
+        "--remove",
+        workdir / "remove-file",
+        "--python-version",
+        "3.11",
+        *options,
+    )
+
+
+def _log(dest_dir, title):
+    """Return the entries of a section of packages.log."""
+    log = (dest_dir / "packages.log").read_text()
+    section = log.split(f"# {title}\n", 1)[1]
+    return section.split("\n\n", 1)[0].split()
+
+
+class TestLinks(unittest.TestCase):
+    def setUp(self):
+        self.workdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.workdir)
+        entries = [
+            (directory, 0o040755, b"")
+            for directory in (
+                "etc",
+                "etc/data",
+                "alt",
+                "usr",
+                "usr/bin",
+                "usr/lib",
+                "usr/lib/data",
+                "usr/share",
+                "usr/share/data",
+            )
+        ]
+        entries += [
+            ("usr/bin/tool-3.11", 0o100755, b"#!/bin/sh\n"),
+            ("usr/lib/data/file", 0o100644, b"data"),
+            ("usr/share/data/file", 0o100644, b"data"),
+        ]
+        entries += [
+            (name, 0o120777, target.encode()) for name, (target, _) in LINKS.items()
+        ]
+        _create(self.workdir, {"links": entries})
+        self.dest_dir = self.workdir / "venv"
+
+    def test_targets(self):
+        for name, (_, expected) in LINKS.items():
+            relpath = (
+                name[len("usr/") :] if name.startswith(("usr/bin", "usr/lib")) else name
+            )
+            with self.subTest(relpath):
+                self.assertEqual(os.readlink(self.dest_dir / relpath), expected)
+        self.assertEqual((self.dest_dir / "alt" / "tool").read_text(), "#!/bin/sh\n")
+        self.assertEqual((self.dest_dir / "lib" / "data" / "chain").read_text(), "data")
+
+    def test_log(self):
+        fixed = _log(self.dest_dir, "Fixed links")
+        self.assertEqual(
+            fixed,
+            [
+                "bin/tool",
+                "->",
+                "tool-3.11",
+                "lib/data/link",
+                "->",
+                "../../usr/share/data/file",
+                "lib/data/system",
+                "->",
+                "/usr/share/zoneinfo/UTC",
+                "usr/share/data/abs",
+                "->",
+                "../../../lib/data/file",
+            ],
+        )
+        self.assertEqual(
+            _log(self.dest_dir, "Unresolved links"),
+            ["etc/data/dangling", "->", "../missing"],
+        )
+
+
+class TestRemove(unittest.TestCase):
+    """The remove list, applied while the packages are extracted."""
+
+    ENTRIES = [
+        ("usr", 0o040755, b""),
+        ("usr/lib", 0o040755, b""),
+        ("usr/share", 0o040755, b""),
+        ("usr/lib/data-1.0", 0o040755, b""),
+        ("usr/lib/data-1.0/file", 0o100644, b"data"),
+        # A removed link to a directory, that is followed by the
+        # entries below it
+        ("usr/lib/data", 0o120777, b"data-1.0"),
+        ("usr/lib/data/extra", 0o100644, b"extra"),
+        # A removed directory, listed without the content
+        ("usr/share/doc", 0o040755, b""),
+        ("usr/share/doc/pkg", 0o040755, b""),
+        ("usr/share/doc/pkg/README", 0o100644, b"readme"),
+        ("usr/share/doc/pkg/link", 0o120777, b"README"),
+    ]
+
+    def setUp(self):
+        self.workdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def test_removed_files(self):
+        for options in ((), ("--jobs", "2"), ("--cache-dir", "cache")):
+            with self.subTest(options):
+                if options:
+                    shutil.rmtree(self.workdir / "venv")
+                options = [
+                    str(self.workdir / o) if o == "cache" else o for o in options
+                ]
+                dest_dir = self.workdir / "venv"
+                _create(
+                    self.workdir,
+                    {"remove": self.ENTRIES},
+                    "lib/data$\nusr/share/doc$\n",
+                    *options,
+                )
+                self.assertEqual(
+                    _log(dest_dir, "Removed files"),
+                    [str(dest_dir / "lib/data"), str(dest_dir / "usr/share/doc")],
+                )
+                self.assertFalse(os.path.lexists(dest_dir / "lib/data"))
+                self.assertFalse(os.path.lexists(dest_dir / "usr/share/doc"))
+                self.assertEqual(
+                    sorted(os.listdir(dest_dir / "lib/data-1.0")), ["extra", "file"]
+                )
+
+
+# Packages of a venv, with Python modules, a script and links
+PACKAGES = {
+    "python3-app": [
+        ("usr", 0o040755, b""),
+        ("usr/bin", 0o040755, b""),
+        ("usr/bin/app", 0o100755, b"#!/usr/bin/python3.11\nimport app\n"),
+        ("usr/lib", 0o040755, b""),
+        ("usr/lib/python3.11", 0o040755, b""),
+        ("usr/lib/python3.11/site-packages", 0o040755, b""),
+        ("usr/lib/python3.11/site-packages/app", 0o040755, b""),
+        ("usr/lib/python3.11/site-packages/app/__init__.py", 0o100644, b"A = 1\n"),
+        ("usr/lib/python3.11/site-packages/app/data.txt", 0o100644, b"data\n"),
+    ],
+    "python3-lib": [
+        ("usr", 0o040755, b""),
+        ("usr/lib", 0o040755, b""),
+        ("usr/lib/python3.11", 0o040755, b""),
+        ("usr/lib/python3.11/site-packages", 0o040755, b""),
+        ("usr/lib/python3.11/site-packages/lib.py", 0o100644, b"L = 1\n"),
+        ("usr/lib/python3.11/site-packages/lib-link.py", 0o120777, b"lib.py"),
+    ],
+}
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.workdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.manifest = self.workdir / "manifest"
+        _create(self.workdir, PACKAGES, "", "--manifest", self.manifest)
+        self.dest_dir = self.workdir / "venv"
+
+    def verify(self, *options):
+        return _venvjail("verify", self.dest_dir, self.manifest, *options, check=False)
+
+    def test_verify(self):
+        result = self.verify()
+        self.assertEqual(result.returncode, 0)
+        self.assertRegex(result.stdout, r"Verified \d+ files, 0 with problems")
+
+    def test_problems(self):
+        site_packages = self.dest_dir / "lib/python3.11/site-packages"
+        (site_packages / "app/__init__.py").write_text("A = 2\n")
+        (site_packages / "app/data.txt").write_text("more data\n")
+        (site_packages / "lib.py").chmod(0o600)
+        (site_packages / "lib-link.py").unlink()
+        (site_packages / "lib-link.py").symlink_to("app")
+        (site_packages / "extra.py").write_text("")
+        (self.dest_dir / "bin/app").unlink()
+        result = self.verify()
+        self.assertEqual(result.returncode, 1)
+        lines = result.stdout.splitlines()
+        self.assertEqual(
+            sorted(lines[:-1]),
+            [
+                "bin/app: missing",
+                "lib/python3.11/site-packages/app/__init__.py: sha256",
+                "lib/python3.11/site-packages/app/data.txt: size",
+                "lib/python3.11/site-packages/extra.py: unexpected",
+                "lib/python3.11/site-packages/lib-link.py: target",
+                "lib/python3.11/site-packages/lib.py: mode",
+            ],
+        )
+        self.assertRegex(lines[-1], r"Verified \d+ files, 6 with problems")
+
+    def test_fast(self):
+        # The files with the same size and time are not read
+        module = self.dest_dir / "lib/python3.11/site-packages/app/__init__.py"
+        st = module.stat()
+        module.write_text("A = 2\n")
+        os.utime(module, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(self.verify("--fast").returncode, 0)
+        self.assertEqual(self.verify().returncode, 1)
+
+
+class TestUpdate(unittest.TestCase):
+    def setUp(self):
+        self.workdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.manifest = self.workdir / "manifest"
+        _create(self.workdir, PACKAGES, "", "--manifest", self.manifest)
+        self.site_packages = self.workdir / "venv/lib/python3.11/site-packages"
+
+    def update(self, packages, *options):
+        return _create(
+            self.workdir,
+            packages,
+            "",
+            "--manifest",
+            self.manifest,
+            "--update",
+            "--check-update",
+            *options,
+        )
+
+    def test_like_clean_build(self):
+        # A changed package, a removed one and a new one
+        packages = {
+            "python3-app": [
+                (name, mode, b"A = 2\n" if name.endswith("__init__.py") else data)
+                for name, mode, data in PACKAGES["python3-app"]
+                if not name.endswith("data.txt")
+            ],
+            "python3-new": [
+                ("usr", 0o040755, b""),
+                ("usr/lib", 0o040755, b""),
+                ("usr/lib/python3.11", 0o040755, b""),
+                ("usr/lib/python3.11/site-packages", 0o040755, b""),
+                ("usr/lib/python3.11/site-packages/new.py", 0o100644, b"N = 1\n"),
+            ],
+        }
+        (self.workdir / "repo/python3-lib-1.0-1.1.noarch.rpm").unlink()
+        output = self.update(packages)
+        self.assertNotIn("Creating the venv again", output)
+        self.assertIn("The venv is identical to a clean build", output)
+        self.assertEqual(
+            (self.site_packages / "app/__init__.py").read_text(), "A = 2\n"
+        )
+        self.assertTrue((self.site_packages / "new.py").exists())
+        for name in ("app/data.txt", "lib.py", "lib-link.py"):
+            self.assertFalse(os.path.lexists(self.site_packages / name), name)
+        result = _venvjail("verify", self.workdir / "venv", self.manifest, check=False)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_option_changed(self):
+        output = self.update(PACKAGES, "--strip")
+        self.assertIn("Creating the venv again, the options strip changed", output)
+        self.assertIn("The venv is identical to a clean build", output)
+        # The remove list is part of the options
+        output = self.update(PACKAGES, "--strip", "--remove", os.devnull)
+        self.assertNotIn("Creating the venv again", output)
+        (self.workdir / "remove").write_text("lib/python3.11/site-packages/lib.py\n")
+        output = self.update(PACKAGES, "--strip", "--remove", self.workdir / "remove")
+        self.assertIn("Creating the venv again, the options remove changed", output)
+        self.assertFalse((self.site_packages / "lib.py").exists())
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.workdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def create(self, archive, *options):
+        if (self.workdir / "venv").exists():
+            shutil.rmtree(self.workdir / "venv")
+        _create(
+            self.workdir,
+            PACKAGES,
+            "",
+            "--output-archive",
+            archive,
+            "--archive-mtime",
+            "0",
+            "--archive-owner",
+            *options,
+        )
+
+    def test_reproducible(self):
+        for suffix in (".tar.gz", ".tar.xz"):
+            with self.subTest(suffix):
+                first = self.workdir / f"first{suffix}"
+                second = self.workdir / f"second{suffix}"
+                self.create(first, "--archive-sort")
+                self.create(second, "--archive-sort")
+                self.assertEqual(first.read_bytes(), second.read_bytes())
+
+                with tarfile.open(first) as tar:
+                    members = tar.getmembers()
+                names = [member.name for member in members]
+                self.assertEqual(names[0], "venv")
+                self.assertEqual(names, sorted(names))
+                self.assertIn("venv/lib/python3.11/site-packages/lib.py", names)
+                for member in members:
+                    self.assertEqual(member.mtime, 0)
+                    self.assertEqual((member.uid, member.gid), (0, 0))
+                    self.assertEqual((member.uname, member.gname), ("root", "root"))
+
+    def test_manifest(self):
+        # The entries are taken from the manifest, sorted
+        archive = self.workdir / "venv.tar.gz"
+        self.create(archive, "--manifest", self.workdir / "manifest")
+        with tarfile.open(archive) as tar:
+            names = tar.getnames()
+        self.assertEqual(names, sorted(names))
+        self.assertIn("venv/packages.log", names)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,18 +19,44 @@
 # and Python RPMs.  Used to jail OpenStack services.
 
 import argparse
+import bz2
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import email.utils
+import fcntl
 import fnmatch
+import functools
+import gzip
+import hashlib
 import itertools
+import json
+import lzma
+import marshal
 import os
 import os.path
 import pathlib
 import re
 import shutil
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
 import xml.etree.ElementTree as ET
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Sane default for exclude-rpm file
 EXCLUDE_RPM = r"""# List of packages to ignore (use Python regex)
 
@@ -59,6 +85,87 @@ python3.*
 rpmlint.*
 """
 
+# RPM header tags used by venvjail
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILELINKTOS = 1036
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIRENAME = 1049
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_DISTURL = 1123
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_LONGFILESIZES = 5008
+
+# Layout of the RPM packages: the lead, and the signature and main
+# headers, with the types of the values of the tags
+RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+RPM_LEAD_SIZE = 96
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+RPM_INT8_TYPE = 2
+RPM_INT16_TYPE = 3
+RPM_INT32_TYPE = 4
+RPM_INT64_TYPE = 5
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+# Headers of the cpio "newc" (and "crc") and ar archives
+CPIO_MAGIC = (b"070701", b"070702")
+CPIO_HEADER_SIZE = 110
+AR_MAGIC = b"!<arch>\n"
+
+# Tags of the RPM headers stored in the repository index
+INDEX_TAGS = (
+    RPMTAG_NAME,
+    RPMTAG_VERSION,
+    RPMTAG_RELEASE,
+    RPMTAG_EPOCH,
+    RPMTAG_ARCH,
+    RPMTAG_PROVIDENAME,
+    RPMTAG_REQUIRENAME,
+    RPMTAG_DIRINDEXES,
+    RPMTAG_BASENAMES,
+    RPMTAG_DIRNAMES,
+    RPMTAG_DISTURL,
+    RPMTAG_PAYLOADFORMAT,
+    RPMTAG_PAYLOADCOMPRESSOR,
+)
+
+# ioctl to clone (reflink) the content of a file
+FICLONE = 0x40049409
+
+# Links of the venv that merge /usr
+VENV_LINKS = {"usr/bin": "../bin", "usr/lib": "../lib", "usr/lib64": "../lib"}
+
+# Tags of the dynamic section, and types of the headers, of ELF files
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+PT_LOAD = 1
+PT_DYNAMIC = 2
+ET_EXEC = 2
+ET_DYN = 3
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHF_ALLOC = 0x2
+SHF_INFO_LINK = 0x40
+
 LICENSE = f"""# Copyright (c) {datetime.datetime.today().year} SUSE LLC.
 #
 # All modifications and additions to the file contributed by third parties
@@ -71,6 +178,163 @@ LICENSE = f"""# Copyright (c) {datetime.datetime.today().year} SUSE LLC.
 # published by the Open Source Initiative.
 """
 
+IMPORT_INDEX = "_venvjail_index.marshal"
+
+# Module installed in the venv to resolve the imports from the index
+IMPORT_FINDER = '''"""Find the top level modules of the venv from an index."""
+
+import marshal
+import os
+import sys
+from importlib.machinery import (
+    BYTECODE_SUFFIXES,
+    EXTENSION_SUFFIXES,
+    SOURCE_SUFFIXES,
+    ExtensionFileLoader,
+    PathFinder,
+    SourceFileLoader,
+    SourcelessFileLoader,
+)
+from importlib.util import spec_from_file_location
+
+# Same order than the FileFinder
+LOADERS = (
+    [(suffix, ExtensionFileLoader) for suffix in EXTENSION_SUFFIXES]
+    + [(suffix, SourceFileLoader) for suffix in SOURCE_SUFFIXES]
+    + [(suffix, SourcelessFileLoader) for suffix in BYTECODE_SUFFIXES]
+)
+
+
+def _find(name, entry):
+    """Find a module in one entry of sys.path, as usual."""
+    spec = PathFinder.find_spec(name, [entry])
+    if spec is None:
+        return None, False
+    # Namespace packages are found by the normal lookup
+    return (spec if spec.loader else None), True
+
+
+class IndexFinder:
+    """Meta path finder that reads the directories from an index.
+
+    The directories of the index are used if they are not modified
+    after the index.  The rest of the directories of sys.path are
+    listed once, and the modules found there are searched as usual.
+
+    """
+
+    def __init__(self, mtime, index):
+        self._mtime = mtime
+        self._index = index
+        self._listings = {}
+
+    def _listing(self, entry):
+        """Return the modules of an entry of sys.path, and if indexed."""
+        if entry in self._listings:
+            return self._listings[entry]
+        listing, indexed = None, False
+        try:
+            mtime = os.stat(entry).st_mtime_ns
+            if entry in self._index and mtime <= self._mtime:
+                listing, indexed = self._index[entry], True
+            else:
+                listing = {name.partition(".")[0] for name in os.listdir(entry)}
+        except OSError:
+            pass
+        self._listings[entry] = listing, indexed
+        return listing, indexed
+
+    def _spec(self, name, entry, module):
+        """Create the spec of an indexed module."""
+        is_dir, inits, files = module
+        location = os.path.join(entry, name)
+        for suffix, loader in LOADERS if is_dir else ():
+            if "__init__" + suffix in inits:
+                path = os.path.join(location, "__init__" + suffix)
+                spec = spec_from_file_location(
+                    name,
+                    path,
+                    loader=loader(name, path),
+                    submodule_search_locations=[location],
+                )
+                return spec, True
+        for suffix, loader in LOADERS:
+            if name + suffix in files:
+                path = location + suffix
+                spec = spec_from_file_location(name, path, loader=loader(name, path))
+                return spec, True
+        return None, is_dir
+
+    def find_spec(self, name, path=None, target=None):
+        # The submodules are found in the path of the package
+        if path is not None:
+            return None
+        for entry in sys.path:
+            if not isinstance(entry, str) or not entry:
+                spec, found = _find(name, entry)
+            else:
+                listing, indexed = self._listing(entry)
+                if listing is None:
+                    spec, found = _find(name, entry)
+                elif name not in listing:
+                    continue
+                elif indexed:
+                    spec, found = self._spec(name, entry, listing[name])
+                else:
+                    spec, found = _find(name, entry)
+            if found:
+                return spec
+        return None
+
+    def invalidate_caches(self):
+        self._listings.clear()
+
+
+def _install():
+    """Install the finder before the PathFinder."""
+    filename = os.path.join(os.path.dirname(__file__), "_venvjail_index.marshal")
+    try:
+        with open(filename, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            index = {}
+            for paths, modules in marshal.load(f):
+                for path in paths:
+                    index[os.path.join(sys.prefix, path)] = modules
+    except (OSError, EOFError, ValueError, TypeError):
+        return
+    position = sys.meta_path.index(PathFinder) if PathFinder in sys.meta_path else 0
+    sys.meta_path.insert(position, IndexFinder(mtime, index))
+
+
+_install()
+'''
+
+
+def _literal_prefix(pattern):
+    """Return the literal text that starts any match of a pattern."""
+    # Alternatives at the top level can start with anything
+    if "|" in pattern:
+        return ""
+    prefix = []
+    i = 1 if pattern.startswith("^") else 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and pattern[i + 1 : i + 2] and not pattern[i + 1].isalnum():
+            literal, size = pattern[i + 1], 2
+        elif char in ".^$*+?{}[]()\\":
+            break
+        else:
+            literal, size = char, 1
+        # The last literal is optional if it is quantified
+        quantifier = pattern[i + size : i + size + 1]
+        if quantifier in ("*", "?", "{"):
+            break
+        prefix.append(literal)
+        if quantifier == "+":
+            break
+        i += size
+    return "".join(prefix)
+
 
 class FileList:
     """File list with comments and regular expressions."""
@@ -85,25 +349,74 @@ class FileList:
         except IOError:
             print("File {} not found, using empty default")
             self.items = []
+        self._compile()
+
+    def _compile(self):
+        # The patterns that start with a literal text are indexed by
+        # this prefix, so only the ones that can match are tested.
+        # The rest are combined in a single regular expression, if
+        # they are not using groups references or flags.
+        self._prefixes = {}
+        self._others = []
+        combined = []
+        for item in self.items:
+            prefix = _literal_prefix(item.pattern)
+            if prefix:
+                self._prefixes.setdefault(prefix, []).append(item)
+            elif item.flags != re.UNICODE or re.search(r"\\\d|\(\?P[<=]", item.pattern):
+                self._others.append(item)
+            else:
+                combined.append(f"(?:{item.pattern})")
+        if combined:
+            self._others.append(re.compile("|".join(combined)))
+        self._lengths = sorted({len(prefix) for prefix in self._prefixes})
+        self._cache = {}
 
     def is_populated(self):
         return self.items
 
     def contains(self, item):
-        return any(i.match(item) for i in self.items)
+        try:
+            return self._cache[item]
+        except KeyError:
+            pass
+        found = any(i.match(item) for i in self._others)
+        for length in self._lengths:
+            if found or length > len(item):
+                break
+            found = any(i.match(item) for i in self._prefixes.get(item[:length], ()))
+        self._cache[item] = found
+        return found
 
     def __contains__(self, item):
         return self.contains(item)
 
 
+def _unshare(path):
+    """Break the hard links of a file, so it can be changed in place."""
+    # The files of the venv can be hard links of the package cache
+    if os.lstat(path).st_nlink > 1:
+        directory = os.path.dirname(path) or "."
+        mode = _make_writable(directory)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            os.close(fd)
+            shutil.copy2(path, tmp)
+            os.replace(tmp, path)
+        finally:
+            os.chmod(directory, mode)
+
+
 def _replace(filename, original, line):
     """Replace a line in a file using regular expressions."""
+    _unshare(filename)
     lines = re.sub(original, line, open(filename).read())
     open(filename, "w").writelines(lines)
 
 
 def _insert(filename, after, line):
     """Insert a line after the `after` line."""
+    _unshare(filename)
     lines = open(filename).readlines()
     # If the line is not found, will produce a ValueError exception
     # and will end the script.  We do not want to capture the
@@ -114,35 +427,174 @@ def _insert(filename, after, line):
     open(filename, "w").writelines(lines)
 
 
-def _find_files(dest_dir, filelist, prefix=None):
+def _find_files(dest_dir, filelist, prefix=""):
     """Return the list of files that match in filelist."""
-    prefix = prefix if prefix else dest_dir
     for entry in os.scandir(dest_dir):
-        if os.path.relpath(entry.path, prefix) in filelist:
+        relpath = prefix + entry.name
+        if relpath in filelist:
             yield entry
         if entry.is_dir(follow_symlinks=False):
-            yield from _find_files(entry.path, filelist, prefix)
+            yield from _find_files(entry.path, filelist, relpath + "/")
 
 
-def _fix_virtualenv(dest_dir, relocated, no_relocate_shebang, python_version):
-    """Fix virtualenv activators."""
+def _walk_tree(dest_dir, visitors, prefix=""):
+    """Visit once all the entries of a tree."""
+    # Every visitor is called with the `os.DirEntry` and the path
+    # relative to the root of the tree.  If a visitor returns False,
+    # the entry is not passed to the next visitors, and if it is a
+    # directory, the content is not visited.
+    with os.scandir(dest_dir) as entries:
+        for entry in entries:
+            relpath = prefix + entry.name
+            if not all(visit(entry, relpath) for visit in visitors):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                _walk_tree(entry.path, visitors, relpath + "/")
+
+
+def _visit_remove(entry, relpath, remove, removed):
+    """Visitor that remove the entries that match in `remove`."""
+    if relpath not in remove:
+        return True
+    removed.append(entry.path)
+    if entry.is_dir(follow_symlinks=False):
+        # Also log the matches inside the directory
+        removed.extend(e.path for e in _find_files(entry.path, remove, relpath + "/"))
+        shutil.rmtree(entry.path)
+    else:
+        os.remove(entry.path)
+    return False
+
+
+def _visit_links(entry, relpath, links):
+    """Visitor that collect the symbolic links and the targets."""
+    if entry.is_symlink():
+        links[entry.path] = (relpath, os.readlink(entry.path))
+    return True
+
+
+def _visit_files(entry, relpath, files):
+    """Visitor that collect the regular files."""
+    if entry.is_file(follow_symlinks=False):
+        files.append(entry.path)
+    return True
+
+
+def _fix_virtualenv(
+    dest_dir,
+    relocated,
+    no_relocate_shebang,
+    python_version,
+    remove=None,
+    jobs=1,
+    timings=None,
+    changed=None,
+    loader="shell",
+    runpath=False,
+    strip=False,
+):
+    """Fix virtualenv activators, and return a log of the changes.
+
+    When a venv is updated, only the `changed` paths (relative to the
+    venv) are fixed.  With `runpath` the ELF files find the libraries
+    of the venv via the runpath, instead of LD_LIBRARY_PATH, and with
+    `strip` the debug sections of the ELF files are removed.
+
+    """
     if not python_version:
         python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
 
     # New path where the venv will live at the end
     virtual_env = relocated / dest_dir
 
-    _fix_filesystem(dest_dir)
-    _fix_alternatives(dest_dir, relocated, python_version)
-    _fix_broken_links(
-        dest_dir,
-        relocated,
-        directories=["srv", f"lib/python{python_version}/site-packages/pytz"],
-    )
-    _fix_relocation(dest_dir, virtual_env, no_relocate_shebang)
-    _fix_activators(dest_dir, virtual_env)
-    _fix_loader(dest_dir, virtual_env)
-    _fix_systemd_services(dest_dir, virtual_env)
+    with _phase(timings, "filesystem"):
+        _fix_filesystem(dest_dir)
+
+    # Walk the tree only one time, pruning the files that are in the
+    # `remove` list, and collecting the entries that can be fixed
+    removed = []
+    links = {}
+    files = []
+    libraries = {}
+    visitors = [
+        functools.partial(_visit_links, links=links),
+        functools.partial(_visit_files, files=files),
+    ]
+    if runpath:
+        visitors.append(functools.partial(_visit_libraries, libraries=libraries))
+    if remove and remove.is_populated():
+        visitors.insert(
+            0, functools.partial(_visit_remove, remove=remove, removed=removed)
+        )
+    with _phase(timings, "prune"):
+        if changed is None:
+            _walk_tree(dest_dir, visitors)
+        else:
+            # The remove list was applied during the extraction
+            for relpath in sorted(changed):
+                path = os.path.join(dest_dir, relpath)
+                if os.path.islink(path):
+                    links[path] = (relpath, os.readlink(path))
+                elif os.path.isfile(path):
+                    files.append(path)
+            if runpath:
+                _walk_tree(
+                    dest_dir,
+                    [functools.partial(_visit_libraries, libraries=libraries)],
+                )
+
+    # All the links are resolved inside the venv.  When updated, the
+    # links not changed are read when needed
+    with _phase(timings, "links"):
+        graph = _LinkGraph(dest_dir, dict(links.values()), complete=changed is None)
+        fixed_links, unresolved_links = _fix_links(
+            dest_dir, python_version, links, graph
+        )
+    with _phase(timings, "relocation"):
+        relocated_shebangs, skipped_shebangs = _fix_relocation(
+            dest_dir, virtual_env, no_relocate_shebang, files, jobs
+        )
+    log = {
+        "Removed files": removed,
+        "Relocated shebangs": relocated_shebangs,
+        "Not relocated shebangs": skipped_shebangs,
+        "Fixed links": fixed_links,
+        "Unresolved links": unresolved_links,
+    }
+    if strip:
+        with _phase(timings, "strip"):
+            stripped, not_stripped = _fix_strip(dest_dir, files, jobs)
+        log["Stripped files"] = stripped
+        log["Not stripped files"] = not_stripped
+    if runpath:
+        with _phase(timings, "runpath"):
+            patched, not_patched = _fix_runpath(dest_dir, files, libraries, jobs)
+        log["Patched runpaths"] = patched
+        log["Not patched runpaths"] = not_patched
+        # The activators of an updated venv are not fixed again
+        if not_patched and changed is not None:
+            raise ValueError("some runpaths cannot be patched")
+
+    # LD_LIBRARY_PATH is still needed by the files without a runpath,
+    # and only the shell loader can export it before the interpreter
+    # starts
+    ld_library_path = not runpath or bool(not_patched)
+    if loader == "native" and ld_library_path:
+        print("WARNING: some runpaths are not patched, using the shell loader")
+        loader = "shell"
+
+    # The activators are part of the venv, and are fixed only once
+    if changed is None:
+        with _phase(timings, "activators"):
+            _fix_activators(dest_dir, virtual_env, ld_library_path)
+    with _phase(timings, "loader"):
+        if loader == "shell":
+            _fix_loader(dest_dir, virtual_env, changed, ld_library_path)
+        elif changed is None:
+            _fix_loader_native(dest_dir, virtual_env, python_version)
+    with _phase(timings, "systemd"):
+        _fix_systemd_services(dest_dir, virtual_env, changed)
+    return log
 
 
 def _fix_filesystem(dest_dir):
@@ -185,105 +637,739 @@ def _fix_filesystem(dest_dir):
             dir_.chmod(mod_)
 
 
-def _fix_alternatives(dest_dir, relocated, python_version):
-    """Fix alternative links."""
-    # TODO: os.scandir() was implemented in 3.5
-    for dirpath, dirnames, filenames in os.walk(dest_dir):
-        for name in filenames:
-            rel_name = os.path.join(dirpath, name)
-            if os.path.islink(rel_name) and "alternatives" in os.readlink(rel_name):
-                # We assume that the Python alternative is living in
-                # the same directory, but we create the link in the
-                # place were it will live at the end
-                alt_name = os.path.join(relocated, dirpath, name + f"-{python_version}")
-                alt_rel_name = rel_name + f"-{python_version}"
-                if os.path.exists(alt_rel_name):
-                    os.unlink(rel_name)
-                    os.symlink(alt_name, rel_name)
+class _LinkGraph:
+    """Symbolic links of the venv, resolved against the root of the venv.
+
+    If the links are not `complete`, the rest of the paths are read
+    from the file system when needed.
+
+    """
+
+    def __init__(self, dest_dir, links, complete=True):
+        self.dest_dir = dest_dir
+        self.links = dict(links)
+        self.complete = complete
+        self._resolved = {}
+
+    def target(self, path):
+        """Return the target of a link, or None if it is not a link."""
+        if path not in self.links and not self.complete:
+            filename = os.path.join(self.dest_dir, path)
+            self.links[path] = (
+                os.readlink(filename) if os.path.islink(filename) else None
+            )
+        return self.links.get(path)
+
+    def update(self, path, target):
+        """Replace the target of a link (or add a new one)."""
+        self.links[path] = target
+        # Forget the resolved links that went through the path
+        self._resolved = {
+            link: value
+            for link, value in self._resolved.items()
+            if link != path and path not in value[2]
+        }
+
+    def resolve(self, path):
+        """Return the path with all the links resolved, relative to the
+        root, and if it escapes the root.
+
+        """
+        resolved, escaped, _ = self._resolve(path)
+        return resolved, escaped
+
+    def _resolve(self, path, depth=0):
+        """Resolve a path, and return also all the paths visited."""
+        if depth > 40:
+            raise ValueError("too many levels of links")
+        resolved = []
+        escaped = False
+        visited = set()
+        for part in path.split("/"):
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if resolved:
+                    resolved.pop()
                 else:
-                    print(f"ERROR: alternative link for {name} not found")
-
-
-def _fix_broken_links(dest_dir, relocated, directories=None):
-    """Fix broken links."""
-    # Some packages create absolute or broken relative soft-links.  We
-    # can use some heuristics to detect them, and if is possible, fix
-    # them.
-    for fix_dir in directories:
-        fix_dest_dir = dest_dir / fix_dir
-        for dirpath, dirnames, filenames in os.walk(fix_dest_dir):
-            for name in itertools.chain(dirnames, filenames):
-                rel_name = os.path.join(dirpath, name)
-                abs_name = os.path.join(relocated, dirpath, name)
-
-                # If the link exist, lets assume that is OK in the
-                # bundle too
-                if os.path.islink(rel_name) and os.path.exists(os.readlink(rel_name)):
+                    escaped = True
+                continue
+            resolved.append(part)
+            current = "/".join(resolved)
+            visited.add(current)
+            target = self.target(current)
+            if target is None:
+                continue
+            if current not in self._resolved:
+                base = "/".join(resolved[:-1])
+                self._resolved[current] = self._resolve(
+                    os.path.join(base, target), depth + 1
+                )
+            current, current_escaped, current_visited = self._resolved[current]
+            visited.update(current_visited)
+            resolved = current.split("/") if current else []
+            escaped = escaped or current_escaped
+        return "/".join(resolved), escaped, visited
+
+    def exists(self, path):
+        """Return True if a path exists inside the venv."""
+        try:
+            resolved, escaped = self.resolve(path)
+        except ValueError:
+            return False
+        return not escaped and os.path.lexists(os.path.join(self.dest_dir, resolved))
+
+
+def _new_link_target(graph, python_version, relpath, target):
+    """Return the new target of a link, and if it is in the system, or
+    None if the link is not fixed.
+
+    """
+    directory = os.path.dirname(relpath)
+    if graph.exists(relpath):
+        # An absolute link would point outside of the relocated venv
+        if target.startswith("/"):
+            resolved, _ = graph.resolve(relpath)
+            return os.path.relpath(resolved or ".", directory or "."), False
+    elif "alternatives" in target:
+        # We assume that the Python alternative is living in the same
+        # directory
+        alternative = f"{os.path.basename(relpath)}-{python_version}"
+        if graph.exists(os.path.join(directory, alternative)):
+            return alternative, False
+    elif target.startswith(".."):
+        # The relative link was created for the original place of the
+        # package, inside `/usr` if the directory is merged in the
+        # venv.  If the target is not in the venv, it is expected in
+        # the system
+        top = relpath.split("/", 1)[0]
+        if graph.target(f"usr/{top}"):
+            original = os.path.join("/usr", directory, target)
+            original = os.path.normpath(original)[1:]
+            if graph.exists(original):
+                resolved, _ = graph.resolve(original)
+                return os.path.relpath(resolved or ".", directory or "."), False
+            return f"/{original}", True
+    return None
+
+
+def _fix_links(dest_dir, python_version, links, graph):
+    """Fix the absolute, escaping and alternative links of the venv.
+
+    The links are resolved inside the venv, and not in the file system
+    of the build.  The relative links can point to the other links, so
+    they are fixed after them, and are pointed to the system only when
+    the rest of the links are fixed.  Return the fixed links with the
+    new target, and the links that cannot be resolved.
+
+    """
+    fixed = []
+    system = set()
+    links = sorted(links.values())
+    for relative, to_system in ((False, False), (True, False), (True, True)):
+        group = [link for link in links if link[1].startswith("..") == relative]
+        # A fixed link can make other links of the group resolvable
+        changed = True
+        while changed:
+            changed = False
+            for relpath, _ in group:
+                if relpath in system:
+                    continue
+                new = _new_link_target(
+                    graph, python_version, relpath, graph.target(relpath)
+                )
+                if not new or new[0] == graph.target(relpath):
                     continue
+                new_target, in_system = new
+                if in_system and not to_system:
+                    continue
+                filename = os.path.join(dest_dir, relpath)
+                parent = os.path.dirname(filename)
+                mode = _make_writable(parent)
+                os.unlink(filename)
+                os.symlink(new_target, filename)
+                os.chmod(parent, mode)
+                graph.update(relpath, new_target)
+                fixed.append(f"{relpath} -> {new_target}")
+                if in_system:
+                    system.add(relpath)
+                changed = True
 
-                # If the link is absolute, lets try to point to some
-                # place inside the bundle
-                if os.path.islink(rel_name) and os.readlink(rel_name).startswith("/"):
-                    link_to = os.path.join(dest_dir, os.readlink(rel_name)[1:])
-                    if os.path.exists(link_to):
-                        # Convert the absolute link into a relative
-                        # link, also takes care of removing the
-                        # initial '/' from the path
-                        rel_link = os.path.relpath(link_to, os.path.dirname(rel_name))
-                        os.unlink(rel_name)
-                        os.symlink(rel_link, rel_name)
-                    else:
-                        print(f"ERROR: relative link for {name} not found")
-                # If the link is relative, probably is pointing to
-                # some place outside
-                elif os.path.islink(rel_name) and os.readlink(rel_name).startswith(
-                    ".."
-                ):
-                    fixed = False
-                    for prefix in ["/", "/usr"]:
-                        link_to = os.path.abspath(
-                            os.path.join(prefix, fix_dir, os.readlink(rel_name))
-                        )
-                        if os.path.exists(link_to):
-                            # Convert the relative link into another
-                            # relative link that points to the correct
-                            # place
-                            rel_link = os.path.relpath(
-                                link_to, os.path.dirname(abs_name)
-                            )
-                            os.unlink(rel_name)
-                            os.symlink(rel_link, rel_name)
-                            fixed = True
-                    if not fixed:
-                        print(f"ERROR: relative link for {name} not found")
-
-
-def _fix_relocation(dest_dir, virtual_env, no_relocate_shebang):
+    # The links expected in the system are not resolved in the venv
+    unresolved = []
+    for relpath, target in links:
+        if relpath in system:
+            continue
+        try:
+            graph.resolve(relpath)
+        except ValueError as e:
+            unresolved.append(f"{relpath} -> {target} ({e})")
+            continue
+        if not graph.exists(relpath):
+            unresolved.append(f"{relpath} -> {graph.target(relpath)}")
+    return fixed, unresolved
+
+
+def _read_shebang(path):
+    """Return the shebang line of a Python script, if any."""
+    with open(path, "rb") as f:
+        # Binaries (like ELF files) are discarded reading only the
+        # first bytes
+        head = f.read(128)
+        if not head.startswith(b"#!"):
+            return None
+        # The kernel only reads the first 256 bytes of the shebang,
+        # but we accept larger lines
+        while b"\n" not in head and len(head) < 4096:
+            chunk = f.read(128)
+            if not chunk:
+                break
+            head += chunk
+    line = head.split(b"\n", 1)[0].rstrip()
+    return line if b"python" in line else None
+
+
+def _write_shebang(path, line, shebang):
+    """Replace the first line of a script with a new shebang."""
+    _unshare(path)
+    mode = os.stat(path).st_mode
+    if not mode & stat.S_IWUSR:
+        os.chmod(path, mode | stat.S_IWUSR)
+    try:
+        with open(path, "r+b") as f:
+            if len(line) == len(shebang):
+                f.write(shebang)
+            else:
+                f.seek(len(line))
+                rest = f.read()
+                f.seek(0)
+                f.write(shebang + rest)
+                f.truncate()
+    finally:
+        if not mode & stat.S_IWUSR:
+            os.chmod(path, mode)
+
+
+def _fix_relocation(dest_dir, virtual_env, no_relocate_shebang, files, jobs=1):
     """Fix relocation shebang from python scripts"""
-    shebang = "#!" + os.path.join(virtual_env, "bin", "python")
-    for dirpath, dirnames, filenames in os.walk(dest_dir):
-        for name in filenames:
-            rel_name = os.path.join(dirpath, name)
-            if any(fnmatch.fnmatch(rel_name, path) for path in no_relocate_shebang):
-                continue
-            if os.path.isfile(rel_name):
-                try:
-                    line = open(rel_name).readline().strip()
-                    if line.startswith("#!") and "python" in line:
-                        _replace(rel_name, line, shebang)
-                except Exception:
-                    pass
+    shebang = os.fsencode("#!" + os.path.join(virtual_env, "bin", "python"))
+    no_relocate = [re.compile(fnmatch.translate(path)) for path in no_relocate_shebang]
+
+    def _relocate(rel_name):
+        try:
+            line = _read_shebang(rel_name)
+            if not line or line == shebang:
+                return None
+            if any(path.match(rel_name) for path in no_relocate):
+                return False
+            _write_shebang(rel_name, line, shebang)
+            return True
+        except OSError as e:
+            print(f"ERROR: shebang of {rel_name} not relocated: {e}")
+
+    relocated = []
+    skipped = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for rel_name, result in zip(files, executor.map(_relocate, files)):
+            if result:
+                relocated.append(rel_name)
+            elif result is False:
+                skipped.append(rel_name)
+    return relocated, skipped
+
+
+# Dynamic section of an ELF file.  `dynamic` is a list of (offset,
+# tag, value) of every entry, and `strtab` the offset of the strings
+_Elf = collections.namedtuple("_Elf", ["endian", "is64", "dynamic", "strtab"])
+
+
+def _read_elf(f):
+    """Read the dynamic section of an ELF file, or return None if not ELF."""
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != b"\x7fELF" or ident[4] not in (1, 2):
+        return None
+    is64 = ident[4] == 2
+    endian = "<" if ident[5] == 1 else ">"
+    if is64:
+        header = struct.Struct(endian + "HHIQQQIHHHHHH")
+        phdr = struct.Struct(endian + "IIQQQQQQ")
+        dyn = struct.Struct(endian + "qQ")
+    else:
+        header = struct.Struct(endian + "HHIIIIIHHHHHH")
+        phdr = struct.Struct(endian + "IIIIIIII")
+        dyn = struct.Struct(endian + "iI")
+    fields = header.unpack(f.read(header.size))
+    phoff, phentsize, phnum = fields[4], fields[8], fields[9]
+
+    # The addresses of the dynamic section are converted to offsets
+    # of the file with the loadable segments
+    loads = []
+    dynamic_segment = None
+    for n in range(phnum):
+        f.seek(phoff + n * phentsize)
+        fields = phdr.unpack(f.read(phdr.size))
+        if is64:
+            p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = fields
+        else:
+            p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = fields
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic_segment = (p_offset, p_filesz)
+    if not dynamic_segment:
+        return _Elf(endian, is64, [], None)
+
+    dynamic = []
+    offset, size = dynamic_segment
+    f.seek(offset)
+    data = f.read(size)
+    for n in range(0, len(data) - dyn.size + 1, dyn.size):
+        tag, value = dyn.unpack_from(data, n)
+        dynamic.append((offset + n, tag, value))
+        if tag == DT_NULL:
+            break
+    strtab = None
+    for _, tag, value in dynamic:
+        if tag == DT_STRTAB:
+            for vaddr, p_offset, p_filesz in loads:
+                if vaddr <= value < vaddr + p_filesz:
+                    strtab = value - vaddr + p_offset
+    return _Elf(endian, is64, dynamic, strtab)
+
+
+def _elf_string(f, elf, offset):
+    """Read a string of the dynamic section of an ELF file."""
+    f.seek(elf.strtab + offset)
+    data = b""
+    while b"\0" not in data:
+        chunk = f.read(256)
+        if not chunk:
+            break
+        data += chunk
+    return data.split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+
+
+def _elf_needed(path):
+    """Return the libraries needed by an ELF file, or None if not ELF."""
+    with open(path, "rb") as f:
+        elf = _read_elf(f)
+        if not elf or elf.strtab is None:
+            return None
+        return [_elf_string(f, elf, v) for _, t, v in elf.dynamic if t == DT_NEEDED]
+
+
+def _visit_libraries(entry, relpath, libraries):
+    """Visitor that collect the directories of the shared libraries."""
+    if ".so" in entry.name and not entry.is_dir(follow_symlinks=False):
+        libraries.setdefault(entry.name, []).append(os.path.dirname(relpath))
+    return True
+
+
+def _is_elf_candidate(path):
+    """Return True if a file can be an executable or a shared object."""
+    return ".so" in os.path.basename(path) or os.lstat(path).st_mode & 0o111
+
+
+def _append_runpath(path, elf, current, runpath):
+    """Set a runpath that does not fit in the string table of an ELF file.
+
+    A copy of the string table, with the runpath at the end, is
+    written in the padding after a loadable segment, that is extended
+    to map it.  The current runpath (or rpath) entry points to the new
+    string, or if there is not one, a DT_RUNPATH entry is written in
+    one of the spare DT_NULL entries that the linker leaves at the end
+    of the dynamic section.  If there is not space, ValueError is
+    raised.
+
+    """
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    if elf.is64:
+        header = struct.Struct(elf.endian + "HHIQQQIHHHHHH")
+        phdr = struct.Struct(elf.endian + "IIQQQQQQ")
+        shdr = struct.Struct(elf.endian + "IIQQQQIIQQ")
+        dyn = struct.Struct(elf.endian + "qQ")
+        # p_offset, p_vaddr, p_filesz, p_memsz, p_align
+        fields = (2, 3, 5, 6, 7)
+    else:
+        header = struct.Struct(elf.endian + "HHIIIIIHHHHHH")
+        phdr = struct.Struct(elf.endian + "IIIIIIII")
+        shdr = struct.Struct(elf.endian + "IIIIIIIIII")
+        dyn = struct.Struct(elf.endian + "iI")
+        fields = (1, 2, 4, 5, 7)
+    ehdr = header.unpack_from(data, 16)
+    phoff, shoff, phentsize, phnum, shentsize, shnum = ehdr[4:6] + ehdr[8:12]
+    segments = [
+        (n, phdr.unpack_from(data, phoff + n * phentsize)) for n in range(phnum)
+    ]
+    sections = [shdr.unpack_from(data, shoff + n * shentsize) for n in range(shnum)]
+
+    # The entry with the runpath, that can be a spare DT_NULL entry if
+    # it is followed by other DT_NULL entry
+    values = {tag: value for _, tag, value in elf.dynamic}
+    if current:
+        entry = current[0]
+    else:
+        entry = elf.dynamic[-1][0]
+        spare = entry + dyn.size
+        if (
+            elf.dynamic[-1][1] != DT_NULL
+            or spare + dyn.size > len(data)
+            or dyn.unpack_from(data, spare)[0] != DT_NULL
+            or not any(
+                p[0] == PT_DYNAMIC and spare < p[fields[0]] + p[fields[2]]
+                for _, p in segments
+            )
+        ):
+            raise ValueError(f"no space for {runpath}")
+    table = bytes(data[elf.strtab : elf.strtab + values[DT_STRSZ]])
+    table += runpath.encode() + b"\0"
+
+    # The padding after a loadable segment, until the next content of
+    # the file and the next page mapped in memory
+    for n, segment in segments:
+        offset, vaddr, filesz, memsz, align = (segment[i] for i in fields)
+        if segment[0] != PT_LOAD or filesz != memsz:
+            continue
+        end, end_vaddr = offset + filesz, vaddr + filesz
+        limits = [len(data) - end]
+        if shoff >= end:
+            limits.append(shoff - end)
+        for section in sections:
+            if section[1] != SHT_NOBITS and section[5] and section[4] >= end:
+                limits.append(section[4] - end)
+        for _, other in segments:
+            other_offset, other_vaddr, _, _, other_align = (other[i] for i in fields)
+            if other[0] == PT_LOAD and other_offset >= end and other is not segment:
+                limits.append(other_offset - end)
+            if other[0] == PT_LOAD and other_vaddr >= end_vaddr:
+                page = other_vaddr & ~(max(other_align, 1) - 1)
+                limits.append(page - end_vaddr)
+        if min(limits) >= len(table) and not any(data[end : end + len(table)]):
+            break
+    else:
+        raise ValueError(f"no space for {runpath}")
+
+    data[end : end + len(table)] = table
+    segment = list(segment)
+    segment[fields[2]] += len(table)
+    segment[fields[3]] += len(table)
+    phdr.pack_into(data, phoff + n * phentsize, *segment)
+    for offset, tag, value in elf.dynamic:
+        if tag == DT_STRTAB:
+            dyn.pack_into(data, offset, tag, end_vaddr)
+        elif tag == DT_STRSZ:
+            dyn.pack_into(data, offset, tag, len(table))
+    tag = current[1] if current else DT_RUNPATH
+    dyn.pack_into(data, entry, tag, values[DT_STRSZ])
+
+    # The section of the string table is moved too, for the tools that
+    # read the sections
+    for m, section in enumerate(sections):
+        if section[1] == SHT_STRTAB and section[4] == elf.strtab:
+            section = list(section)
+            section[3], section[4], section[5] = end_vaddr, end, len(table)
+            shdr.pack_into(data, shoff + m * shentsize, *section)
+    with open(path, "r+b") as f:
+        f.write(data)
+
+
+def _patch_runpath(dest_dir, relpath, libraries):
+    """Set the runpath of an ELF file that needs libraries of the venv.
+
+    Return the new runpath, or None if the file does not need a
+    runpath.  The runpath is replaced in place if there is space for
+    it, or appended to a copy of the string table if not, and in the
+    last case `patchelf` is used, if available, or ValueError is
+    raised.  The entries of the current runpath (or rpath) are kept
+    after the directories of the venv, and an rpath is not converted
+    into a runpath, as it is also used for the dependencies of the
+    libraries.
+
+    """
+    path = os.path.join(dest_dir, relpath)
+    with open(path, "rb") as f:
+        elf = _read_elf(f)
+        if not elf or elf.strtab is None:
+            return None
+        strings = {
+            (tag, value): _elf_string(f, elf, value)
+            for _, tag, value in elf.dynamic
+            if tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH)
+        }
+
+    # Directories of the venv with the needed libraries, relative to
+    # the file.  The less nested directory with the library is used
+    origin = os.path.dirname(relpath) or "."
+    runpath = []
+    for (tag, _), name in strings.items():
+        if tag == DT_NEEDED and name in libraries:
+            directory = min(libraries[name], key=lambda d: (d.count("/"), d))
+            directory = os.path.relpath(directory or ".", origin)
+            entry = "$ORIGIN" if directory == "." else f"$ORIGIN/{directory}"
+            if entry not in runpath:
+                runpath.append(entry)
+    if not runpath:
+        return None
+
+    # The current runpath (or rpath, that is ignored if there is a
+    # runpath) is maintained after the directories of the venv
+    current = None
+    for offset, tag, value in elf.dynamic:
+        if tag == DT_RUNPATH or (tag == DT_RPATH and not current):
+            current = (offset, tag, value)
+    old = strings[current[1:]] if current else ""
+    for entry in old.split(":"):
+        if entry and entry not in runpath:
+            runpath.append(entry)
+    new = ":".join(runpath)
+    if new == old:
+        return None
+
+    # The string can be replaced if it is large enough, and is not
+    # shared with other entries
+    in_place = (
+        current
+        and len(new) <= len(old)
+        and not any(current[2] < value <= current[2] + len(old) for _, value in strings)
+    )
+    _unshare(path)
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if not mode & stat.S_IWUSR:
+        os.chmod(path, mode | stat.S_IWUSR)
+    try:
+        if in_place:
+            with open(path, "r+b") as f:
+                f.seek(elf.strtab + current[2])
+                f.write(new.encode() + b"\0" * (len(old) - len(new)))
+        else:
+            try:
+                _append_runpath(path, elf, current, new)
+            except ValueError:
+                if not shutil.which("patchelf"):
+                    raise
+                command = ["patchelf", "--set-rpath", new, path]
+                if current and current[1] == DT_RPATH:
+                    command.insert(1, "--force-rpath")
+                subprocess.run(command, check=True)
+    finally:
+        if not mode & stat.S_IWUSR:
+            os.chmod(path, mode)
+    return new
+
+
+def _strip_elf(path):
+    """Remove the debug sections and the symbol table of an ELF file.
+
+    Only the sections that are not loaded in memory are removed, so
+    the build ID (an allocated note) and the data appended at the end
+    of the file (like a signature) are maintained.  Return the size
+    of the file before and after, or None if nothing is removed.
+
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < 16 or data[:4] != b"\x7fELF" or data[4] not in (1, 2):
+        return None
+    is64 = data[4] == 2
+    endian = "<" if data[5] == 1 else ">"
+    if is64:
+        header = struct.Struct(endian + "HHIQQQIHHHHHH")
+        phdr = struct.Struct(endian + "IIQQQQQQ")
+        shdr = struct.Struct(endian + "IIQQQQIIQQ")
+    else:
+        header = struct.Struct(endian + "HHIIIIIHHHHHH")
+        phdr = struct.Struct(endian + "IIIIIIII")
+        shdr = struct.Struct(endian + "IIIIIIIIII")
+    fields = list(header.unpack_from(data, 16))
+    e_type, phoff, shoff = fields[0], fields[4], fields[5]
+    phentsize, phnum, shentsize, shnum, shstrndx = fields[8:13]
+    # Relocatable objects, and files with extended section numbers,
+    # are not stripped
+    if e_type not in (ET_EXEC, ET_DYN) or not shnum or shstrndx >= shnum:
+        return None
+
+    # The end of the content loaded in memory
+    loaded = 0
+    for n in range(phnum):
+        fields_ph = phdr.unpack_from(data, phoff + n * phentsize)
+        p_offset, p_filesz = (
+            (fields_ph[2], fields_ph[5]) if is64 else (fields_ph[1], fields_ph[4])
+        )
+        loaded = max(loaded, p_offset + p_filesz)
+
+    # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size,
+    # sh_link, sh_info, sh_addralign, sh_entsize
+    sections = [
+        list(shdr.unpack_from(data, shoff + n * shentsize)) for n in range(shnum)
+    ]
+    names_offset = sections[shstrndx][4]
+
+    def _name(section):
+        start = names_offset + section[0]
+        return data[start : data.index(b"\0", start)].decode("ascii", "replace")
+
+    def _removable(section):
+        return not section[2] & SHF_ALLOC and section[1] != SHT_NOBITS
+
+    removed = {
+        n
+        for n, section in enumerate(sections)
+        if n
+        and _removable(section)
+        and (
+            _name(section).startswith((".debug", ".zdebug")) or section[1] == SHT_SYMTAB
+        )
+    }
+    # The relocations of the debug sections, and the strings of the
+    # symbol table if not used by other section
+    for n, section in enumerate(sections):
+        if section[1] in (SHT_REL, SHT_RELA) and section[7] in removed:
+            if _removable(section):
+                removed.add(n)
+    for n, section in enumerate(sections):
+        if section[1] == SHT_STRTAB and _removable(section) and n != shstrndx:
+            users = [m for m, other in enumerate(sections) if other[6] == n]
+            if users and removed.issuperset(users):
+                removed.add(n)
+    if not removed:
+        return None
+
+    # The kept sections cannot refer to the removed ones, and the
+    # removed sections must be after the content loaded in memory
+    index = {}
+    for n, section in enumerate(sections):
+        if n in removed:
+            continue
+        index[n] = len(index)
+        info_link = section[1] in (SHT_REL, SHT_RELA) or section[2] & SHF_INFO_LINK
+        if section[6] in removed or (info_link and section[7] in removed):
+            raise ValueError(f"{_name(section)} refers to a removed section")
+    start = min(sections[n][4] for n in removed)
+    if start < loaded:
+        raise ValueError("the debug sections are loaded in memory")
+
+    # The kept sections after the first removed one are moved
+    out = bytearray(data[:start])
+    moved = sorted(
+        (section for n, section in enumerate(sections) if n in index),
+        key=lambda section: section[4],
+    )
+    for section in moved:
+        if section[4] < start:
+            continue
+        if section[1] != SHT_NOBITS:
+            out.extend(b"\0" * (-len(out) % max(section[8], 1)))
+            out.extend(data[section[4] : section[4] + section[5]])
+            section[4] = len(out) - section[5]
+        else:
+            section[4] = len(out)
+
+    # The new table of sections, and the data after the end of the
+    # sections (like an appended signature)
+    end = max(
+        [shoff + shnum * shentsize]
+        + [s[4] + s[5] for s in sections if s[1] != SHT_NOBITS]
+    )
+    trailer = data[end:]
+    out.extend(b"\0" * (-len(out) % (8 if is64 else 4)))
+    new_shoff = len(out)
+    for n, section in enumerate(sections):
+        if n not in index:
+            continue
+        section[6] = index.get(section[6], 0)
+        if section[1] in (SHT_REL, SHT_RELA) or section[2] & SHF_INFO_LINK:
+            section[7] = index.get(section[7], 0)
+        out.extend(shdr.pack(*section))
+    out.extend(trailer)
+    fields = list(header.unpack_from(data, 16))
+    fields[5], fields[11], fields[12] = new_shoff, len(index), index[shstrndx]
+    header.pack_into(out, 16, *fields)
+
+    # The file is replaced, so the hard links of the cache are not
+    # modified
+    directory = os.path.dirname(path) or "."
+    mode = _make_writable(directory)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(out)
+        os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(tmp, path)
+    finally:
+        os.chmod(directory, mode)
+    return len(data), len(out)
+
+
+def _fix_strip(dest_dir, files, jobs=1):
+    """Strip the ELF files of the venv, in parallel.
+
+    Return the stripped files with the size before and after, and
+    the files that cannot be stripped.
+
+    """
+    candidates = [
+        os.path.relpath(path, dest_dir) for path in files if _is_elf_candidate(path)
+    ]
+
+    def _strip(relpath):
+        try:
+            return _strip_elf(os.path.join(dest_dir, relpath)), None
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            return None, e
+
+    stripped = []
+    not_stripped = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for relpath, (sizes, error) in zip(
+            candidates, executor.map(_strip, candidates)
+        ):
+            if sizes:
+                stripped.append(f"{relpath} ({sizes[0]} -> {sizes[1]} bytes)")
+            elif error:
+                not_stripped.append(f"{relpath} ({error})")
+    return stripped, not_stripped
+
+
+def _fix_runpath(dest_dir, files, libraries, jobs=1):
+    """Set a runpath relative to $ORIGIN in the ELF files of the venv.
+
+    Return the patched files with the new runpath, and the files that
+    need a runpath but cannot be patched.
 
+    """
+    candidates = [
+        os.path.relpath(path, dest_dir) for path in files if _is_elf_candidate(path)
+    ]
+
+    def _patch(relpath):
+        try:
+            return _patch_runpath(dest_dir, relpath, libraries), None
+        except (OSError, ValueError, struct.error, subprocess.CalledProcessError) as e:
+            return None, e
+
+    patched = []
+    not_patched = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for relpath, (runpath, error) in zip(
+            candidates, executor.map(_patch, candidates)
+        ):
+            if runpath:
+                patched.append(f"{relpath} ({runpath})")
+            elif error:
+                not_patched.append(f"{relpath} ({error})")
+    return patched, not_patched
 
-def _fix_activators(dest_dir, virtual_env):
+
+def _fix_activators(dest_dir, virtual_env, ld_library_path=True):
     """Fix virtualenv activators."""
-    ld_library_path = virtual_env / "lib"
+    lib = virtual_env / "lib"
     activators = {
         "activate": {
             "replace": (r'VIRTUAL_ENV=".*"', f'VIRTUAL_ENV="{virtual_env}"'),
             "insert": (
                 "deactivate nondestructive",
-                f'export LD_LIBRARY_PATH="{ld_library_path}"',
+                f'export LD_LIBRARY_PATH="{lib}"',
             ),
         },
         "activate.csh": {
@@ -293,7 +1379,7 @@ def _fix_activators(dest_dir, virtual_env):
             ),
             "insert": (
                 "deactivate nondestructive",
-                f'setenv LD_LIBRARY_PATH "{ld_library_path}"',
+                f'setenv LD_LIBRARY_PATH "{lib}"',
             ),
         },
         "activate.fish": {
@@ -303,7 +1389,7 @@ def _fix_activators(dest_dir, virtual_env):
             ),
             "insert": (
                 "deactivate nondestructive",
-                f'set -gx LD_LIBRARY_PATH "{ld_library_path}"',
+                f'set -gx LD_LIBRARY_PATH "{lib}"',
             ),
         },
     }
@@ -316,168 +1402,2566 @@ def _fix_activators(dest_dir, virtual_env):
 
         # Add the new LD_LIBRARY_PATH.  We use the `lib` instead of
         # `lib64` in the assumption that this will remain invariant
-        # for different architectures
-        after, line = action["insert"]
-        _insert(filename, after, line)
+        # for different architectures.  It is not needed if the
+        # libraries are found via the runpath
+        if ld_library_path:
+            after, line = action["insert"]
+            _insert(filename, after, line)
+
+
+def _fix_loader(dest_dir, virtual_env, changed=None, ld_library_path=True):
+    """Fix virtualenv python entry point."""
+    library_path = 'export LD_LIBRARY_PATH="$VIRTUAL_ENV/lib"\n'
+    loader = f"""#!/bin/sh
+
+export VIRTUAL_ENV="{virtual_env}"
+export PATH="$VIRTUAL_ENV/bin:$PATH"
+{library_path if ld_library_path else ""}export PYTHONHOME="$VIRTUAL_ENV"
+
+exec {{}} "$@"
+"""
+
+    # We replace all the python interpreters with a loader that set
+    # the correct env variables before executing it
+    for python in (dest_dir / "bin").glob("python*"):
+        if python.is_symlink():
+            continue
+        if changed is not None and f"bin/{python.name}" not in changed:
+            continue
+        new_name = python.with_name(python.name + ".original")
+        python.replace(new_name)
+        with python.open("w") as f:
+            new_python = virtual_env / "bin" / new_name.name
+            f.write(loader.format(new_python))
+        python.chmod(0o755)
+
+
+def _write_import_index(dest_dir, python_version):
+    """Write the index of the top level modules of the venv, and return it.
+
+    A finder installed in the venv resolves the imports from the
+    index, and uses the normal lookup if the directory is modified
+    after the index.
+
+    """
+    if not python_version:
+        python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    site_packages = dest_dir / f"lib/python{python_version}/site-packages"
+    site_packages.mkdir(parents=True, exist_ok=True)
+
+    # The cache of the compiled modules is created before the index,
+    # or the first import would make the index stale
+    (site_packages / "__pycache__").mkdir(exist_ok=True)
+    (site_packages / "_venvjail_finder.py").write_text(IMPORT_FINDER)
+    (site_packages / "_venvjail_finder.pth").write_text("import _venvjail_finder\n")
+
+    # The directory is in sys.path also via the `lib64` link
+    paths = []
+    for lib in sorted(dest_dir.glob("lib*")):
+        path = lib / f"python{python_version}/site-packages"
+        if path.is_dir() and path.samefile(site_packages):
+            paths.append(str(path.relative_to(dest_dir)))
+
+    # For every name the files that can be the module, and if it is
+    # a directory the files that can be the __init__ of the package
+    modules = {}
+    with os.scandir(site_packages) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            name = entry.name.partition(".")[0]
+            if not name or entry.name == IMPORT_INDEX:
+                continue
+            is_dir, inits, files = modules.get(name, (False, (), ()))
+            if entry.name == name and entry.is_dir():
+                is_dir = True
+                inits = tuple(
+                    sorted(
+                        init
+                        for init in os.listdir(entry.path)
+                        if init.startswith("__init__.")
+                    )
+                )
+            elif entry.is_file():
+                files += (entry.name,)
+            else:
+                continue
+            modules[name] = (is_dir, inits, files)
+
+    # The version 2 of marshal is reproducible (without references).
+    # The index is written the last, so it is newer than the directory
+    index = site_packages / IMPORT_INDEX
+    with index.open("wb") as f:
+        marshal.dump([(tuple(paths), modules)], f, 2)
+    return index
+
+
+def _fix_loader_native(dest_dir, virtual_env, python_version):
+    """Prepare the environment of the interpreters, without a loader.
+
+    LD_LIBRARY_PATH is not exported, as it is read by the dynamic
+    loader before the interpreter starts, so every ELF file of the
+    venv needs a runpath.
+
+    """
+    # The base of the venv is searched from `home`, so if the standard
+    # library is inside the venv the result is like with PYTHONHOME,
+    # and if not the original base is used
+    _replace(dest_dir / "pyvenv.cfg", r"home = .*", f"home = {virtual_env / 'bin'}")
+
+    # The rest of the variables are set by a `.pth` file when the
+    # interpreter starts, and are inherited by the child processes.
+    # PYTHONHOME is set only if the base is the venv, or the child
+    # interpreters would not find the standard library
+    venv = str(virtual_env)
+    hook = (
+        f"import os, sys; os.environ.update(VIRTUAL_ENV={venv!r}, "
+        f"PATH={venv + '/bin:'!r} + os.environ.get('PATH', '')); "
+        f"os.environ.update(PYTHONHOME={venv!r}) "
+        f"if sys.base_prefix == {venv!r} else None"
+    )
+    site_packages = dest_dir / f"lib/python{python_version}/site-packages"
+    site_packages.mkdir(parents=True, exist_ok=True)
+    (site_packages / "_venvjail_loader.pth").write_text(hook + "\n")
+
+
+def _fix_systemd_services_in(services_dir, virtual_env, names=None):
+    for service in services_dir.glob("*.service"):
+        if names is not None and service.name not in names:
+            continue
+        _unshare(service)
+        # Service files are read only
+        service.chmod(0o644)
+        _replace(service, r"ExecStart=(.*)", rf"ExecStart={virtual_env}\1")
+        _replace(service, r"ExecStartPre=-(.*)", rf"ExecStartPre=-{virtual_env}\1")
+        service.chmod(0o444)
+
+        # TODO: Do we need this? If so, we should adjust some After
+        # and Before.
+        # For convenience, rename the service
+        service.rename(services_dir / ("venv-" + service.name))
+
+
+def _fix_systemd_services(dest_dir, virtual_env, changed=None):
+    """Fix systemd services."""
+    # "lib/systemd/system" and "usr/lib/systemd/system" are links in
+    # Python3 venvs.  For now we choose only one to avoid processing
+    # two times the same service file
+    for systemd_dir in ("lib/systemd/system",):
+        names = None
+        if changed is not None:
+            names = {
+                os.path.basename(path)
+                for path in changed
+                if os.path.dirname(path) == systemd_dir
+            }
+        _fix_systemd_services_in(dest_dir / systemd_dir, virtual_env, names)
+
+
+# Compile the modules listed in stdin with the interpreter of the venv,
+# in a process pool, like `compileall -j 0` does for directories
+COMPILE_MODULES = """\
+import compileall, concurrent.futures, functools, py_compile, sys
+stripdir, prependdir, mode = sys.argv[1:]
+compile_file = functools.partial(
+    compileall.compile_file,
+    force=True,
+    quiet=1,
+    stripdir=stripdir,
+    prependdir=prependdir,
+    invalidation_mode=py_compile.PycInvalidationMode[mode.upper().replace("-", "_")],
+)
+modules = sys.stdin.read().splitlines()
+with concurrent.futures.ProcessPoolExecutor() as executor:
+    results = list(executor.map(compile_file, modules, chunksize=16))
+sys.exit(0 if all(results) else 1)
+"""
+
+
+def _compile_bytecode(
+    dest_dir, virtual_env, python_version, invalidation_mode, changed=None
+):
+    """Compile the Python modules of the venv, and return True if success."""
+    if not python_version:
+        python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    site_packages = dest_dir / f"lib/python{python_version}/site-packages"
+    if not site_packages.is_dir():
+        return True
+
+    # When the venv is updated, only the changed modules are compiled
+    modules = None
+    if changed is not None:
+        prefix = f"lib/python{python_version}/site-packages/"
+        modules = [
+            str(dest_dir / path)
+            for path in sorted(changed)
+            if path.startswith(prefix) and path.endswith(".py")
+        ]
+        if not modules:
+            return True
+
+    # The bytecode depends on the Python version of the venv, that can
+    # be different from the one running this script
+    if python_version == f"{sys.version_info.major}.{sys.version_info.minor}":
+        python = sys.executable
+    else:
+        python = shutil.which(f"python{python_version}")
+    if not python:
+        print(f"ERROR: python{python_version} not found, modules not compiled")
+        return False
+
+    # Force the compilation, as the `.pyc` from the packages contain
+    # the paths used during the build, and store the path where the
+    # venv will live at the end.  With `-j 0` all the CPUs are used
+    command = [
+        python,
+        "-m",
+        "compileall",
+        "-q",
+        "-f",
+        "-j",
+        "0",
+        "-s",
+        str(dest_dir),
+        "-p",
+        str(virtual_env),
+        "--invalidation-mode",
+        invalidation_mode,
+    ]
+    if modules is None:
+        return subprocess.call(command + [str(site_packages)]) == 0
+    # `compileall -i -` compiles the list of modules serially, so the
+    # changed modules are compiled in parallel by a script
+    command = [
+        python,
+        "-c",
+        COMPILE_MODULES,
+        str(dest_dir),
+        str(virtual_env),
+        invalidation_mode,
+    ]
+    modules = "\n".join(modules)
+    return subprocess.run(command, input=modules, text=True).returncode == 0
+
+
+def _visit_stat(entry, relpath, files):
+    """Visitor that collect the regular files and the stat data."""
+    if entry.is_file(follow_symlinks=False):
+        files.append((entry.path, entry.stat(follow_symlinks=False)))
+    return True
+
+
+def _dedup(dest_dir, jobs=1):
+    """Replace identical files with hard links, and return the saved bytes."""
+    files = []
+    _walk_tree(dest_dir, [functools.partial(_visit_stat, files=files)])
+
+    # Only files with the same size and the same permissions can be
+    # merged.  The hard links already present are considered a single
+    # file
+    candidates = collections.defaultdict(dict)
+    for path, st in sorted(files):
+        if st.st_size:
+            key = (st.st_size, st.st_mode, st.st_uid, st.st_gid)
+            candidates[key].setdefault((st.st_dev, st.st_ino), []).append(path)
+    candidates = [inodes for inodes in candidates.values() if len(inodes) > 1]
+
+    # Hash only the candidates
+    firsts = [paths[0] for group in candidates for paths in group.values()]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        checksums = dict(zip(firsts, executor.map(_checksum, firsts)))
+
+    saved = 0
+    for group in candidates:
+        originals = {}
+        for paths in group.values():
+            checksum = checksums[paths[0]]
+            if checksum not in originals:
+                originals[checksum] = paths[0]
+                continue
+            for path in paths:
+                # The link is created with a temporary name, that
+                # cannot collide with the files of the venv
+                directory = os.path.dirname(path)
+                mode = _make_writable(directory)
+                try:
+                    tmp_dir = tempfile.mkdtemp(dir=directory)
+                    tmp = os.path.join(tmp_dir, "link")
+                    os.link(originals[checksum], tmp)
+                    os.replace(tmp, path)
+                    os.rmdir(tmp_dir)
+                finally:
+                    os.chmod(directory, mode)
+            saved += os.lstat(originals[checksum]).st_size
+    return saved
+
+
+# Entry of a package payload.  `kind` is one of "dir", "file",
+# "symlink" or "link" (hard link), and `linkname` is the target of the
+# links.  The data of the files is read from `fileobj`.
+_Entry = collections.namedtuple(
+    "_Entry", ["name", "kind", "mode", "mtime", "size", "linkname", "fileobj"]
+)
+
+
+class _LimitedReader:
+    """Read at most `size` bytes from a stream."""
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        if len(data) < size:
+            raise ValueError("Unexpected end of stream")
+        self.remaining -= len(data)
+        return data
+
+    def skip(self):
+        while self.remaining:
+            self.read(min(self.remaining, 1024 * 1024))
+
+
+def _entry_name(name):
+    """Normalize the name of an entry, relative to the package root."""
+    name = os.path.normpath("/" + name).lstrip("/")
+    return "" if name == "." else name
+
+
+def _read_rpm_header(f):
+    """Read a RPM header structure, and return a dict of tags."""
+    magic, nindex, hsize = struct.unpack(">4s4xII", f.read(16))
+    if magic != RPM_HEADER_MAGIC:
+        raise ValueError("Bad RPM header magic")
+    index = f.read(16 * nindex)
+    store = f.read(hsize)
+    if len(store) != hsize:
+        raise ValueError("Truncated RPM header")
+
+    header = {}
+    for tag, type_, offset, count in struct.iter_unpack(">IIII", index):
+        if type_ in (RPM_INT8_TYPE, RPM_INT16_TYPE, RPM_INT32_TYPE, RPM_INT64_TYPE):
+            fmt = {
+                RPM_INT8_TYPE: "B",
+                RPM_INT16_TYPE: "H",
+                RPM_INT32_TYPE: "I",
+                RPM_INT64_TYPE: "Q",
+            }[type_]
+            size = struct.calcsize(fmt) * count
+            value = struct.unpack(f">{count}{fmt}", store[offset : offset + size])
+        elif type_ == RPM_BIN_TYPE:
+            value = store[offset : offset + count]
+        elif type_ in (RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE):
+            value = []
+            for _ in range(count):
+                end = store.index(b"\0", offset)
+                value.append(store[offset:end].decode("utf-8", "surrogateescape"))
+                offset = end + 1
+            if type_ == RPM_STRING_TYPE:
+                value = value[0]
+        else:
+            continue
+        header[tag] = value
+    return header
+
+
+def _read_rpm_headers(f):
+    """Read the lead, signature and main header of a RPM package."""
+    lead = f.read(RPM_LEAD_SIZE)
+    if lead[:4] != RPM_LEAD_MAGIC:
+        raise ValueError("Not a RPM package")
+    start = f.tell()
+    signature = _read_rpm_header(f)
+    # The signature header is aligned to 8 bytes
+    f.read(-(f.tell() - start) % 8)
+    return signature, _read_rpm_header(f)
+
+
+def _feed(f, pipe, errors):
+    """Copy the content of a file into a pipe, and close it.
+
+    The errors reading the file are appended to `errors`, so the
+    reader of the pipe can raise them.
+
+    """
+    try:
+        shutil.copyfileobj(f, pipe)
+    except BrokenPipeError:
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _drain(stream):
+    """Read the rest of a stream, so the decompressor checks the end."""
+    while stream.read(1024 * 1024):
+        pass
+
+
+@contextlib.contextmanager
+def _decompress(f, compressor):
+    """Stream that decompress the data of a file.
+
+    The archives end before the compressed stream, so the rest of the
+    stream is read at the end, and a truncated or corrupted stream is
+    detected by the decompressor.
+
+    """
+    if compressor == "gzip":
+        with gzip.GzipFile(fileobj=f) as stream:
+            yield stream
+            _drain(stream)
+    elif compressor in ("xz", "lzma"):
+        with lzma.LZMAFile(f) as stream:
+            yield stream
+            _drain(stream)
+    elif compressor == "bzip2":
+        with bz2.BZ2File(f) as stream:
+            yield stream
+            _drain(stream)
+    elif compressor == "zstd" and zstandard:
+        with zstandard.ZstdDecompressor().stream_reader(f) as stream:
+            yield stream
+            _drain(stream)
+    elif compressor == "zstd":
+        # Without the Python module, we use the zstd tool
+        cmd = ["zstd", "--decompress", "--stdout"]
+        with subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        ) as process:
+            errors = []
+            feeder = threading.Thread(target=_feed, args=(f, process.stdin, errors))
+            feeder.start()
+            yield process.stdout
+            _drain(process.stdout)
+            feeder.join()
+        if errors:
+            raise errors[0]
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+    elif compressor in ("none", None):
+        yield f
+    else:
+        raise ValueError(f"Compression {compressor} not supported")
+
+
+@contextlib.contextmanager
+def _compress(f, compressor, jobs=1):
+    """Stream that compress the data written into a file."""
+    if compressor == "gzip":
+        # Without timestamp and file name, so the output is
+        # reproducible
+        with gzip.GzipFile(filename="", fileobj=f, mode="wb", mtime=0) as stream:
+            yield stream
+    elif compressor == "xz":
+        with lzma.LZMAFile(f, "wb") as stream:
+            yield stream
+    elif compressor == "zstd" and zstandard:
+        compressor = zstandard.ZstdCompressor(threads=jobs if jobs > 1 else 0)
+        with compressor.stream_writer(f, closefd=False) as stream:
+            yield stream
+    elif compressor == "zstd":
+        # Without the Python module, we use the zstd tool
+        cmd = ["zstd", "--quiet", "--stdout", f"-T{jobs}"]
+        with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=f) as process:
+            yield process.stdin
+            process.stdin.close()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+    elif compressor in ("none", None):
+        yield f
+    else:
+        raise ValueError(f"Compression {compressor} not supported")
+
+
+def _read_cpio(f):
+    """Iterate over the entries of a cpio "newc" archive."""
+    # Hard links are stored with the data only in the last entry, so
+    # we delay the creation of the previous ones
+    links = {}
+    while True:
+        header = f.read(CPIO_HEADER_SIZE)
+        if len(header) != CPIO_HEADER_SIZE or header[:6] not in CPIO_MAGIC:
+            raise ValueError("Bad cpio header")
+        fields = [int(header[i : i + 8], 16) for i in range(6, CPIO_HEADER_SIZE, 8)]
+        ino, mode, _, _, nlink, mtime, size = fields[:7]
+        namesize = fields[11]
+        name = f.read(namesize)[:-1].decode("utf-8", "surrogateescape")
+        f.read(-(CPIO_HEADER_SIZE + namesize) % 4)
+        if name == "TRAILER!!!":
+            break
+
+        name = _entry_name(name)
+        data = _LimitedReader(f, size)
+        if stat.S_ISDIR(mode):
+            yield _Entry(name, "dir", mode, mtime, 0, None, None)
+        elif stat.S_ISLNK(mode):
+            linkname = data.read().decode("utf-8", "surrogateescape")
+            yield _Entry(name, "symlink", mode, mtime, 0, linkname, None)
+        elif stat.S_ISREG(mode):
+            if nlink > 1 and not size:
+                links.setdefault(ino, []).append((name, mode, mtime))
+            else:
+                yield _Entry(name, "file", mode, mtime, size, None, data)
+                # The data is still available if the file was removed
+                for link, mode, mtime in links.pop(ino, []):
+                    yield _Entry(link, "link", mode, mtime, size, name, data)
+        data.skip()
+        f.read(-size % 4)
+
+    # Hard links without data are empty files
+    for (name, mode, mtime), *rest in links.values():
+        data = _LimitedReader(f, 0)
+        yield _Entry(name, "file", mode, mtime, 0, None, data)
+        for link, mode, mtime in rest:
+            yield _Entry(link, "link", mode, mtime, 0, name, data)
+
+
+def _remove(path):
+    """Remove a file, a link or an empty directory, if present."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.rmdir(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+class _PathResolver:
+    """Resolve the paths of the packages against the links of the venv."""
+
+    def __init__(self, dest_dir):
+        self.root = os.path.realpath(dest_dir)
+        self._parents = {}
+
+    def directory(self, name):
+        """Path of a directory relative to the venv, following all the links."""
+        try:
+            return self._parents[name]
+        except KeyError:
+            real = os.path.realpath(os.path.join(self.root, name))
+            resolved = os.path.relpath(real, self.root)
+            if resolved.startswith(".."):
+                resolved = None
+            self._parents[name] = resolved
+            return resolved
+
+    def relpath(self, name):
+        """Path relative to the venv, following the links of the parents."""
+        parent, base = os.path.split(name)
+        resolved = self.directory(parent)
+        if resolved is None:
+            return None
+        return base if resolved == "." else os.path.join(resolved, base)
+
+    def invalidate(self):
+        """Forget the resolved paths, after the creation of a link."""
+        self._parents.clear()
+
+
+class _Pruner(_PathResolver):
+    """Remove list applied during the extraction of the packages.
+
+    The removed links are created anyway, so the entries below them
+    are placed in the target of the link, like if the packages were
+    extracted before removing the files.  All the removed paths are
+    deleted when the extraction finishes.
+
+    """
+
+    def __init__(self, dest_dir, remove):
+        super().__init__(dest_dir)
+        self.dest_dir = str(dest_dir)
+        self.remove = remove
+        # Removed paths, like they are logged after walking the tree
+        self.removed = set()
+
+    def check(self, name):
+        """Return True if the entry is removed, logging the matches."""
+        relpath = self.relpath(name) if name else None
+        if not relpath:
+            return False
+        # The entry is removed if a parent directory is removed
+        removed = False
+        prefix = ""
+        for part in relpath.split("/"):
+            prefix = f"{prefix}/{part}" if prefix else part
+            if prefix in self.remove:
+                self.removed.add(os.path.join(self.dest_dir, prefix))
+                removed = True
+        return removed
+
+    def link(self, name, target):
+        """Create a removed link, that is deleted by `finish`."""
+        path = os.path.join(self.dest_dir, self.relpath(name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _remove(path)
+        os.symlink(target, path)
+        self.invalidate()
+
+    def finish(self):
+        """Delete the removed paths created during the extraction."""
+        for path in sorted(self.removed):
+            if os.path.isdir(path) and not os.path.islink(path):
+                _rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+        self.invalidate()
+
+
+def _copy_hashed(src, dst):
+    """Copy the content of a stream, and return the SHA256 of the data."""
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+        sha256.update(chunk)
+        dst.write(chunk)
+    return sha256.hexdigest()
+
+
+def _write_entries(directory, entries, pruner=None, stats=None, manifest=None):
+    """Write the entries of a package inside a directory.
+
+    Return the hard links that are not written because the file with
+    the data was removed, and the data was not available.  The files
+    and directories written are recorded in `manifest`, with the hash
+    of the data.
+
+    """
+    # Like cpio and tar, the existing files are replaced, the links to
+    # directories are followed, and the permissions and modification
+    # time of the directories are set at the end
+    directories = []
+    # Removed files, and the first hard link that replaces them
+    removed = {}
+    orphans = {}
+    for entry in entries:
+        if pruner and pruner.check(entry.name):
+            if entry.kind == "file":
+                removed[entry.name] = None
+            elif entry.kind == "symlink":
+                pruner.link(entry.name, entry.linkname)
+            continue
+        if entry.kind == "link" and entry.linkname in removed:
+            if removed[entry.linkname]:
+                entry = entry._replace(linkname=removed[entry.linkname])
+            elif entry.fileobj:
+                entry = entry._replace(kind="file")
+                removed[entry.linkname] = entry.name
+            else:
+                orphans.setdefault(entry.linkname, []).append(entry)
+                continue
+
+        path = os.path.join(directory, entry.name)
+        if entry.kind == "dir":
+            if not os.path.isdir(path):
+                _remove(path)
+                os.makedirs(path)
+            if not os.path.islink(path.rstrip("/")):
+                directories.append((path, entry))
+            elif manifest is not None:
+                manifest.append((entry.name, os.stat(path), None))
+            continue
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _remove(path)
+        digest = None
+        if entry.kind == "file":
+            with open(path, "wb") as f:
+                if manifest is None:
+                    shutil.copyfileobj(entry.fileobj, f)
+                else:
+                    digest = _copy_hashed(entry.fileobj, f)
+                if stats is not None:
+                    stats["bytes"] += f.tell()
+            os.chmod(path, stat.S_IMODE(entry.mode))
+            os.utime(path, (entry.mtime, entry.mtime))
+        elif entry.kind == "symlink":
+            os.symlink(entry.linkname, path)
+            os.utime(path, (entry.mtime, entry.mtime), follow_symlinks=False)
+            if pruner:
+                pruner.invalidate()
+        elif entry.kind == "link":
+            os.link(os.path.join(directory, entry.linkname), path)
+        if stats is not None:
+            stats["files"] += 1
+        if manifest is not None:
+            manifest.append((entry.name, os.lstat(path), digest))
+
+    for path, entry in reversed(directories):
+        os.chmod(path, stat.S_IMODE(entry.mode))
+        os.utime(path, (entry.mtime, entry.mtime))
+        if manifest is not None:
+            manifest.append((entry.name, os.lstat(path), None))
+    return orphans
+
+
+def _orphan_entries(entries, orphans):
+    """Iterate over the hard links that lost the file with the data."""
+    for entry in entries:
+        if entry.kind == "file" and entry.name in orphans:
+            first, *rest = orphans[entry.name]
+            yield first._replace(kind="file", fileobj=entry.fileobj)
+            for link in rest:
+                yield link._replace(linkname=first.name)
+
+
+def _extract_rpm(package, directory, pruner=None, stats=None, manifest=None):
+    """Extract the payload of a RPM package inside a directory."""
+    with open(package, "rb") as f:
+        _, header = _read_rpm_headers(f)
+        if header.get(RPMTAG_PAYLOADFORMAT, "cpio") != "cpio":
+            raise ValueError("Payload format not supported")
+        compressor = header.get(RPMTAG_PAYLOADCOMPRESSOR, "gzip")
+        with _decompress(f, compressor) as payload:
+            _write_entries(directory, _read_cpio(payload), pruner, stats, manifest)
+    return header
+
+
+def _read_ar(f):
+    """Iterate over the members of an ar archive."""
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError("Not an ar archive")
+    while True:
+        header = f.read(60)
+        if not header:
+            break
+        if len(header) != 60 or header[58:] != b"`\n":
+            raise ValueError("Bad ar header")
+        name = header[:16].decode("utf-8").rstrip().rstrip("/")
+        size = int(header[48:58])
+        data = _LimitedReader(f, size)
+        yield name, data
+        data.skip()
+        # The members are aligned to 2 bytes
+        f.read(size % 2)
+
+
+def _read_tar(f):
+    """Iterate over the entries of a tar stream."""
+    with tarfile.open(fileobj=f, mode="r|") as tar:
+        for info in tar:
+            name = _entry_name(info.name)
+            if info.isdir():
+                yield _Entry(name, "dir", info.mode, info.mtime, 0, None, None)
+            elif info.issym():
+                yield _Entry(
+                    name, "symlink", info.mode, info.mtime, 0, info.linkname, None
+                )
+            elif info.islnk():
+                linkname = _entry_name(info.linkname)
+                yield _Entry(name, "link", info.mode, info.mtime, 0, linkname, None)
+            elif info.isreg():
+                yield _Entry(
+                    name,
+                    "file",
+                    info.mode,
+                    info.mtime,
+                    info.size,
+                    None,
+                    tar.extractfile(info),
+                )
+
+
+# Compressors of the members of a Debian package
+DEB_COMPRESSORS = {
+    "": None,
+    ".gz": "gzip",
+    ".xz": "xz",
+    ".lzma": "lzma",
+    ".bz2": "bzip2",
+    ".zst": "zstd",
+}
+
+
+def _deb_member(name, data):
+    """Context manager that decompress a member of a Debian package."""
+    suffix = name.split(".tar", 1)[1]
+    return _decompress(data, DEB_COMPRESSORS.get(suffix, suffix))
+
+
+def _parse_control(text):
+    """Parse the fields of a Debian control file."""
+    fields = {}
+    key = None
+    for line in text.splitlines():
+        if line.startswith((" ", "\t")) and key:
+            fields[key] += "\n" + line.strip()
+        elif ":" in line:
+            key, value = line.split(":", 1)
+            fields[key] = value.strip()
+    return fields
+
+
+def _read_deb_control(name, data):
+    """Read the control file from the control member of a package."""
+    with _deb_member(name, data) as member, tarfile.open(
+        fileobj=member, mode="r|"
+    ) as tar:
+        for info in tar:
+            if info.isreg() and _entry_name(info.name) == "control":
+                return _parse_control(tar.extractfile(info).read().decode("utf-8"))
+    raise ValueError("Control file not found")
+
+
+def _read_deb_headers(f):
+    """Read the control fields of a Debian package."""
+    for name, data in _read_ar(f):
+        if name.startswith("control.tar"):
+            return _read_deb_control(name, data)
+    raise ValueError("Control member not found")
+
+
+def _read_deb_data(f):
+    """Iterate over the entries of the data member of a Debian package."""
+    for name, data in _read_ar(f):
+        if name.startswith("data.tar"):
+            with _deb_member(name, data) as payload:
+                yield from _read_tar(payload)
+            return
+    raise ValueError("Data member not found")
+
+
+def _extract_deb(package, directory, pruner=None, stats=None, manifest=None):
+    """Extract the data of a Debian package inside a directory."""
+    with open(package, "rb") as f:
+        control = _read_deb_headers(f)
+    with open(package, "rb") as f:
+        entries = _read_deb_data(f)
+        orphans = _write_entries(directory, entries, pruner, stats, manifest)
+    if orphans:
+        # The data of some hard links was in a removed file, that we
+        # need to read again
+        with open(package, "rb") as f:
+            entries = _orphan_entries(_read_deb_data(f), orphans)
+            _write_entries(directory, entries, stats=stats, manifest=manifest)
+    return control
+
+
+def _extract(package, directory, pruner=None, stats=None, manifest=None):
+    """Extract the content of a package, and return the headers."""
+    if package.suffix == ".rpm":
+        return _extract_rpm(package, directory, pruner, stats, manifest)
+    elif package.suffix == ".deb":
+        return _extract_deb(package, directory, pruner, stats, manifest)
+
+
+def _read_headers(package):
+    """Read the headers of a package, without reading the payload."""
+    with open(package, "rb") as f:
+        if package.suffix == ".rpm":
+            return _read_rpm_headers(f)[1]
+        elif package.suffix == ".deb":
+            return _read_deb_headers(f)
+
+
+def _make_writable(path):
+    """Add write permission for the owner to a directory."""
+    mode = stat.S_IMODE(os.lstat(path).st_mode)
+    if not mode & stat.S_IWUSR:
+        os.chmod(path, mode | stat.S_IWUSR)
+    return mode
+
+
+def _prune(path, name, pruner):
+    """Check a staged entry against the remove list, logging the content."""
+    if not pruner.check(name):
+        return False
+    if os.path.islink(path):
+        pruner.link(name, os.readlink(path))
+    elif os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for child in itertools.chain(dirnames, filenames):
+                child_path = os.path.join(dirpath, child)
+                child = os.path.join(name, os.path.relpath(child_path, path))
+                pruner.check(child)
+                if os.path.islink(child_path):
+                    pruner.link(child, os.readlink(child_path))
+    return True
+
+
+def _prune_staged(path, name, pruner):
+    """Remove the entries of a staged directory that are in the remove list."""
+    mode = _make_writable(path)
+    for entry in os.scandir(path):
+        child = f"{name}/{entry.name}"
+        if _prune(entry.path, child, pruner):
+            if entry.is_dir(follow_symlinks=False):
+                _rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+        elif entry.is_dir(follow_symlinks=False):
+            _prune_staged(entry.path, child, pruner)
+    os.chmod(path, mode)
+
+
+def _merge_tree(src, dst, pruner=None, prefix=""):
+    """Move the content of `src` into `dst`, overwriting like cpio."""
+    _make_writable(src)
+    for entry in os.scandir(src):
+        name = prefix + entry.name
+        target = os.path.join(dst, entry.name)
+        is_dir = entry.is_dir(follow_symlinks=False)
+        # A directory merged with an existing one (that can be a
+        # removed link) is pruned entry by entry.  The removed links
+        # inside a new directory can create the directory
+        if pruner and not (is_dir and os.path.isdir(target)):
+            if _prune(entry.path, name, pruner):
+                continue
+            if is_dir:
+                _prune_staged(entry.path, name, pruner)
+
+        if is_dir and os.path.isdir(target):
+            # Keep the existing directory (or link to a directory)
+            # and merge the content, like `--keep-directory-symlink`
+            _merge_tree(entry.path, target, pruner, name + "/")
+            continue
+
+        if os.path.isdir(target) and not os.path.islink(target):
+            # Only empty directories can be replaced
+            os.rmdir(target)
+        elif is_dir and os.path.lexists(target):
+            os.unlink(target)
+
+        if is_dir:
+            # Moving a directory needs to update the `..` entry
+            mode = _make_writable(entry.path)
+            os.replace(entry.path, target)
+            os.chmod(target, mode)
+        else:
+            os.replace(entry.path, target)
+            if pruner and entry.is_symlink():
+                pruner.invalidate()
+
+
+def _rmtree(path):
+    """Remove a tree, including the read only directories."""
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames:
+            _make_writable(os.path.join(dirpath, name))
+    shutil.rmtree(path)
+
+
+def _copy_file(src, dst, link="copy"):
+    """Copy a file, using a hard link or a reflink if possible."""
+    if link == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    if link in ("hardlink", "reflink"):
+        try:
+            with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            pass
+        else:
+            shutil.copystat(src, dst)
+            return
+    shutil.copy2(src, dst)
+
+
+def _copy_tree(
+    src, dst, link="copy", pruner=None, prefix="", stats=None, manifest=None
+):
+    """Copy the content of `src` into `dst`, overwriting like cpio."""
+    for entry in os.scandir(src):
+        name = prefix + entry.name
+        target = os.path.join(dst, entry.name)
+        is_dir = entry.is_dir(follow_symlinks=False)
+        # A directory merged with an existing one (that can be a
+        # removed link) is pruned entry by entry
+        if pruner and not (is_dir and os.path.isdir(target)):
+            if _prune(entry.path, name, pruner):
+                continue
+
+        if is_dir:
+            # Keep the existing directory (or link to a directory)
+            # and copy the content, like `--keep-directory-symlink`
+            args = (link, pruner, name + "/", stats, manifest)
+            if os.path.isdir(target):
+                _copy_tree(entry.path, target, *args)
+            else:
+                _remove(target)
+                os.mkdir(target)
+                _copy_tree(entry.path, target, *args)
+                shutil.copystat(entry.path, target)
+            if manifest is not None:
+                manifest.append((name, os.stat(target), None))
+            continue
+
+        _remove(target)
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), target)
+            shutil.copystat(entry.path, target, follow_symlinks=False)
+            if pruner:
+                pruner.invalidate()
+        else:
+            _copy_file(entry.path, target, link)
+            if stats is not None:
+                stats["bytes"] += entry.stat().st_size
+        if stats is not None:
+            stats["files"] += 1
+        if manifest is not None:
+            # The hash is calculated later
+            manifest.append((name, os.lstat(target), None))
+
+
+def _checksum(filename):
+    """Return the SHA256 of a file."""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _size(value):
+    """Parse a size, like 512M or 10G, into bytes."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def _jobs(value):
+    """Parse a number of jobs, that must be at least one."""
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {jobs}")
+    return jobs
+
+
+class PackageCache:
+    """Cache of extracted packages, indexed by the package checksum."""
+
+    def __init__(self, directory, max_size=None, link="reflink"):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.link = link
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def get(self, package):
+        """Return the extracted tree of a package, extracting it if needed."""
+        entry = self.directory / _checksum(package)
+        if not entry.is_dir():
+            # Extract in a temporary directory and rename it, so
+            # incomplete entries are never visible
+            tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+            try:
+                tree = os.path.join(tmp, "tree")
+                os.mkdir(tree)
+                _extract(package, tree)
+                with open(os.path.join(tmp, "info"), "w") as f:
+                    print(package.name, _tree_size(tree), file=f)
+                os.rename(tmp, entry)
+            except OSError:
+                # Other build can store the same package at the same
+                # time
+                if not entry.is_dir():
+                    raise
+            finally:
+                if os.path.exists(tmp):
+                    _rmtree(tmp)
+        # The modification time is used as the last access time
+        os.utime(entry)
+        return entry / "tree"
+
+    def entries(self):
+        """Return the entries of the cache, the least recently used first."""
+        entries = []
+        for entry in self.directory.iterdir():
+            if entry.name.startswith(".") or not (entry / "info").exists():
+                continue
+            name, size = (entry / "info").read_text().split()
+            entries.append((entry.stat().st_mtime, entry, name, int(size)))
+        return sorted(entries)
+
+    def prune(self, max_size=None):
+        """Remove the least recently used entries, and return them."""
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(size for _, _, _, size in entries)
+        removed = []
+        for _, entry, name, size in entries:
+            if total <= max_size:
+                break
+            _rmtree(entry)
+            total -= size
+            removed.append((name, size))
+        return removed
+
+
+def _tree_size(path):
+    """Return the size of all the files of a tree."""
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+def _cpu_time():
+    """CPU time of the process, including the finished subprocesses."""
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+class Timings:
+    """Wall and CPU time of the phases and packages of `create`."""
+
+    def __init__(self):
+        self.phases = []
+        self.packages = {}
+        self._stack = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure a phase, nested phases are named like `parent/name`."""
+        self._stack.append(name)
+        record = {"name": "/".join(self._stack)}
+        self.phases.append(record)
+        wall, cpu = time.perf_counter(), _cpu_time()
+        try:
+            yield
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = _cpu_time() - cpu
+            self._stack.pop()
+
+    @contextlib.contextmanager
+    def package(self, name):
+        """Measure the work done for a package in the current thread."""
+        stats = collections.Counter()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield stats
+        finally:
+            stats["wall"] = time.perf_counter() - wall
+            stats["cpu"] = time.thread_time() - cpu
+            # A package can be measured in more than one thread
+            with self._lock:
+                self.packages.setdefault(name, collections.Counter()).update(stats)
+
+    def report(self, file=sys.stdout):
+        """Print the phases, and the packages sorted by wall time."""
+        print(f"{'Phase':<40} {'Wall (s)':>10} {'CPU (s)':>10}", file=file)
+        for record in self.phases:
+            depth = record["name"].count("/")
+            name = "  " * depth + record["name"].rsplit("/", 1)[-1]
+            print(f"{name:<40} {record['wall']:10.3f} {record['cpu']:10.3f}", file=file)
+        total = sum(r["wall"] for r in self.phases if "/" not in r["name"])
+        print(f"{'Total':<40} {total:10.3f}", file=file)
+
+        print(file=file)
+        print(
+            f"{'Package':<40} {'Wall (s)':>10} {'CPU (s)':>10} "
+            f"{'Files':>8} {'Bytes':>12}",
+            file=file,
+        )
+        packages = sorted(self.packages.items(), key=lambda i: -i[1]["wall"])
+        for name, record in packages:
+            print(
+                f"{name:<40} {record['wall']:10.3f} {record['cpu']:10.3f} "
+                f"{record['files']:8} {record['bytes']:12}",
+                file=file,
+            )
+
+    def to_json(self):
+        """Return the timings as a JSON serializable dict."""
+        packages = [
+            {"name": name, **{k: record[k] for k in ("wall", "cpu", "files", "bytes")}}
+            for name, record in self.packages.items()
+        ]
+        return {"phases": self.phases, "packages": packages}
+
+
+def _phase(timings, name):
+    """Measure a phase, if the timings are collected."""
+    return timings.phase(name) if timings else contextlib.nullcontext()
+
+
+def _measure(timings, name):
+    """Measure a package, if the timings are collected."""
+    return timings.package(name) if timings else contextlib.nullcontext()
+
+
+def _visit_manifest(entry, relpath, entries):
+    """Visitor that collect all the entries, and the stat data."""
+    entries.append((relpath, entry.stat(follow_symlinks=False)))
+    return True
+
+
+def _owners(entry):
+    """Return the packages that wrote an entry of the manifest, in order."""
+    if "owners" in entry:
+        return entry["owners"]
+    if "conflicts" in entry:
+        return entry["conflicts"]
+    return [entry["package"]] if entry["package"] else []
+
+
+def _source_path(relpath):
+    """Return the path of the file used by the fixes to create another."""
+    dirname, name = os.path.split(relpath)
+    # Renamed systemd services
+    if name.startswith("venv-") and name.endswith(".service"):
+        return os.path.join(dirname, name[len("venv-") :])
+    # Interpreters replaced by the loader
+    if dirname == "bin" and name.endswith(".original"):
+        return os.path.join(dirname, name[: -len(".original")])
+    # Compiled modules
+    if os.path.basename(dirname) == "__pycache__" and name.endswith(".pyc"):
+        return os.path.join(os.path.dirname(dirname), name.split(".")[0] + ".py")
+    return None
+
+
+class Manifest:
+    """Files installed by each package, and the hash of the content."""
+
+    def __init__(self):
+        self.records = {}
+
+    def package(self, name):
+        """Return the list where the files of a package are recorded."""
+        return self.records.setdefault(name, [])
+
+    def build(self, dest_dir, packages, jobs=1, previous=None):
+        """Return the manifest of the venv, and the overwritten paths.
+
+        The hashes computed during the extraction are reused if the
+        file was not changed later by the fixes.  With `previous` (the
+        entries of the last manifest of an updated venv, by path) the
+        paths that are not written again keep the owners and hashes.
+
+        """
+        # The paths of the packages are resolved after the
+        # extraction, when all the links are in place
+        resolver = _PathResolver(dest_dir)
+        order = {package: n for n, package in enumerate(packages)}
+
+        # All the packages that write a path, in order.  The last one
+        # is the owner
+        writers = collections.defaultdict(list)
+        directories = set()
+        inodes = {}
+        digests = {}
+        for package in packages:
+            for name, st, digest in self.records.get(package, ()):
+                if stat.S_ISDIR(st.st_mode):
+                    # The directories can be links in the venv
+                    path = resolver.directory(name)
+                else:
+                    path = resolver.relpath(name)
+                if not path or path == ".":
+                    continue
+                if package not in writers[path]:
+                    writers[path].append(package)
+                if stat.S_ISDIR(st.st_mode):
+                    directories.add(path)
+                    continue
+                key = (st.st_dev, st.st_ino)
+                inodes[key] = (st.st_mtime_ns, st.st_size, package)
+                if digest:
+                    digests[key] = (st.st_mtime_ns, st.st_size, digest)
+        written = set(writers)
+        previous = previous or {}
+        for path, entry in previous.items():
+            owners = [package for package in _owners(entry) if package in order]
+            if owners:
+                owners = set(owners).union(writers.get(path, ()))
+                writers[path] = sorted(owners, key=order.get)
+            if stat.S_ISDIR(int(entry["mode"], 8)):
+                directories.add(path)
+        conflicts = {
+            path: packages
+            for path, packages in writers.items()
+            if len(packages) > 1 and path not in directories
+        }
+
+        def _entry(item):
+            relpath, st = item
+            key = (st.st_dev, st.st_ino)
+            package = writers[relpath][-1] if relpath in writers else None
+            if not package and key in inodes:
+                # Renamed files are owned by the package that installed
+                # the file, if the inode was not reused
+                mtime, size, package = inodes[key]
+                if (mtime, size) != (st.st_mtime_ns, st.st_size):
+                    package = None
+            if not package and _source_path(relpath) in writers:
+                # Files created by the fixes, like the compiled modules
+                package = writers[_source_path(relpath)][-1]
+            entry = {"path": relpath, "package": package, "mode": f"{st.st_mode:o}"}
+            if stat.S_ISDIR(st.st_mode):
+                if len(writers.get(relpath, ())) > 1:
+                    entry["owners"] = writers[relpath]
+                return entry
+
+            entry["size"] = st.st_size
+            entry["mtime"] = int(st.st_mtime)
+            old = previous.get(relpath, {})
+            if stat.S_ISLNK(st.st_mode):
+                entry["target"] = os.readlink(os.path.join(dest_dir, relpath))
+            elif stat.S_ISREG(st.st_mode):
+                cached = digests.get(key)
+                if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+                    entry["sha256"] = cached[2]
+                elif (
+                    relpath not in written
+                    and "sha256" in old
+                    and (old["size"], old["mtime"]) == (entry["size"], entry["mtime"])
+                ):
+                    entry["sha256"] = old["sha256"]
+                else:
+                    entry["sha256"] = _checksum(os.path.join(dest_dir, relpath))
+            if relpath in conflicts:
+                entry["conflicts"] = conflicts[relpath]
+            return entry
+
+        items = []
+        _walk_tree(dest_dir, [functools.partial(_visit_manifest, entries=items)])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            entries = list(executor.map(_entry, sorted(items)))
+        return entries, conflicts
+
+
+def _package_stamp(package):
+    """Return the data used to detect the changes of a package."""
+    st = package.stat()
+    return {"name": package.name, "size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def _manifest_ignored(dest_dir, filename):
+    """Return the paths of the venv that are not part of the manifest."""
+    ignored = {"packages.log"}
+    relpath = os.path.relpath(os.path.abspath(filename), os.path.abspath(dest_dir))
+    if not relpath.startswith(".."):
+        ignored.add(relpath)
+    return ignored
+
+
+# Options of `create` that change the content of the venv
+BUILD_OPTIONS = (
+    "system_site_packages",
+    "python_version",
+    "relocate",
+    "no_relocate_shebang_list",
+    "loader",
+    "import_index",
+    "strip",
+    "runpath",
+    "compile",
+    "invalidation_mode",
+    "dedup",
+)
+
+
+def _build_options(args, remove):
+    """Return the options that change the content of the venv."""
+    options = {name: getattr(args, name) for name in BUILD_OPTIONS}
+    options["relocate"] = str(options["relocate"])
+    options["dest_dir"] = str(args.dest_dir)
+    # The remove list is compared by the expressions, not the comments
+    patterns = "\n".join(item.pattern for item in remove.items)
+    options["remove"] = hashlib.sha256(patterns.encode()).hexdigest()
+    return options
+
+
+def _write_manifest(filename, dest_dir, packages, venv, options, entries):
+    """Write the manifest, after a header with the packages, the venv
+    and the build options."""
+    # The header is used to update the venv later
+    header = {"packages": [_package_stamp(package) for package in packages]}
+    header["venv"] = venv
+    header["options"] = options
+    ignored = _manifest_ignored(dest_dir, filename)
+    with filename.open("w") as f:
+        print(json.dumps(header), file=f)
+        for entry in entries:
+            if entry["path"] not in ignored:
+                print(json.dumps(entry), file=f)
+
+
+def _read_manifest(filename):
+    """Return the header and the entries of a manifest."""
+    with filename.open() as f:
+        entries = [json.loads(line) for line in f]
+    if entries and "path" not in entries[0]:
+        return entries[0], entries[1:]
+    return {}, entries
+
+
+# Compression of the archives, by extension
+ARCHIVE_COMPRESSORS = {
+    ".tar": "none",
+    ".tar.gz": "gzip",
+    ".tgz": "gzip",
+    ".tar.xz": "xz",
+    ".txz": "xz",
+    ".tar.zst": "zstd",
+    ".tzst": "zstd",
+}
+
+
+def _archive_compressor(filename):
+    """Return the compression of an archive, from the name of the file."""
+    for suffix, compressor in ARCHIVE_COMPRESSORS.items():
+        if filename.name.endswith(suffix):
+            return compressor
+    raise ValueError(f"Format of the archive {filename} not supported")
+
+
+def _write_archive(
+    dest_dir, filename, paths=None, prefix=None, mtime=None, owner=False, jobs=1
+):
+    """Write the venv into a compressed tar archive.
+
+    The entries are read from the tree in one pass, and compressed
+    while the archive is written.  If `paths` (like the ones of the
+    manifest) is not provided, the tree is walked.  Return the number
+    of entries of the archive.
+
+    """
+    if paths is None:
+        items = []
+        _walk_tree(dest_dir, [functools.partial(_visit_manifest, entries=items)])
+        paths = [relpath for relpath, _ in items]
+    if prefix is None:
+        prefix = os.path.basename(os.path.abspath(dest_dir))
+
+    compressor = _archive_compressor(filename)
+    with filename.open("wb") as f, _compress(f, compressor, jobs) as stream:
+        # In stream mode the data is never read back, and the GNU
+        # format does not store the fraction of the modification time
+        with tarfile.open(
+            fileobj=stream, mode="w|", format=tarfile.GNU_FORMAT
+        ) as archive:
+            for relpath in itertools.chain([""], paths):
+                path = os.path.join(dest_dir, relpath)
+                arcname = os.path.join(prefix, relpath).rstrip("/") or "."
+                info = archive.gettarinfo(path, arcname)
+                if not info:
+                    # Sockets are not archived
+                    continue
+                if mtime is not None:
+                    info.mtime = mtime
+                if owner:
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = "root"
+                if info.isreg():
+                    with open(path, "rb") as data:
+                        archive.addfile(info, data)
+                else:
+                    archive.addfile(info)
+    return len(paths) + 1
+
+
+def _archive_paths(dest_dir, manifest, sort=False):
+    """Return the paths to archive, from the manifest or sorted if requested."""
+    if manifest:
+        # The manifest is sorted, and do not include the log
+        _, entries = _read_manifest(manifest)
+        paths = [entry["path"] for entry in entries]
+        if os.path.exists(os.path.join(dest_dir, "packages.log")):
+            paths.append("packages.log")
+        return sorted(paths)
+    if sort:
+        items = []
+        _walk_tree(dest_dir, [functools.partial(_visit_manifest, entries=items)])
+        return sorted(relpath for relpath, _ in items)
+    return None
+
+
+def _record(manifest, package):
+    """Return the list where the files of a package are recorded, if any."""
+    return manifest.package(package.name) if manifest else None
+
+
+def _extract_packages(
+    packages, dest_dir, jobs=1, cache=None, pruner=None, timings=None, manifest=None
+):
+    """Extract the packages in order, and return the headers and failures."""
+    headers = {}
+    failed = []
+    if jobs <= 1 and not cache:
+        for package in packages:
+            try:
+                with _measure(timings, package.name) as stats:
+                    headers[package.name] = _extract(
+                        package, dest_dir, pruner, stats, _record(manifest, package)
+                    )
+            except Exception as e:
+                failed.append((package, e))
+        return headers, failed
+
+    # Each package is extracted in parallel in its own staging
+    # directory (inside `dest_dir`, so we can move the files), or in
+    # the cache, and installed in the same order used by the serial
+    # extraction.  This way, if two packages provide the same file,
+    # the last one wins.
+    staging = None if cache else tempfile.mkdtemp(prefix=".staging-", dir=dest_dir)
+    pending = collections.deque()
+
+    def _prepare(n, package):
+        with _measure(timings, package.name) as stats:
+            if cache:
+                return cache.get(package), None
+            staged = os.path.join(staging, str(n))
+            os.mkdir(staged)
+            return staged, _extract(
+                package, staged, stats=stats, manifest=_record(manifest, package)
+            )
+
+    def _install_next():
+        package, future = pending.popleft()
+        try:
+            tree, header = future.result()
+            if header:
+                headers[package.name] = header
+            with _measure(timings, package.name) as stats:
+                if cache:
+                    _copy_tree(
+                        tree,
+                        dest_dir,
+                        cache.link,
+                        pruner,
+                        stats=stats,
+                        manifest=_record(manifest, package),
+                    )
+                else:
+                    _merge_tree(tree, dest_dir, pruner)
+        except Exception as e:
+            failed.append((package, e))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for n, package in enumerate(packages):
+                future = executor.submit(_prepare, n, package)
+                pending.append((package, future))
+                # Limit the number of extracted packages waiting to be
+                # installed
+                if len(pending) > 2 * jobs:
+                    _install_next()
+            while pending:
+                _install_next()
+    finally:
+        if staging:
+            _rmtree(staging)
+    return headers, failed
+
+
+def _get_rpm_track_info(header):
+    tags = (
+        RPMTAG_NAME,
+        RPMTAG_EPOCH,
+        RPMTAG_VERSION,
+        RPMTAG_RELEASE,
+        RPMTAG_ARCH,
+        RPMTAG_DISTURL,
+    )
+    # Like `rpm -qp --queryformat`, missing tags are shown as "(none)"
+    values = []
+    for tag in tags:
+        value = header.get(tag, "(none)")
+        if isinstance(value, tuple):
+            value = value[0]
+        values.append(str(value))
+    return "|".join(values)
+
+
+def _get_deb_track_info(control):
+    fields = (
+        control.get("Package", ""),
+        "None",
+        control.get("Version", ""),
+        "None",
+        control.get("Architecture", ""),
+        "None",
+        "None",
+    )
+    return "|".join(fields)
+
+
+def _get_track_info(package, headers):
+    if package.suffix == ".rpm":
+        return _get_rpm_track_info(headers)
+    elif package.suffix == ".deb":
+        return _get_deb_track_info(headers)
+    return "|".join(["None"] * 7)
+
+
+def _get_rpm_deps(header):
+    """Return the name, provides and requires of a RPM package."""
+    name = header.get(RPMTAG_NAME)
+    provides = [name, *header.get(RPMTAG_PROVIDENAME, ())]
+    # The requirements are a list of alternatives, like in Debian
+    requires = [
+        [require]
+        for require in header.get(RPMTAG_REQUIRENAME, ())
+        if not require.startswith(("rpmlib(", "config("))
+    ]
+    return name, provides, requires
+
+
+def _get_rpm_files(header):
+    """Return the files of a RPM package."""
+    dirnames = header.get(RPMTAG_DIRNAMES, ())
+    return [
+        dirnames[index] + basename
+        for basename, index in zip(
+            header.get(RPMTAG_BASENAMES, ()), header.get(RPMTAG_DIRINDEXES, ())
+        )
+    ]
+
+
+def _get_deb_deps(control):
+    """Return the name, provides and requires of a Debian package."""
+
+    def _names(field):
+        # Drop the version and the architecture qualifiers
+        return [
+            [re.split(r"[\s(:]", alt.strip(), 1)[0] for alt in dep.split("|")]
+            for dep in field.split(",")
+            if dep.strip()
+        ]
+
+    name = control.get("Package")
+    provides = [name] + [p for (p,) in _names(control.get("Provides", ""))]
+    requires = _names(control.get("Pre-Depends", "")) + _names(
+        control.get("Depends", "")
+    )
+    return name, provides, requires
+
+
+def _get_rpm_file_entries(header):
+    """Return the path, mode, size and link target of the files of a RPM."""
+    paths = _get_rpm_files(header)
+    modes = header.get(RPMTAG_FILEMODES, ())
+    sizes = header.get(RPMTAG_LONGFILESIZES) or header.get(RPMTAG_FILESIZES, ())
+    targets = header.get(RPMTAG_FILELINKTOS, ())
+    entries = itertools.zip_longest(paths, modes, sizes, targets)
+    return [
+        (path, mode, size, target or None)
+        for path, mode, size, target in itertools.islice(entries, len(paths))
+    ]
+
+
+def _get_deb_file_entries(f):
+    """Return the path, mode, size and link target of the files of a deb."""
+    types = {"dir": stat.S_IFDIR, "symlink": stat.S_IFLNK}
+    return [
+        (
+            "/" + entry.name,
+            types.get(entry.kind, stat.S_IFREG) | stat.S_IMODE(entry.mode),
+            entry.size,
+            entry.linkname if entry.kind == "symlink" else None,
+        )
+        for entry in _read_deb_data(f)
+        if entry.name
+    ]
+
+
+def _package_files(package):
+    """Return the files of a package, reading only the headers of the data."""
+    with open(package, "rb") as f:
+        if package.suffix == ".rpm":
+            return _get_rpm_file_entries(_read_rpm_headers(f)[1])
+        return _get_deb_file_entries(f)
+
+
+def _read_all_headers(packages, jobs=1):
+    """Read the headers of the packages in parallel."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            package: executor.submit(_read_headers, package) for package in packages
+        }
+    headers = {}
+    failed = []
+    for package, future in futures.items():
+        try:
+            headers[package.name] = future.result()
+        except Exception as e:
+            failed.append((package, e))
+    return headers, failed
+
+
+def _index_package(package):
+    """Read the metadata of a package stored in the repository index."""
+    with open(package, "rb") as f:
+        if package.suffix == ".rpm":
+            _, header = _read_rpm_headers(f)
+            payload_size = os.fstat(f.fileno()).st_size - f.tell()
+            files = _get_rpm_file_entries(header)
+            header = {tag: header[tag] for tag in INDEX_TAGS if tag in header}
+            name, arch = header.get(RPMTAG_NAME), header.get(RPMTAG_ARCH)
+            epoch = header.get(RPMTAG_EPOCH, (None,))[0]
+            version, release = header.get(RPMTAG_VERSION), header.get(RPMTAG_RELEASE)
+            disturl = header.get(RPMTAG_DISTURL)
+        else:
+            header = _read_deb_headers(f)
+            f.seek(0)
+            payload_size = None
+            for member, data in _read_ar(f):
+                if member.startswith("data.tar"):
+                    payload_size = data.remaining
+            f.seek(0)
+            files = _get_deb_file_entries(f)
+            name, arch = header.get("Package"), header.get("Architecture")
+            # The Debian version is `[epoch:]upstream[-revision]`
+            epoch, version, release = re.match(
+                r"(?:(\d+):)?(.*?)(?:-([^-]*))?$", header.get("Version", "")
+            ).groups()
+            disturl = None
+    return {
+        "name": name,
+        "epoch": epoch,
+        "version": version,
+        "release": release,
+        "arch": arch,
+        "disturl": disturl,
+        "checksum": _checksum(package),
+        "payload_size": payload_size,
+        "header": json.dumps(header),
+        "files": files,
+    }
+
+
+class RepoIndex:
+    """Persistent index of the packages of a repository, in SQLite."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS packages (
+        filename TEXT PRIMARY KEY,
+        mtime INTEGER,
+        size INTEGER,
+        name TEXT,
+        epoch TEXT,
+        version TEXT,
+        release TEXT,
+        arch TEXT,
+        disturl TEXT,
+        checksum TEXT,
+        payload_size INTEGER,
+        header TEXT
+    );
+    CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+    CREATE TABLE IF NOT EXISTS files (
+        filename TEXT REFERENCES packages (filename) ON DELETE CASCADE,
+        path TEXT,
+        mode INTEGER,
+        size INTEGER,
+        target TEXT
+    );
+    CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+    CREATE INDEX IF NOT EXISTS files_path ON files (path);
+    """
+
+    # Version of the schema.  An index with other version is created
+    # again
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != self.VERSION:
+            self.db.executescript(
+                "DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS packages;"
+            )
+            self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, packages, jobs=1):
+        """Index the new or changed packages, and forget the missing ones.
+
+        Return the number of updated and removed packages, and the
+        packages that cannot be read.
+
+        """
+        known = {
+            filename: (mtime, size)
+            for filename, mtime, size in self.db.execute(
+                "SELECT filename, mtime, size FROM packages"
+            )
+        }
+        changed = []
+        for package in packages:
+            st = package.stat()
+            stamp = (st.st_mtime_ns, st.st_size)
+            if known.pop(package.name, None) != stamp:
+                changed.append((package, stamp))
+
+        failed = []
+        with self.db, concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+            futures = [
+                executor.submit(_index_package, package) for package, _ in changed
+            ]
+            for (package, (mtime, size)), future in zip(changed, futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    failed.append((package, e))
+                    continue
+                files = record.pop("files")
+                self.db.execute(
+                    "DELETE FROM packages WHERE filename = ?", (package.name,)
+                )
+                self.db.execute(
+                    "INSERT INTO packages VALUES (:filename, :mtime, :size, :name, "
+                    ":epoch, :version, :release, :arch, :disturl, :checksum, "
+                    ":payload_size, :header)",
+                    {"filename": package.name, "mtime": mtime, "size": size, **record},
+                )
+                self.db.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                    ((package.name, *entry) for entry in files),
+                )
+            self.db.executemany(
+                "DELETE FROM packages WHERE filename = ?",
+                ((filename,) for filename in known),
+            )
+        return len(changed) - len(failed), len(known), failed
+
+    def headers(self):
+        """Return the headers of the packages, indexed by file name."""
+        headers = {}
+        for filename, header in self.db.execute(
+            "SELECT filename, header FROM packages"
+        ):
+            header = json.loads(header)
+            if filename.endswith(".rpm"):
+                # Restore the tags and the INT32 arrays
+                header = {
+                    int(tag): tuple(value) if isinstance(value, list) else value
+                    for tag, value in header.items()
+                }
+            headers[filename] = header
+        return headers
+
+    def files(self, filename):
+        """Return the path, mode, size and link target of the files of a package."""
+        return self.db.execute(
+            "SELECT path, mode, size, target FROM files WHERE filename = ? "
+            "ORDER BY rowid",
+            (filename,),
+        ).fetchall()
+
+
+def _index_path(repo, index):
+    """Path of the index of a repository."""
+    return pathlib.Path(index) if index else repo / ".venvjail-index.db"
+
+
+def _update_index(repo, index, packages, jobs=1):
+    """Update the index of a repository, and return it."""
+    repo_index = RepoIndex(_index_path(repo, index))
+    updated, removed, failed = repo_index.update(packages, jobs)
+    for package, error in failed:
+        print(f"ERROR: package {package.name} not indexed: {error}")
+    return repo_index, updated, removed, failed
+
+
+def _resolve(packages, headers, roots, exclude):
+    """Return the closure of the root packages, and the unresolved requires."""
+    # Index of provides, without the excluded packages that are
+    # expected to be installed outside the venv
+    deps = {}
+    index = collections.defaultdict(list)
+    for package in sorted(packages):
+        if package.suffix == ".rpm":
+            name, provides, requires = _get_rpm_deps(headers[package.name])
+        else:
+            name, provides, requires = _get_deb_deps(headers[package.name])
+        deps[package] = (name, requires)
+        for provide in provides:
+            index[provide].append(package)
+
+    # Only the required files are indexed
+    wanted = {
+        alt
+        for _, requires in deps.values()
+        for alts in requires
+        for alt in alts
+        if alt.startswith("/")
+    }
+    if wanted:
+        for package in deps:
+            if package.suffix == ".rpm":
+                for path in _get_rpm_files(headers[package.name]):
+                    if path in wanted:
+                        index[path].append(package)
+
+    providers = {}
+    for provide, candidates in index.items():
+        # A requirement satisfied outside the venv
+        if any(package.name in exclude for package in candidates):
+            providers[provide] = None
+            continue
+        # Prefer the package with the same name
+        for package in candidates:
+            if deps[package][0] == provide:
+                providers[provide] = package
+                break
+        else:
+            providers[provide] = candidates[0]
+
+    closure = set()
+    unresolved = []
+    pending = []
+    for root in roots:
+        if root not in providers:
+            raise ValueError(f"root package {root} not found")
+        if not providers[root]:
+            raise ValueError(f"root package {root} is excluded")
+        pending.append(providers[root])
+    while pending:
+        package = pending.pop()
+        if package in closure:
+            continue
+        closure.add(package)
+        name, requires = deps[package]
+        for alts in requires:
+            for alt in alts:
+                if alt in providers:
+                    if providers[alt]:
+                        pending.append(providers[alt])
+                    break
+            else:
+                unresolved.append(f"{' | '.join(alts)} (required by {name})")
+    return closure, unresolved
+
+
+def _create_venv(args, timings):
+    """Create an empty venv, and return the paths of the venv."""
+    options = []
+    if args.system_site_packages:
+        options.append("--system-site-packages")
+    options.extend(["--copies", "--without-pip"])
+    options = " ".join(options)
+    with _phase(timings, "venv"):
+        subprocess.call(f"python3 -m venv {options} {args.dest_dir}", shell=True)
+
+    # Prepare the links for /usr/bin and /usr/lib[64]
+    (args.dest_dir / "usr").mkdir()
+    for link, target in VENV_LINKS.items():
+        (args.dest_dir / link).symlink_to(target)
+
+    # The paths of the venv are never deleted by an update
+    items = []
+    _walk_tree(args.dest_dir, [functools.partial(_visit_manifest, entries=items)])
+    return sorted(relpath for relpath, _ in items)
+
+
+def _select_packages(args, timings):
+    """Return the included, excluded and unresolved packages, and headers."""
+    # If both are populated, the algorithm will take precedence over
+    # the `exclude` list
+    include = FileList(args.include)
+    exclude = FileList(args.exclude)
+
+    included = []
+    excluded = []
+    packages = list(
+        itertools.chain.from_iterable(
+            args.repo.glob(pkgs) for pkgs in ("*.rpm", "*.deb")
+        )
+    )
+
+    # The headers can come from the index of the repository
+    headers = {}
+    if args.index is not None:
+        with _phase(timings, "index"):
+            repo_index, _, _, failed = _update_index(
+                args.repo, args.index, packages, args.jobs
+            )
+            headers = repo_index.headers()
+            repo_index.close()
+        if failed:
+            exit(1)
+
+    # Install only the dependency closure of some packages, instead
+    # of the `include` list
+    closure = None
+    unresolved = None
+    if args.resolve:
+        with _phase(timings, "resolve"):
+            if args.index is None:
+                headers, failed = _read_all_headers(packages, args.jobs)
+                for package, error in failed:
+                    print(f"ERROR: package {package.name} not read: {error}")
+                if failed:
+                    exit(1)
+            try:
+                closure, unresolved = _resolve(packages, headers, args.resolve, exclude)
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                exit(1)
+
+    to_extract = []
+    for package in packages:
+        pkg = package.name
+        if pkg in exclude:
+            excluded.append(pkg)
+            continue
+        if closure is not None:
+            if package not in closure:
+                excluded.append(pkg)
+                continue
+        elif include.is_populated() and pkg not in include:
+            excluded.append(pkg)
+            continue
+        included.append(pkg)
+        to_extract.append(package.absolute())
+    return included, excluded, to_extract, headers, unresolved
+
+
+def _install_packages(args, timings, packages, headers, pruner, cache, manifest):
+    """Extract the packages in the venv, exiting if some package fails."""
+    with _phase(timings, "extract"):
+        extracted, failed = _extract_packages(
+            packages, args.dest_dir, args.jobs, cache, pruner, timings, manifest
+        )
+    headers.update(extracted)
+    if pruner:
+        pruner.finish()
+    for package, error in failed:
+        print(f"ERROR: package {package.name} not extracted: {error}")
+    if failed:
+        exit(1)
+
+
+def _compile_and_dedup(args, timings, changed=None):
+    """Compile the modules and merge the identical files, if requested."""
+    # Compile the modules, after the relocation and before merging
+    # the identical files
+    if args.compile:
+        with _phase(timings, "compile"):
+            compiled = _compile_bytecode(
+                args.dest_dir,
+                args.relocate / args.dest_dir,
+                args.python_version,
+                args.invalidation_mode,
+                changed,
+            )
+        if not compiled:
+            print("ERROR: some modules were not compiled")
+
+    # Merge the identical files
+    if args.dedup:
+        with _phase(timings, "dedup"):
+            saved = _dedup(args.dest_dir, args.jobs)
+        print(f"Deduplicated files, {saved} bytes saved")
+
+
+def _conflicts_log(conflicts):
+    """Return the log lines of the paths installed by several packages."""
+    return [f"{path} ({', '.join(packages)})" for path, packages in conflicts.items()]
+
+
+def _plan_venv(args, packages, remove):
+    """Plan the content of the venv, without extracting the packages.
+
+    The files of the packages are read from the headers (or the
+    index), and placed like in the venv.  Return the size and number
+    of files of every package (of the files not overwritten by a later
+    package), the number of files and bytes removed, and the paths
+    installed by more than one package.
+
+    """
+    if args.index is not None:
+        repo_index = RepoIndex(_index_path(args.repo, args.index))
+        files = {package.name: repo_index.files(package.name) for package in packages}
+        repo_index.close()
+    else:
+        files = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {
+                package: executor.submit(_package_files, package)
+                for package in packages
+            }
+        for package, future in futures.items():
+            try:
+                files[package.name] = future.result()
+            except Exception as e:
+                print(f"ERROR: package {package.name} not read: {e}")
+                exit(1)
+
+    # The links of the packages are added to the links of the venv,
+    # as the packages are extracted
+    links = dict(VENV_LINKS, lib64="lib")
+    graph = _LinkGraph(args.dest_dir, links)
+    writers = collections.defaultdict(list)
+    sizes = {}
+    removed = [0, 0]
+    for package in packages:
+        for path, mode, size, target in files[package.name]:
+            name = _entry_name(path)
+            if not name:
+                continue
+            parent, base = os.path.split(name)
+            parent, _ = graph.resolve(parent)
+            relpath = os.path.join(parent, base)
+            # The removed links are followed like in the extraction
+            if mode and stat.S_ISLNK(mode) and target:
+                graph.update(relpath, target)
+            prefixes = itertools.accumulate(relpath.split("/"), os.path.join)
+            if any(prefix in remove for prefix in prefixes):
+                removed[0] += 1
+                removed[1] += size or 0
+                continue
+            if mode and stat.S_ISDIR(mode):
+                continue
+            if package.name not in writers[relpath]:
+                writers[relpath].append(package.name)
+            sizes[relpath] = size or 0
+
+    contributors = {package.name: [0, 0] for package in packages}
+    for relpath, size in sizes.items():
+        contributor = contributors[writers[relpath][-1]]
+        contributor[0] += 1
+        contributor[1] += size
+    conflicts = {relpath: names for relpath, names in writers.items() if len(names) > 1}
+    return contributors, removed, conflicts
+
+
+def _print_plan(included, excluded, contributors, removed, conflicts, top=10):
+    """Print the plan of the venv."""
+    print("# Included packages")
+    for pkg in sorted(included):
+        print(pkg)
+    print("\n\n# Excluded packages")
+    for pkg in sorted(excluded):
+        print(pkg)
+    print("\n\n# Overwrite conflicts")
+    for relpath, packages in sorted(conflicts.items()):
+        print(f"{relpath} ({', '.join(packages)})")
+
+    print()
+    print(f"{'Largest packages':<60} {'Files':>8} {'Bytes':>12}")
+    largest = sorted(contributors.items(), key=lambda i: (-i[1][1], i[0]))
+    for name, (files, size) in largest[:top]:
+        print(f"{name:<60} {files:8} {size:12}")
+    files = sum(files for files, _ in contributors.values())
+    size = sum(size for _, size in contributors.values())
+    print(f"{'Removed':<60} {removed[0]:8} {removed[1]:12}")
+    print(f"{'Total':<60} {files:8} {size:12}")
+    print(
+        f"\n{len(included)} packages, {files} files, {size} bytes, "
+        f"{len(conflicts)} conflicts"
+    )
+
+
+def _build_venv(args, timings, packages, headers, remove, cache):
+    """Create the venv and install the packages, and return the log."""
+    venv = _create_venv(args, timings)
+
+    # The files from the remove list are not extracted
+    pruner = _Pruner(args.dest_dir, remove) if remove.is_populated() else None
+    # Record the files of each package, hashing the data while is
+    # written
+    manifest = Manifest() if args.manifest else None
+    _install_packages(args, timings, packages, headers, pruner, cache, manifest)
+
+    # Prune the rest of the files (maintaining a log) and fix the venv
+    with _phase(timings, "fix"):
+        log = _fix_virtualenv(
+            args.dest_dir,
+            args.relocate,
+            args.no_relocate_shebang_list,
+            args.python_version,
+            remove,
+            args.jobs,
+            timings,
+            loader=args.loader,
+            runpath=args.runpath,
+            strip=args.strip,
+        )
+    if pruner:
+        log["Removed files"].extend(pruner.removed)
+
+    _compile_and_dedup(args, timings)
+    if args.import_index:
+        with _phase(timings, "import index"):
+            _write_import_index(args.dest_dir, args.python_version)
+
+    # The manifest reflects the final content of the venv
+    if manifest:
+        with _phase(timings, "manifest"):
+            entries, conflicts = manifest.build(
+                args.dest_dir, [package.name for package in packages], args.jobs
+            )
+            _write_manifest(
+                args.manifest,
+                args.dest_dir,
+                packages,
+                venv,
+                _build_options(args, remove),
+                entries,
+            )
+        log["Overwrite conflicts"] = _conflicts_log(conflicts)
+    return log
+
+
+def _delete_files(dest_dir, previous, deleted, venv):
+    """Delete the files of some packages, and return the deleted paths."""
+    deleted_paths = []
+    directories = set()
+    for path, entry in previous.items():
+        if entry["package"] not in deleted:
+            continue
+        if stat.S_ISDIR(int(entry["mode"], 8)):
+            directories.add(path)
+            continue
+        filename = os.path.join(dest_dir, path)
+        if os.path.lexists(filename):
+            parent = os.path.dirname(filename)
+            mode = _make_writable(parent)
+            os.unlink(filename)
+            os.chmod(parent, mode)
+        deleted_paths.append(path)
+        directories.update(itertools.accumulate(path.split("/")[:-1], os.path.join))
+
+    # The directories are deleted if they are empty, and no other
+    # package (or the venv) needs them
+    for path in sorted(directories, key=lambda path: path.count("/"), reverse=True):
+        entry = previous.get(path)
+        if path in venv or (entry and not deleted.issuperset(_owners(entry))):
+            continue
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.join(dest_dir, path))
+            deleted_paths.append(path)
+    return deleted_paths
+
+
+def _check_libraries(dest_dir, previous, changed, deleted_paths):
+    """Raise ValueError if a file not updated needs an updated library."""
+    before = collections.defaultdict(set)
+    for path, entry in previous.items():
+        if ".so" in os.path.basename(path) and not stat.S_ISDIR(int(entry["mode"], 8)):
+            before[os.path.basename(path)].add(os.path.dirname(path))
+    after = {}
+    _walk_tree(dest_dir, [functools.partial(_visit_libraries, libraries=after)])
+    names = {
+        name
+        for name in before.keys() | after.keys()
+        if before.get(name) != set(after.get(name, ()))
+    }
+    if not names:
+        return
+
+    skipped = changed.union(deleted_paths)
+    for path, entry in previous.items():
+        filename = os.path.join(dest_dir, path)
+        if path in skipped or not stat.S_ISREG(int(entry["mode"], 8)):
+            continue
+        if not os.path.isfile(filename) or not _is_elf_candidate(filename):
+            continue
+        with contextlib.suppress(OSError, struct.error):
+            needed = names.intersection(_elf_needed(filename) or ())
+            if needed:
+                raise ValueError(f"{path} needs the updated {', '.join(needed)}")
+
 
+def _update_venv(args, timings, packages, headers, remove, cache):
+    """Update an existing venv, and return the log.
 
-def _fix_loader(dest_dir, virtual_env):
-    """Fix virtualenv python entry point."""
-    loader = f"""#!/bin/sh
+    Only the new or changed packages (by size and modification time)
+    are extracted and fixed, and the files of the packages that are
+    not installed anymore are deleted.  If the result can be different
+    from a clean build, ValueError is raised and the venv needs to be
+    created again.
 
-export VIRTUAL_ENV="{virtual_env}"
-export PATH="$VIRTUAL_ENV/bin:$PATH"
-export LD_LIBRARY_PATH="$VIRTUAL_ENV/lib"
-export PYTHONHOME="$VIRTUAL_ENV"
+    """
+    if not args.manifest.exists():
+        raise ValueError(f"manifest {args.manifest} not found")
+    header, entries = _read_manifest(args.manifest)
+    if "packages" not in header:
+        raise ValueError(f"manifest {args.manifest} without packages")
+    # The venv is updated only with the same options of the last build
+    options = _build_options(args, remove)
+    recorded = header.get("options", {})
+    changed_options = sorted(
+        name
+        for name in options.keys() | recorded.keys()
+        if options.get(name) != recorded.get(name)
+    )
+    if changed_options:
+        raise ValueError(f"the options {', '.join(changed_options)} changed")
+    previous = {entry["path"]: entry for entry in entries}
+    stamps = {stamp["name"]: stamp for stamp in header["packages"]}
+    names = [package.name for package in packages]
+    kept = {
+        package.name
+        for package in packages
+        if stamps.get(package.name) == _package_stamp(package)
+    }
+    deleted = set(stamps) - kept
+    added = [package for package in packages if package.name not in kept]
 
-exec {{}} "$@"
-"""
+    # The files of the deleted packages cannot be recovered if other
+    # package (or the venv) installed the same path
+    venv = set(header.get("venv", ()))
+    for path, entry in previous.items():
+        if deleted.intersection(entry.get("conflicts", ())):
+            writers = ", ".join(entry["conflicts"])
+            raise ValueError(f"{path} is installed by {writers}")
+        if entry["package"] in deleted and path in venv:
+            if not stat.S_ISDIR(int(entry["mode"], 8)):
+                raise ValueError(f"{path} of {entry['package']} overwrites the venv")
 
-    # We replace all the python interpreters with a loader that set
-    # the correct env variables before executing it
-    for python in (dest_dir / "bin").glob("python*"):
-        if python.is_symlink():
-            continue
-        new_name = python.with_name(python.name + ".original")
-        python.replace(new_name)
-        with python.open("w") as f:
-            new_python = virtual_env / "bin" / new_name.name
-            f.write(loader.format(new_python))
-        python.chmod(0o755)
+    with _phase(timings, "delete"):
+        deleted_paths = _delete_files(args.dest_dir, previous, deleted, venv)
 
+    pruner = _Pruner(args.dest_dir, remove) if remove.is_populated() else None
+    manifest = Manifest()
+    _install_packages(args, timings, added, headers, pruner, cache, manifest)
 
-def _fix_systemd_services_in(services_dir, virtual_env):
-    for service in services_dir.glob("*.service"):
-        # Service files are read only
-        service.chmod(0o644)
-        _replace(service, r"ExecStart=(.*)", rf"ExecStart={virtual_env}\1")
-        _replace(service, r"ExecStartPre=-(.*)", rf"ExecStartPre=-{virtual_env}\1")
-        service.chmod(0o444)
+    # The new files cannot overwrite the files of other packages (or
+    # the venv), that were not extracted again
+    resolver = _PathResolver(args.dest_dir)
+    changed = set()
+    directories = collections.defaultdict(list)
+    for package in added:
+        for name, st, _ in manifest.records.get(package.name, ()):
+            is_dir = stat.S_ISDIR(st.st_mode)
+            path = resolver.directory(name) if is_dir else resolver.relpath(name)
+            if not path or path == ".":
+                continue
+            if is_dir:
+                directories[path].append(package.name)
+            else:
+                changed.add(path)
+            if os.path.dirname(path) == "lib/systemd/system":
+                service = os.path.join(
+                    os.path.dirname(path), "venv-" + os.path.basename(path)
+                )
+                entry = previous.get(service, {"package": None})
+                if service in previous and entry["package"] not in deleted:
+                    raise ValueError(f"{path} of {package.name} overwrites {service}")
+            entry = previous.get(path)
+            if not entry or entry["package"] in deleted:
+                continue
+            if is_dir and stat.S_ISDIR(int(entry["mode"], 8)):
+                continue
+            owner = entry["package"] or "the venv"
+            raise ValueError(f"{path} of {package.name} overwrites {owner}")
 
-        # TODO: Do we need this? If so, we should adjust some After
-        # and Before.
-        # For convenience, rename the service
-        service.rename(services_dir / ("venv-" + service.name))
+    # The mode of the directories is the one of the last package that
+    # installs the directory, or the default one
+    order = {name: n for n, name in enumerate(names)}
+    umask = os.umask(0)
+    os.umask(umask)
+    for path, entry in previous.items():
+        if stat.S_ISDIR(int(entry["mode"], 8)) and deleted.intersection(_owners(entry)):
+            directories.setdefault(path, [])
+    for path, writers in directories.items():
+        filename = os.path.join(args.dest_dir, path)
+        if os.path.islink(filename) or not os.path.isdir(filename):
+            continue
+        entry = previous.get(path, {"package": None})
+        owners = [package for package in _owners(entry) if package in kept]
+        owners = sorted(set(owners).union(writers), key=order.get)
+        if not owners:
+            os.chmod(filename, 0o777 & ~umask)
+        elif owners[-1] in kept and owners[-1] == entry["package"]:
+            os.chmod(filename, stat.S_IMODE(int(entry["mode"], 8)))
 
+    # Only the new files get a runpath, so the libraries needed by the
+    # other files cannot be added, moved or deleted
+    if args.runpath:
+        _check_libraries(args.dest_dir, previous, changed, deleted_paths)
 
-def _fix_systemd_services(dest_dir, virtual_env):
-    """Fix systemd services."""
-    # "lib/systemd/system" and "usr/lib/systemd/system" are links in
-    # Python3 venvs.  For now we choose only one to avoid processing
-    # two times the same service file
-    for systemd_dir in ("lib/systemd/system",):
-        _fix_systemd_services_in(dest_dir / systemd_dir, virtual_env)
+    with _phase(timings, "fix"):
+        log = _fix_virtualenv(
+            args.dest_dir,
+            args.relocate,
+            args.no_relocate_shebang_list,
+            args.python_version,
+            remove,
+            args.jobs,
+            timings,
+            changed,
+            args.loader,
+            args.runpath,
+            args.strip,
+        )
+    if pruner:
+        log["Removed files"].extend(pruner.removed)
 
+    _compile_and_dedup(args, timings, changed)
+    if args.import_index:
+        with _phase(timings, "import index"):
+            index = _write_import_index(args.dest_dir, args.python_version)
+        # The index is written again, maybe in the same second
+        previous.pop(str(index.relative_to(args.dest_dir)), None)
 
-def _extract_rpm(package, directory):
-    cpio_help = subprocess.check_output(["cpio", "--help"])
-    cmd = [
-        "cpio",
-        "--extract",
-        "--unconditional",
-        "--preserve-modification-time",
-        "--make-directories",
-    ]
-    if b"--extract-over-symlinks" in cpio_help:
-        cmd.append("--extract-over-symlinks")
-    subprocess.call(
-        f"cd {directory}; rpm2cpio {package} | {' '.join(cmd)}",
-        stdout=subprocess.DEVNULL,
-        shell=True,
-    )
+    # The paths not written again keep the owners, without the
+    # deleted packages
+    for path, entry in previous.items():
+        owners = [package for package in _owners(entry) if package not in deleted]
+        previous[path] = dict(entry, owners=owners)
+    with _phase(timings, "manifest"):
+        entries, conflicts = manifest.build(args.dest_dir, names, args.jobs, previous)
+        _write_manifest(
+            args.manifest,
+            args.dest_dir,
+            packages,
+            header.get("venv", []),
+            header["options"],
+            entries,
+        )
+    return {
+        "Extracted packages": [package.name for package in added],
+        "Deleted packages": deleted,
+        "Deleted files": deleted_paths,
+        **log,
+        "Overwrite conflicts": _conflicts_log(conflicts),
+    }
 
 
-def _extract_deb(package, directory):
-    subprocess.call(
-        f"cd {directory}; ar x {package}; "
-        "tar --keep-directory-symlink -xJvf data.tar.xz; "
-        "rm control.tar.xz data.tar.xz debian-binary",
-        stdout=subprocess.DEVNULL,
-        shell=True,
-    )
+def _clean_args(args, manifest):
+    """Return the arguments of a clean build of an updated venv.
 
+    The packages are selected like in the update, and the venv is
+    built with the options recorded in the manifest.
 
-def _get_rpm_track_info(package):
-    query = "|".join(
-        ("%{NAME}", "%{EPOCH}", "%{VERSION}", "%{RELEASE}", "%{ARCH}", "%{DISTURL}")
-    )
-    return subprocess.check_output(
-        f"rpm -qp --queryformat='{query}' {package}",
-        stderr=subprocess.DEVNULL,
-        shell=True,
+    """
+    header, _ = _read_manifest(args.manifest)
+    options = {name: header["options"][name] for name in BUILD_OPTIONS}
+    options["relocate"] = pathlib.Path(options["relocate"])
+    return argparse.Namespace(
+        dest_dir=args.dest_dir,
+        repo=args.repo,
+        include=args.include,
+        exclude=args.exclude,
+        remove=args.remove,
+        index=args.index,
+        resolve=args.resolve,
+        jobs=args.jobs,
+        manifest=manifest,
+        cache_dir=None,
+        track=None,
+        output_archive=None,
+        update=False,
+        plan=False,
+        check_update=False,
+        timings=False,
+        timings_json=None,
+        **options,
     )
 
 
-def _get_deb_track_info(package):
-    query = "|".join(
-        ("${Package}", "None", "${Version}", "None", "${Architecture}", "None", "None")
-    )
+def _check_update(args):
+    """Compare the updated venv with a clean build, and return the differences."""
+    # The clean build is created in the same place, as the paths are
+    # part of the venv
+    updated = args.dest_dir.with_name(args.dest_dir.name + ".updated")
+    os.replace(args.dest_dir, updated)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = pathlib.Path(tmp, "manifest")
+            create(_clean_args(args, manifest))
+            _, expected = _read_manifest(manifest)
+    finally:
+        if os.path.lexists(args.dest_dir):
+            _rmtree(args.dest_dir)
+        os.replace(updated, args.dest_dir)
 
-    return subprocess.check_output(
-        f"dpkg-deb -W --showformat='{query}' {package}",
-        stderr=subprocess.DEVNULL,
-        shell=True,
-    )
+    # The content is compared with the files of the updated venv, and
+    # the owners with the manifest written by the update
+    ignored = _manifest_ignored(args.dest_dir, args.manifest)
+    found, _ = Manifest().build(args.dest_dir, [], args.jobs)
+    found = {entry["path"]: entry for entry in found}
+    expected = {entry["path"]: entry for entry in expected}
+    recorded = {entry["path"]: entry for entry in _read_manifest(args.manifest)[1]}
+    differences = []
+    for path in sorted(set(found).union(expected).difference(ignored)):
+        if path not in found:
+            differences.append(f"{path}: missing")
+        elif path not in expected:
+            differences.append(f"{path}: unexpected")
+        else:
+            fields = [
+                field
+                for field in ("mode", "size", "sha256", "target")
+                if found[path].get(field) != expected[path].get(field)
+            ]
+            fields.extend(
+                field
+                for field in ("package", "owners", "conflicts")
+                if recorded.get(path, {}).get(field) != expected[path].get(field)
+            )
+            if fields:
+                differences.append(f"{path}: {', '.join(fields)}")
+    return differences
 
 
 def create(args):
     """Function called for the `create` command."""
-    # Create the virtual environment
-    options = []
-    if args.system_site_packages:
-        options.append("--system-site-packages")
-    options.extend(["--copies", "--without-pip"])
-    options = " ".join(options)
-    subprocess.call(f"python3 -m venv {options} {args.dest_dir}", shell=True)
-
-    # Prepare the links for /usr/bin and /usr/lib[64]
-    usr = args.dest_dir / "usr"
-    usr.mkdir()
-    (usr / "bin").symlink_to("../bin")
-    (usr / "lib").symlink_to("../lib")
-    (usr / "lib64").symlink_to("../lib")
-
-    # If both are populated, the algorithm will take precedence over
-    # the `exclude` list
-    include = FileList(args.include)
-    exclude = FileList(args.exclude)
+    timings = Timings() if args.timings or args.timings_json else None
+    if args.update and not args.manifest:
+        print("ERROR: --update requires the --manifest of the last build")
+        exit(1)
+    if args.loader == "native" and not args.runpath:
+        print("ERROR: --loader native requires --runpath")
+        exit(1)
+    if args.output_archive:
+        try:
+            _archive_compressor(args.output_archive)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            exit(1)
 
     # Install the packages and maintain a log
-    included = []
-    excluded = []
-    packages = itertools.chain.from_iterable(
-        args.repo.glob(pkgs) for pkgs in ("*.rpm", "*.deb")
+    included, excluded, to_extract, headers, unresolved = _select_packages(
+        args, timings
     )
-    for package in packages:
-        pkg = package.name
-        if pkg in exclude:
-            excluded.append(pkg)
-            continue
-        if include.is_populated() and pkg not in include:
-            excluded.append(pkg)
-            continue
-        included.append(pkg)
+    remove = FileList(args.remove)
 
-        package = package.absolute()
-        if package.suffix == ".rpm":
-            _extract_rpm(package, args.dest_dir)
-        elif package.suffix == ".deb":
-            _extract_deb(package, args.dest_dir)
+    # Only the plan of the venv is shown, without extracting the
+    # packages
+    if args.plan:
+        with _phase(timings, "plan"):
+            contributors, removed, conflicts = _plan_venv(args, to_extract, remove)
+        _print_plan(included, excluded, contributors, removed, conflicts)
+        if args.timings:
+            print()
+            timings.report()
+        return
 
-    # Prune some files and maintain a log
-    remove = FileList(args.remove)
-    to_remove = list(_find_files(args.dest_dir, remove))
-    for entry in to_remove:
-        if not (os.path.exists(entry.path) or os.path.islink(entry.path)):
-            continue
-        if entry.is_dir():
-            shutil.rmtree(entry.path)
-        else:
-            os.remove(entry.path)
+    cache = None
+    if args.cache_dir:
+        cache = PackageCache(args.cache_dir, args.cache_size, args.cache_link)
 
-    _fix_virtualenv(
-        args.dest_dir, args.relocate, args.no_relocate_shebang_list, args.python_version
-    )
+    log = None
+    if args.update and args.dest_dir.exists():
+        try:
+            log = _update_venv(args, timings, to_extract, headers, remove, cache)
+        except ValueError as e:
+            print(f"Creating the venv again, {e}")
+            _rmtree(args.dest_dir)
+    if log is None:
+        log = _build_venv(args, timings, to_extract, headers, remove, cache)
+    if unresolved is not None:
+        log["Unresolved requirements"] = unresolved
+
+    # Keep the size of the cache bounded
+    if cache:
+        with _phase(timings, "cache prune"):
+            cache.prune()
 
     # Write the log file, useful to better taylor the inclusion /
     # exclusion of packages.
@@ -488,23 +3972,146 @@ def create(args):
         print("\n\n# Excluded packages", file=f)
         for pkg in sorted(excluded):
             print(pkg, file=f)
-        print("\n\n# Removed files", file=f)
-        for fn in sorted([entry.path for entry in to_remove]):
-            print(fn, file=f)
+        for title, entries in log.items():
+            print(f"\n\n# {title}", file=f)
+            for fn in sorted(set(entries)):
+                print(fn, file=f)
 
     # Write the L3/Maintenance track file, required to track the
     # content of the venv inside OBS.
     if args.track:
-        with args.track.open("w") as f:
+        with _phase(timings, "track"), args.track.open("w") as f:
             for pkg in sorted(included):
-                pkg = args.repo / pkg
-                if pkg.suffix == ".rpm":
-                    line = _get_rpm_track_info(pkg)
-                elif pkg.suffix == ".deb":
-                    line = _get_deb_track_info(pkg)
-                else:
-                    line = ["None"] * 7
-                print(line.decode("utf-8"), file=f)
+                # Reuse the headers read during the extraction
+                package = args.repo / pkg
+                if pkg not in headers:
+                    headers[pkg] = _read_headers(package)
+                print(_get_track_info(package, headers[pkg]), file=f)
+
+    # The final tree is streamed into a compressed archive
+    if args.output_archive:
+        with _phase(timings, "archive"):
+            _write_archive(
+                args.dest_dir,
+                args.output_archive,
+                _archive_paths(args.dest_dir, args.manifest, args.archive_sort),
+                args.archive_prefix,
+                args.archive_mtime,
+                args.archive_owner,
+                args.jobs,
+            )
+
+    if args.timings:
+        timings.report()
+    if args.timings_json:
+        with args.timings_json.open("w") as f:
+            json.dump(timings.to_json(), f, indent=2)
+
+    if args.check_update:
+        differences = _check_update(args)
+        for difference in differences:
+            print(difference)
+        if differences:
+            print(f"ERROR: {len(differences)} paths are different in a clean build")
+            exit(1)
+        print("The venv is identical to a clean build")
+
+
+def index(args):
+    """Function called for the `index` command."""
+    packages = itertools.chain.from_iterable(
+        args.repo.glob(pkgs) for pkgs in ("*.rpm", "*.deb")
+    )
+    repo_index, updated, removed, failed = _update_index(
+        args.repo, args.index, packages, args.jobs
+    )
+    repo_index.close()
+    print(f"Indexed {updated} packages, removed {removed}")
+    if failed:
+        exit(1)
+
+
+def _verify_entry(dest_dir, entry, fast=False):
+    """Check an entry of the manifest, and return the problems found."""
+    path = os.path.join(dest_dir, entry["path"])
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return ["missing"]
+
+    problems = []
+    if f"{st.st_mode:o}" != entry["mode"]:
+        problems.append("mode")
+    if "target" in entry:
+        if not stat.S_ISLNK(st.st_mode) or os.readlink(path) != entry["target"]:
+            problems.append("target")
+    elif "sha256" in entry:
+        if st.st_size != entry["size"]:
+            problems.append("size")
+        elif fast and int(st.st_mtime) == entry["mtime"]:
+            # Unchanged files are not read
+            pass
+        elif not stat.S_ISREG(st.st_mode) or _checksum(path) != entry["sha256"]:
+            problems.append("sha256")
+    return problems
+
+
+def verify(args):
+    """Function called for the `verify` command."""
+    _, entries = _read_manifest(args.manifest)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(
+            functools.partial(_verify_entry, args.dest_dir, fast=args.fast), entries
+        )
+        failed = 0
+        for entry, problems in zip(entries, results):
+            if problems:
+                failed += 1
+                print(f"{entry['path']}: {', '.join(problems)}")
+
+    # Files that are not in the manifest
+    items = []
+    _walk_tree(args.dest_dir, [functools.partial(_visit_manifest, entries=items)])
+    known = {entry["path"] for entry in entries}
+    known.update(_manifest_ignored(args.dest_dir, args.manifest))
+    for relpath, _ in sorted(items):
+        if relpath in known:
+            continue
+        failed += 1
+        print(f"{relpath}: unexpected")
+
+    print(f"Verified {len(entries)} files, {failed} with problems")
+    if failed:
+        exit(1)
+
+
+def archive(args):
+    """Function called for the `archive` command."""
+    paths = _archive_paths(args.dest_dir, args.manifest, args.archive_sort)
+    try:
+        count = _write_archive(
+            args.dest_dir,
+            args.output_archive,
+            paths,
+            args.archive_prefix,
+            args.archive_mtime,
+            args.archive_owner,
+            args.jobs,
+        )
+    except (OSError, ValueError) as e:
+        print(f"ERROR: archive not written: {e}")
+        exit(1)
+    print(f"Archived {count} entries in {args.output_archive}")
+
+
+def cache_prune(args):
+    """Function called for the `cache prune` command."""
+    cache = PackageCache(args.cache_dir)
+    removed = cache.prune(args.max_size)
+    for name, size in removed:
+        print(f"Removed {name} ({size} bytes)")
+    print(f"Freed {sum(size for _, size in removed)} bytes")
 
 
 def _filter_binary_xml(root):
@@ -531,12 +4138,81 @@ def _filter_binary_name(names, args):
         return [pkg for pkg in names if pkg not in exclude]
 
 
+def _api_cache_file(args, api):
+    """Path of the cached response of an API call."""
+    key = hashlib.sha256(f"{args.apiurl} {api}".encode("utf-8")).hexdigest()
+    return args.api_cache_dir / key
+
+
+def _write_api_cache(args, cache_file, data):
+    """Write a file of the API cache atomically, as can be shared."""
+    args.api_cache_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=args.api_cache_dir, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, cache_file)
+
+
+def _osc_api(args, api):
+    """Call the OBS API, using the local cache of responses."""
+    cache_file = _api_cache_file(args, api)
+    etag_file = cache_file.with_suffix(".etag")
+    mtime = None
+    try:
+        mtime = cache_file.stat().st_mtime
+        if args.offline or time.time() - mtime < args.ttl:
+            return cache_file.read_bytes()
+    except FileNotFoundError:
+        if args.offline:
+            raise ValueError(f"{api} not found in the cache (offline mode)")
+
+    if args.transport == "http":
+        # An expired response is validated with a conditional request,
+        # and if not modified is valid for another `ttl` seconds
+        request = urllib.request.Request(args.apiurl.rstrip("/") + api)
+        if mtime is not None:
+            since = email.utils.formatdate(mtime, usegmt=True)
+            request.add_header("If-Modified-Since", since)
+            if etag_file.exists():
+                request.add_header("If-None-Match", etag_file.read_text())
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                output = response.read()
+                etag = response.headers.get("ETag")
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or mtime is None:
+                raise
+            os.utime(cache_file)
+            return cache_file.read_bytes()
+        if etag:
+            _write_api_cache(args, etag_file, etag.encode("utf-8"))
+        elif etag_file.exists():
+            etag_file.unlink()
+    else:
+        output = subprocess.check_output(["osc", "--apiurl", args.apiurl, "api", api])
+
+    _write_api_cache(args, cache_file, output)
+    return output
+
+
+def _osc_api_map(args, apis):
+    """Call the OBS API concurrently, and return the responses in order."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(_osc_api, args, api) for api in apis]
+    outputs = []
+    for api, future in zip(apis, futures):
+        try:
+            outputs.append(future.result())
+        except Exception as e:
+            print(f"ERROR: API call {api} failed: {e}")
+            exit(1)
+    return outputs
+
+
 def _repository(args):
     """List binary packages from a repository"""
     api = f"/build/{args.project}/{args.repo}/{args.arch}/_repository"
-    output = subprocess.check_output(
-        f"osc --apiurl {args.apiurl} api {api}", shell=True
-    )
+    (output,) = _osc_api_map(args, [api])
     elements = _filter_binary_xml(ET.fromstring(output))
     # Unversioned name, so we remove the file extension
     elements = [re.sub(r"\.rpm$|\.deb$", "", pkg) for pkg in elements]
@@ -576,20 +4252,21 @@ def binary(args):
         r"(?:(.*)-([^-]+)-([^-]+)\.([^-\.]+)\.rpm)|(?:(.*)_([^_]+)_([^_]+)\.deb)"
     )
 
-    api = f"/build/{args.project}/{args.repo}/{args.arch}/{args.package}"
-    output = subprocess.check_output(
-        f"osc --apiurl {args.apiurl} api {api}", shell=True
-    )
-    elements = _filter_binary_xml(ET.fromstring(output))
-    # Take only the name of the package
-    elements = [
-        pkg_re.match(pkg).groups()[0] or pkg_re.match(pkg).groups()[4]
-        for pkg in elements
-        if pkg_re.match(pkg)
+    apis = [
+        f"/build/{args.project}/{args.repo}/{args.arch}/{package}"
+        for package in args.package
     ]
-    elements = _filter_binary_name(elements, args)
-    for pkg in elements:
-        print(pkg)
+    for output in _osc_api_map(args, apis):
+        elements = _filter_binary_xml(ET.fromstring(output))
+        # Take only the name of the package
+        elements = [
+            pkg_re.match(pkg).groups()[0] or pkg_re.match(pkg).groups()[4]
+            for pkg in elements
+            if pkg_re.match(pkg)
+        ]
+        elements = _filter_binary_name(elements, args)
+        for pkg in elements:
+            print(pkg)
 
 
 def _filter_requires_spec(spec):
@@ -605,11 +4282,12 @@ def requires(args):
         exit(1)
 
     # TODO: we need to find a way for Debian
-    api = f"/source/{args.project}/{args.package}/{args.package}.spec"
-    output = subprocess.check_output(
-        f"osc --apiurl {args.apiurl} api {api}", shell=True
-    )
-    requires_and_version = _filter_requires_spec(output.decode("utf-8"))
+    apis = [
+        f"/source/{args.project}/{package}/{package}.spec" for package in args.package
+    ]
+    requires_and_version = {}
+    for output in _osc_api_map(args, apis):
+        requires_and_version.update(_filter_requires_spec(output.decode("utf-8")))
     requires = requires_and_version.keys()
 
     # Remove the packages included in the venv
@@ -629,6 +4307,69 @@ def requires(args):
         print(requires.strip())
 
 
+def _add_api_arguments(subparser):
+    """Add the options of the commands that use the OBS API."""
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    subparser.add_argument(
+        "--api-cache-dir",
+        type=pathlib.Path,
+        default=pathlib.Path(cache_home, "venvjail", "api"),
+        help="Directory used to cache the API responses",
+    )
+    subparser.add_argument(
+        "--ttl",
+        type=int,
+        default=3600,
+        help="Seconds that a cached API response is valid (0 to refresh)",
+    )
+    subparser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use only the cached API responses, even if expired",
+    )
+    subparser.add_argument(
+        "--transport",
+        choices=("osc", "http"),
+        default="osc",
+        help="Call the API via osc, or via plain HTTP (no authentication)",
+    )
+    subparser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=4,
+        help="Number of concurrent API calls",
+    )
+
+
+def _add_archive_arguments(subparser):
+    """Add the options of the commands that write an archive."""
+    subparser.add_argument(
+        "--archive-prefix",
+        metavar="PREFIX",
+        help="Directory of the venv inside the archive "
+        "(by default the name of the venv)",
+    )
+    subparser.add_argument(
+        "--archive-sort",
+        action="store_true",
+        help="Archive the entries sorted by name (always with a manifest)",
+    )
+    subparser.add_argument(
+        "--archive-mtime",
+        type=int,
+        metavar="SECONDS",
+        default=os.environ.get("SOURCE_DATE_EPOCH"),
+        help="Modification time of all the archived entries "
+        "(by default SOURCE_DATE_EPOCH, if defined)",
+    )
+    subparser.add_argument(
+        "--archive-owner",
+        action="store_true",
+        help="Archive the entries owned by root",
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Utility to help venvs creation for Python services"
@@ -698,12 +4439,132 @@ if __name__ == "__main__":
         default="remove-file",
         help="File with filenames to remove",
     )
+    subparser.add_argument(
+        "--index",
+        metavar="FILE",
+        nargs="?",
+        const="",
+        help="Read the headers from the index of the repository, updating it "
+        "(by default REPO/.venvjail-index.db)",
+    )
+    subparser.add_argument(
+        "--resolve",
+        metavar="PACKAGE",
+        nargs="+",
+        help="Install the dependency closure of these packages, "
+        "instead of the include list",
+    )
     subparser.add_argument(
         "-t",
         "--track",
         type=pathlib.Path,
         help="Filename for the L3/Maintenance track file",
     )
+    subparser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=1,
+        help="Number of parallel jobs used to extract and fix the venv",
+    )
+    subparser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Replace identical files with hard links",
+    )
+    subparser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        help="Directory used to cache the extracted packages",
+    )
+    subparser.add_argument(
+        "--cache-size",
+        type=_size,
+        default="10G",
+        help="Maximum size of the cache (like 512M or 10G)",
+    )
+    subparser.add_argument(
+        "--cache-link",
+        choices=("hardlink", "reflink", "copy"),
+        default="reflink",
+        help="How the files are installed from the cache. "
+        "If not possible, the files are copied",
+    )
+    subparser.add_argument(
+        "--loader",
+        choices=("shell", "native"),
+        default="shell",
+        help="Set the environment of the interpreters with a shell script, "
+        "or natively when the interpreter starts (requires --runpath)",
+    )
+    subparser.add_argument(
+        "--import-index",
+        action="store_true",
+        help="Resolve the imports of the modules of the venv from an index",
+    )
+    subparser.add_argument(
+        "--strip",
+        action="store_true",
+        help="Remove the debug sections and the symbol table of the ELF files",
+    )
+    subparser.add_argument(
+        "--runpath",
+        action="store_true",
+        help="Set a runpath relative to the ELF files that need libraries "
+        "of the venv, instead of LD_LIBRARY_PATH",
+    )
+    subparser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the Python modules, using the relocated paths",
+    )
+    subparser.add_argument(
+        "--invalidation-mode",
+        choices=("timestamp", "checked-hash", "unchecked-hash"),
+        default="timestamp",
+        help="How the compiled modules are invalidated",
+    )
+    subparser.add_argument(
+        "--manifest",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="Write the manifest of the venv, with the hash of every file",
+    )
+    subparser.add_argument(
+        "--update",
+        action="store_true",
+        help="Update an existing venv using the last manifest, extracting only "
+        "the new or changed packages",
+    )
+    subparser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Show the packages, files, size and conflicts of the venv, "
+        "reading only the headers of the packages",
+    )
+    subparser.add_argument(
+        "--check-update",
+        action="store_true",
+        help="Compare the updated venv with a clean build",
+    )
+    subparser.add_argument(
+        "--output-archive",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="Write the venv into an archive (.tar, .tar.gz, .tar.xz or .tar.zst)",
+    )
+    _add_archive_arguments(subparser)
+    subparser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Show the time used by each phase and package",
+    )
+    subparser.add_argument(
+        "--timings-json",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="Write the time used by each phase and package in a JSON file",
+    )
     subparser.add_argument("-v", "--version", default="0.1.0", help="Package version")
     subparser.set_defaults(func=create)
 
@@ -725,6 +4586,7 @@ if __name__ == "__main__":
         default="exclude-rpm",
         help="File with packages to exclude",
     )
+    _add_api_arguments(subparser)
     subparser.set_defaults(func=include)
 
     # Parser for `exclude` command
@@ -735,7 +4597,9 @@ if __name__ == "__main__":
 
     # Parser for `binary` command
     subparser = subparsers.add_parser("binary", help="List the binary packages")
-    subparser.add_argument("package", metavar="PACKAGE", help="Source package name")
+    subparser.add_argument(
+        "package", metavar="PACKAGE", nargs="+", help="Source package name"
+    )
     subparser.add_argument(
         "-A", "--apiurl", default="https://api.opensuse.org", help="API address"
     )
@@ -750,13 +4614,16 @@ if __name__ == "__main__":
         default="exclude-rpm",
         help="File with packages to exclude",
     )
+    _add_api_arguments(subparser)
     subparser.set_defaults(func=binary)
 
     # Parser for `requires` command
     subparser = subparsers.add_parser(
         "requires", help="List requirements for a package"
     )
-    subparser.add_argument("package", metavar="PACKAGE", help="Source package name")
+    subparser.add_argument(
+        "package", metavar="PACKAGE", nargs="+", help="Source package name"
+    )
     subparser.add_argument(
         "-A", "--apiurl", default="https://api.opensuse.org", help="API address"
     )
@@ -775,8 +4642,117 @@ if __name__ == "__main__":
         default="exclude-rpm",
         help="File with packages to exclude",
     )
+    _add_api_arguments(subparser)
     subparser.set_defaults(func=requires)
 
+    # Parser for `verify` command
+    subparser = subparsers.add_parser(
+        "verify", help="Verify a virtualenv against its manifest"
+    )
+    subparser.add_argument(
+        "dest_dir",
+        type=pathlib.Path,
+        metavar="DEST_DIR",
+        help="Virtual environment directory",
+    )
+    subparser.add_argument(
+        "manifest",
+        type=pathlib.Path,
+        metavar="MANIFEST",
+        help="Manifest generated by `create`",
+    )
+    subparser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=os.cpu_count(),
+        help="Number of files verified in parallel",
+    )
+    subparser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Do not read the files with the same size and modification time",
+    )
+    subparser.set_defaults(func=verify)
+
+    # Parser for `archive` command
+    subparser = subparsers.add_parser(
+        "archive", help="Write a virtualenv into a compressed archive"
+    )
+    subparser.add_argument(
+        "dest_dir",
+        type=pathlib.Path,
+        metavar="DEST_DIR",
+        help="Virtual environment directory",
+    )
+    subparser.add_argument(
+        "output_archive",
+        type=pathlib.Path,
+        metavar="ARCHIVE",
+        help="Archive file (.tar, .tar.gz, .tar.xz or .tar.zst)",
+    )
+    subparser.add_argument(
+        "--manifest",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="Archive the entries of the manifest, without walking the venv",
+    )
+    subparser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=1,
+        help="Number of threads used by the compression (only zstd)",
+    )
+    _add_archive_arguments(subparser)
+    subparser.set_defaults(func=archive)
+
+    # Parser for `index` command
+    subparser = subparsers.add_parser(
+        "index", help="Create or update the index of a repository"
+    )
+    subparser.add_argument(
+        "repo",
+        type=pathlib.Path,
+        metavar="REPO",
+        help="Repository directory",
+    )
+    subparser.add_argument(
+        "-o",
+        "--index",
+        metavar="FILE",
+        help="Index file (by default REPO/.venvjail-index.db)",
+    )
+    subparser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=1,
+        help="Number of packages indexed in parallel",
+    )
+    subparser.set_defaults(func=index)
+
+    # Parser for `cache` command
+    subparser = subparsers.add_parser("cache", help="Manage the package cache")
+    cache_subparsers = subparser.add_subparsers(help="Sub-commands for cache")
+    subparser = cache_subparsers.add_parser(
+        "prune", help="Remove the least recently used packages"
+    )
+    subparser.add_argument(
+        "cache_dir",
+        type=pathlib.Path,
+        metavar="CACHE_DIR",
+        help="Directory used to cache the extracted packages",
+    )
+    subparser.add_argument(
+        "-m",
+        "--max-size",
+        type=_size,
+        default="10G",
+        help="Maximum size of the cache (like 512M or 10G)",
+    )
+    subparser.set_defaults(func=cache_prune)
+
     args = parser.parse_args()
     if not hasattr(args, "func"):
         print("ERROR: No action specified")